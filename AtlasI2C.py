@@ -11,6 +11,7 @@ import fcntl
 import time
 import copy
 import string
+import collections
 
 class AtlasI2C:
 
@@ -25,6 +26,19 @@ class AtlasI2C:
     DEFAULT_ADDRESS = 98
     LONG_TIMEOUT_COMMANDS = ("R", "CAL")
     SLEEP_COMMANDS = ("SLEEP", )
+    # first byte of a response
+    STATUS_OK = 1
+    STATUS_SYNTAX_ERROR = 2
+    STATUS_PENDING = 254
+    STATUS_NO_DATA = 255
+    # readiness polling: first interval, growth per poll and largest interval
+    POLL_INTERVAL = 0.02
+    POLL_BACKOFF = 1.5
+    POLL_MAX_INTERVAL = 0.2
+    # give up on a command after this many times its nominal timeout
+    POLL_TIMEOUT_FACTOR = 2.0
+    # response times kept per command for the percentiles
+    LATENCY_HISTORY = 64
 
     def __init__(self, address=None, moduletype = "", name = "", bus=None):
         '''
@@ -37,15 +51,23 @@ class AtlasI2C:
         self.bus = bus or self.DEFAULT_BUS
         self._long_timeout = self.LONG_TIMEOUT
         self._short_timeout = self.SHORT_TIMEOUT
-        self.file_read = io.open(file="/dev/i2c-{}".format(self.bus), 
-                                 mode="rb", 
-                                 buffering=0)
-        self.file_write = io.open(file="/dev/i2c-{}".format(self.bus),
-                                  mode="wb", 
-                                  buffering=0)
+        self.file_read, self.file_write = self.open_bus()
         self.set_i2c_address(self._address)
         self._name = name
         self._module = moduletype
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=self.LATENCY_HISTORY))
+
+    def open_bus(self):
+        '''
+        open the read and write streams of the I2C bus device
+        '''
+        file_read = io.open(file="/dev/i2c-{}".format(self.bus), 
+                            mode="rb", 
+                            buffering=0)
+        file_write = io.open(file="/dev/i2c-{}".format(self.bus),
+                             mode="wb", 
+                             buffering=0)
+        return file_read, file_write
 
     # Define properties
     @property
@@ -144,6 +166,10 @@ class AtlasI2C:
         '''
         
         raw_data = self.file_read.read(num_of_bytes)
+        return self.parse(raw_data)
+
+
+    def parse(self, raw_data):
         response = self.get_response(raw_data=raw_data)
         #print(response)
         is_valid, error_code = self.response_valid(response=response)
@@ -168,18 +194,77 @@ class AtlasI2C:
         return timeout
 
 
+    def command_key(self, command):
+        return command.upper().split(",")[0]
+
+
+    def first_poll_delay(self, command):
+        '''
+        no point polling before the fastest response seen for this command
+        '''
+        history = self.latencies.get(self.command_key(command))
+        if history:
+            return 0.9 * min(history)
+        return self.POLL_INTERVAL
+
+
+    def poll_ready(self, num_of_bytes=31):
+        '''
+        one read of the response; None while the device is still processing
+        '''
+        raw_data = self.file_read.read(num_of_bytes)
+        if len(raw_data) > 0:
+            status = ord(raw_data[0]) if self.app_using_python_two() else raw_data[0]
+            if status == self.STATUS_PENDING:
+                return None
+        return raw_data
+
+
     def query(self, command):
         '''
-        write a command to the board, wait the correct timeout, 
-        and read the response
+        write a command to the board, poll until the response is ready
+        (instead of sleeping the worst case timeout) and read it
         '''
         self.write(command)
         current_timeout = self.get_command_timeout(command=command)
         if not current_timeout:
             return "sleep mode"
-        else:
-            time.sleep(current_timeout)
-            return self.read()
+        return self.parse(self.wait_for_response(command, time.monotonic()))
+
+
+    def wait_for_response(self, command, sent):
+        '''
+        poll with growing intervals until the response is ready, and record
+        how long it took; returns the raw response
+        '''
+        deadline = sent + self.POLL_TIMEOUT_FACTOR * self.get_command_timeout(command=command)
+        interval = self.POLL_INTERVAL
+        time.sleep(self.first_poll_delay(command))
+
+        while True:
+            raw_data = self.poll_ready()
+            now = time.monotonic()
+            if raw_data is not None:
+                self.latencies[self.command_key(command)].append(now - sent)
+                return raw_data
+            if now >= deadline:
+                return bytes([self.STATUS_PENDING])
+            time.sleep(min(interval, deadline - now))
+            interval = min(interval * self.POLL_BACKOFF, self.POLL_MAX_INTERVAL)
+
+
+    def latency_stats(self):
+        '''
+        response time percentiles per command: {command: (count, p50, p95, max)}
+        '''
+        stats = {}
+        for key, history in list(self.latencies.items()):
+            ordered = sorted(tuple(history))
+            if not ordered:
+                continue
+            pick = lambda q: ordered[min(len(ordered) - 1, int(round(q / 100.0 * (len(ordered) - 1))))]
+            stats[key] = (len(ordered), pick(50), pick(95), ordered[-1])
+        return stats
 
 
     def close(self):
@@ -204,3 +289,43 @@ class AtlasI2C:
         self.set_i2c_address(prev_addr)
 
         return i2c_devices
+
+
+def query_all(devices, command):
+    '''
+    send the same command to several EZO devices and collect all the
+    responses, so N devices cost about one conversion time rather than N;
+    returns the responses in device order
+    '''
+    sent = {}
+    for device in devices:
+        device.write(command)
+        sent[device] = time.monotonic()
+
+    if not devices[0].get_command_timeout(command=command):
+        return ["sleep mode"] * len(devices)
+
+    responses = {}
+    pending = list(devices)
+    interval = AtlasI2C.POLL_INTERVAL
+    time.sleep(min(device.first_poll_delay(command) for device in devices))
+
+    while pending:
+        for device in list(pending):
+            raw_data = device.poll_ready()
+            now = time.monotonic()
+            deadline = sent[device] + device.POLL_TIMEOUT_FACTOR * device.get_command_timeout(command=command)
+            if raw_data is not None:
+                device.latencies[device.command_key(command)].append(now - sent[device])
+            elif now >= deadline:
+                raw_data = bytes([device.STATUS_PENDING])
+            else:
+                continue
+            responses[device] = device.parse(raw_data)
+            pending.remove(device)
+
+        if pending:
+            time.sleep(interval)
+            interval = min(interval * AtlasI2C.POLL_BACKOFF, AtlasI2C.POLL_MAX_INTERVAL)
+
+    return [responses[device] for device in devices]
@@ -1,4 +1,6 @@
 import math
+import threading
+import collections
 import numpy
 
 ASY_SAFEGUARD = 1.0002
@@ -13,6 +15,33 @@ TAO_SQRTH2OMAX = 6.2365
 TAO_COMP_MIN = 0.400
 TAO_COMP_MAX = 1.000
 
+# Raw count -> temperature tables, one per calibration, most recent last
+LUT_CACHE_SIZE = 8
+_lut_cache = collections.OrderedDict()
+_lut_lock = threading.Lock()
+
+# Camera parameter names, as written to the -stats.csv rows by
+# thermal_control.py, and the attribute each one sets
+STATS_PARAMS = {
+	'J0': 'm_J0',
+	'J1': 'm_J1',
+	'R': 'm_R',
+	'B': 'm_B',
+	'F': 'm_F',
+	'X': 'm_X',
+	'alpha1': 'm_alpha1',
+	'alpha2': 'm_alpha2',
+	'beta1': 'm_beta1',
+	'beta2': 'm_beta2',
+	'ObjectEmissivity': 'm_Emissivity',
+	'ObjectDistance': 'm_ObjectDistance',
+	'AtmosphericTemperature': 'm_AtmTemp',
+	'RelativeHumidity': 'm_RelHum',
+	'ReflectedTemperature': 'm_AmbTemp',
+	'ExtOpticsTemperature': 'm_ExtOptTemp',
+	'ExtOpticsTransmission': 'm_ExtOptTransm',
+}
+
 class RadiometricData:
 	"""TODO: What does this do?"""
 	lPixval = None # the radiometric data
@@ -39,9 +68,19 @@ class RadiometricData:
 	m_F = 1
 	m_B = 1430.1
 
+	_calcKey = None
+
 	def __init__(self):
 		pass
 
+	def setFromStats(self, stats):
+		"""Take calibration parameters from a stats row; missing or unreadable values keep their current setting."""
+		for name, attr in STATS_PARAMS.items():
+			try:
+				setattr(self, attr, float(stats[name]))
+			except (KeyError, TypeError, ValueError):
+				pass
+
 	def doCalcAtmTao(self):
 		#double tao, dtao
 		#double H, T, sqrtD, X, a1, b1, a2, b2
@@ -189,27 +228,110 @@ class RadiometricData:
 
 		return (Tkelvin)
 	
-	def getTempFast(self):
-		self.doUpdateCalcConst()
-
-		dPow = (self.lPixval - self.m_J0) / self.m_J1
-		dSig = self.m_K1 * dPow - self.m_K2
-		dbl_reg = self.m_R / dSig + self.m_F
-
-		if (self.m_F <= 1.0):
-			dbl_reg[dbl_reg < ASY_SAFEGUARD] = ASY_SAFEGUARD
+	def calibrationKey(self):
+		"""Tuple of every parameter the conversion constants depend on."""
+		return (self.m_J0, self.m_J1, self.m_R, self.m_B, self.m_F, self.m_X,
+			self.m_alpha1, self.m_alpha2, self.m_beta1, self.m_beta2,
+			self.m_Emissivity, self.m_ObjectDistance, self.m_AtmTemp, self.m_RelHum,
+			self.m_AmbTemp, self.m_ExtOptTemp, self.m_ExtOptTransm)
+
+	def updateCalcConstIfChanged(self):
+		"""Re-run doUpdateCalcConst only when a calibration parameter has changed."""
+		key = self.calibrationKey()
+		if self.m_K1 is None or self._calcKey != key:
+			self.doUpdateCalcConst()
+			self._calcKey = key
+
+	def getTempBatch(self, lPixval, out=None, celsius=False):
+		"""Convert raw counts to temperature without full-frame temporaries.
+
+		lPixval is one frame (480, 640) or a stack (N, 480, 640) of uint16 counts.
+		The result is written into out (float32 by default, allocated if not
+		given) in Kelvin, or Celsius if celsius is True, and out is returned.
+		"""
+		lPixval = numpy.asarray(lPixval)
+		if out is None:
+			out = numpy.empty(lPixval.shape, dtype=numpy.float32)
+		elif out.shape != lPixval.shape:
+			raise ValueError("out has shape %s, expected %s" % (out.shape, lPixval.shape))
+		elif out.dtype.kind != 'f':
+			raise ValueError("out must be a floating point array, got %s" % out.dtype)
+
+		self.updateCalcConstIfChanged()
+
+		# K1 * (pix - J0) / J1 - K2 folded into a single scale and offset
+		scale = self.m_K1 / self.m_J1
+		offset = -(self.m_K1 * self.m_J0 / self.m_J1 + self.m_K2)
+
+		if self.m_F <= 1.0:
+			floor = ASY_SAFEGUARD
 		else:
-			tmp = m_F * ASY_SAFEGUARD
-			dbl_reg[dbl_reg < tmp] = tmp
-		
-				
-		self.Tkelvin = self.m_B / numpy.log(dbl_reg)
+			floor = self.m_F * ASY_SAFEGUARD
+
+		# Tkelvin = B / log(R / objSig + F), evaluated in place in out
+		with numpy.errstate(divide='ignore'):
+			numpy.multiply(lPixval, scale, out=out, casting='unsafe')
+			out += offset
+			numpy.divide(self.m_R, out, out=out)
+			out += self.m_F
+			numpy.maximum(out, floor, out=out)
+			numpy.log(out, out=out)
+			numpy.divide(self.m_B, out, out=out)
+
+		if celsius:
+			out -= 273.15
+
+		return(out)
+
+	def getTempLUT(self, celsius=False):
+		"""Return the 65536-entry float32 table of temperature for every Mono16 count.
+
+		Tables are kept in a small LRU keyed on the full calibration, so frames
+		sharing camera parameters reuse the same table.
+		"""
+		key = self.calibrationKey() + (bool(celsius),)
+		with _lut_lock:
+			lut = _lut_cache.get(key)
+			if lut is not None:
+				_lut_cache.move_to_end(key)
+				return(lut)
+
+		lut = self.getTempBatch(numpy.arange(65536, dtype=numpy.uint16), celsius=celsius)
+		lut.flags.writeable = False
+
+		with _lut_lock:
+			_lut_cache[key] = lut
+			while len(_lut_cache) > LUT_CACHE_SIZE:
+				_lut_cache.popitem(last=False)
+
+		return(lut)
+
+	def getTempLookup(self, lPixval, out=None, celsius=False):
+		"""Same as getTempBatch, but a single table gather per frame.
+
+		lPixval must hold uint16 counts; out, if given, must be float32.
+		"""
+		lPixval = numpy.asarray(lPixval)
+		if lPixval.dtype != numpy.uint16:
+			raise ValueError("lookup conversion needs uint16 counts, got %s" % lPixval.dtype)
+		if out is None:
+			out = numpy.empty(lPixval.shape, dtype=numpy.float32)
+		elif out.shape != lPixval.shape or out.dtype != numpy.float32:
+			raise ValueError("out must be float32 with shape %s" % (lPixval.shape,))
+
+		# every uint16 is a valid index, so 'clip' skips the bounds check
+		numpy.take(self.getTempLUT(celsius), lPixval, out=out, mode='clip')
+		return(out)
+
+	def getTempFast(self):
+		self.Tkelvin = self.getTempBatch(self.lPixval, out=numpy.empty(numpy.shape(self.lPixval)))
 		return(self.Tkelvin)
 
-d = RadiometricData()
-d.lPixval = numpy.ones((640, 480)) * 14000
+if __name__ == "__main__":
+	d = RadiometricData()
+	d.lPixval = numpy.ones((640, 480)) * 14000
 
-#print(d.getTemp())
-print(d.getTempFast())
-d.lPixval = numpy.ones((640, 480)) * 13000
-print(d.getTempFast())
+	#print(d.getTemp())
+	print(d.getTempFast())
+	d.lPixval = numpy.ones((640, 480)) * 13000
+	print(d.getTempFast())
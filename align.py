@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+
+# Offline registration of the infrared frames of a campaign.
+#
+# The camera sits on a mast for days, so the scene drifts slowly (wind,
+# thermal expansion) and now and then jumps (a bump, a re-mount). Every
+# frame is registered to a keyframe by FFT phase correlation: the
+# normalized cross-power spectrum of the two frames transforms back to a
+# surface with a single peak at their relative shift, found to a fraction
+# of a pixel by a parabola through the peak and its neighbours. The
+# cross-power is weighted towards low spatial frequencies (BANDWIDTH), as
+# the highest ones carry mostly sensor noise. The peak height (1.0 for a
+# pure translation, near 0 for unrelated images) is the quality of the
+# match.
+#
+# Keyframes roll: every KEYFRAME_INTERVAL-th frame is a candidate and is
+# linked to the keyframe before it, so the drift adds up along the chain.
+# A candidate that does not match well enough is rejected and its frames go
+# to the last good keyframe; after KEYFRAME_PATIENCE rejections in a row
+# the next candidate starts a new alignment group (the view has changed
+# for good). Frames whose match is poor, or whose shift from the group
+# reference is more than MAX_SHIFT pixels, are flagged. This replaces the
+# MATLAB align_thermal step and the manual deletion of badly aligned frames
+# described in manuals/.
+#
+# The keyframe links and then the frames are spread over a process pool;
+# each worker computes a keyframe's spectrum once for all of its frames.
+#
+# usage: python align.py results_231020-142501 [results_231021-080000 ...] [-o OUTPUT_DIR] [-j WORKERS]
+#
+# Runs are taken in time order and registered as one sequence. Output (in
+# OUTPUT_DIR, the first results directory by default):
+#   alignment.csv   per frame: run, counter, timestamp, keyframe, group,
+#                   dy/dx (pixels; the frame shows the group reference
+#                   moved by this much), quality and flag ('' if aligned,
+#                   'quality' or 'shift')
+#   aligned.npy     with --aligned: uint16 (N, H, W) frames moved back onto
+#                   the group reference by whole pixels, 0 where there is
+#                   no data
+#
+
+import os
+import csv
+import time
+import argparse
+import multiprocessing
+
+# Logging and print statements
+import logging
+runlog = logging.getLogger()
+
+import numpy
+
+from run_reader import RunReader
+
+ALIGNMENT_NAME = 'alignment.csv'
+ALIGNED_NAME = 'aligned.npy'
+ALIGNMENT_FIELDS = ['index', 'run', 'counter', 'timestamp', 'keyframe', 'group', 'dy', 'dx', 'quality', 'flag']
+
+KEYFRAME_INTERVAL = 10
+
+# phase correlation peak below which a match is poor
+MIN_QUALITY = 0.1
+
+# shift from the group reference, in pixels, beyond which a frame is flagged
+MAX_SHIFT = 20.0
+
+# rejected keyframe candidates in a row before a new group is started
+KEYFRAME_PATIENCE = 3
+
+# Frames handed to a worker at a time
+CHUNK_SIZE = 32
+
+# standard deviation of the Gaussian weight on the cross-power spectrum,
+# in cycles per pixel
+BANDWIDTH = 0.1
+
+# keeps the normalization finite where the cross-power spectrum is zero
+EPSILON = 1e-12
+
+# per process caches: open runs, and the window and weights of each frame shape
+readers = {}
+windows = {}
+weights = {}
+
+def reader(run_dir, store):
+    key = (run_dir, store)
+    if key not in readers:
+        readers[key] = RunReader(run_dir, store)
+    return readers[key]
+
+def window(shape):
+    """2-D Hann window, so the frame edges do not correlate as a strong feature."""
+    if shape not in windows:
+        windows[shape] = numpy.outer(numpy.hanning(shape[0]), numpy.hanning(shape[1])).astype(numpy.float32)
+    return windows[shape]
+
+def weight(shape):
+    """Low-pass weight of the rfft2 cross-power, scaled so an exact match peaks at 1.0."""
+    if shape not in weights:
+        fy = numpy.fft.fftfreq(shape[0])[:, None]
+        fx = numpy.fft.fftfreq(shape[1])[None, :]
+        full = numpy.exp(-(fy * fy + fx * fx) / (2 * BANDWIDTH * BANDWIDTH))
+        weights[shape] = (full[:, :shape[1] // 2 + 1] / full.mean()).astype(numpy.float32)
+    return weights[shape]
+
+def spectrum(frame):
+    """Spectrum of a frame for phase correlation: mean removed, windowed, real FFT."""
+    data = numpy.asarray(frame, dtype=numpy.float32)
+    data = (data - data.mean()) * window(data.shape)
+    return numpy.fft.rfft2(data)
+
+def peak_offset(below, centre, above):
+    """Sub-pixel position of a peak from a parabola through three samples, in (-0.5, 0.5)."""
+    curvature = below - 2.0 * centre + above
+    if curvature >= 0:
+        return 0.0
+    return float(numpy.clip(0.5 * (below - above) / curvature, -0.5, 0.5))
+
+def correlate(frame_spectrum, key_spectrum, shape):
+    """(dy, dx, quality) of a frame relative to a keyframe, from their spectra.
+
+    frame[y, x] ~ key[y - dy, x - dx]; quality is the phase correlation peak.
+    """
+    cross = frame_spectrum * numpy.conj(key_spectrum)
+    cross *= weight(shape) / (numpy.abs(cross) + EPSILON)
+    surface = numpy.fft.irfft2(cross, s=shape)
+
+    py, px = numpy.unravel_index(numpy.argmax(surface), shape)
+    height, width = shape
+    dy = py + peak_offset(surface[py - 1, px], surface[py, px], surface[(py + 1) % height, px])
+    dx = px + peak_offset(surface[py, px - 1], surface[py, px], surface[py, (px + 1) % width])
+    # the surface wraps around: past half the frame is a negative shift
+    if dy > height / 2:
+        dy -= height
+    if dx > width / 2:
+        dx -= width
+    return dy, dx, float(surface[py, px])
+
+def shift_frame(frame, dy, dx, out):
+    """Move a frame by whole pixels (-dy, -dx) onto its reference; 0 where there is no data."""
+    dy, dx = int(round(dy)), int(round(dx))
+    height, width = frame.shape
+    out.fill(0)
+    if abs(dy) >= height or abs(dx) >= width:
+        return out
+    out[max(0, -dy):height - max(0, dy), max(0, -dx):width - max(0, dx)] = \
+        frame[max(0, dy):height - max(0, -dy), max(0, dx):width - max(0, -dx)]
+    return out
+
+def find_frames(results_dirs, store='frames'):
+    """(run_dir, position, counter, timestamp) of every frame of the runs, runs in time order."""
+    runs = []
+    for run_dir in results_dirs:
+        run = RunReader(run_dir, store)
+        if len(run) == 0:
+            runlog.warning("No frames found in %s" % run_dir)
+            continue
+        runs.append((float(run.timestamps.min()), run_dir, run))
+    runs.sort(key=lambda entry: entry[0])
+
+    frames = []
+    for start, run_dir, run in runs:
+        for position in range(len(run)):
+            frames.append((run_dir, position, int(run.counters[position]), float(run.timestamps[position])))
+        run.close()
+    return frames
+
+def frame_spectrum(frame, store):
+    run_dir, position = frame[:2]
+    return spectrum(reader(run_dir, store).frame(position))
+
+def link_chunk(args):
+    """Worker: match each keyframe candidate of a chunk to the candidate before it."""
+    store, shape, candidates = args
+    links = []
+    previous = frame_spectrum(candidates[0][1], store)
+    for index, frame in candidates[1:]:
+        current = frame_spectrum(frame, store)
+        links.append((index,) + correlate(current, previous, shape))
+        previous = current
+    return links
+
+def register_chunk(args):
+    """Worker: register the frames of a chunk of keyframe segments; writes aligned frames if asked."""
+    store, shape, segments, max_shift, min_quality, aligned_path = args
+    aligned = numpy.load(aligned_path, mmap_mode='r+') if aligned_path else None
+
+    rows = []
+    key_index = key_spectrum = None
+    for keyframe, members in segments:
+        if keyframe['index'] != key_index:
+            key_index = keyframe['index']
+            key_spectrum = frame_spectrum(keyframe['frame'], store)
+
+        for index, frame in members:
+            data = reader(frame[0], store).frame(frame[1])
+            if index == key_index:
+                dy, dx, quality = 0.0, 0.0, 1.0
+            else:
+                dy, dx, quality = correlate(spectrum(data), key_spectrum, shape)
+            dy += keyframe['dy']
+            dx += keyframe['dx']
+
+            flag = ''
+            if quality < min_quality:
+                flag = 'quality'
+            elif numpy.hypot(dy, dx) > max_shift:
+                flag = 'shift'
+
+            if aligned is not None:
+                shift_frame(data, dy, dx, aligned[index])
+
+            rows.append({
+                'index': index,
+                'run': os.path.basename(os.path.normpath(frame[0])),
+                'counter': frame[2],
+                'timestamp': round(frame[3], 3),
+                'keyframe': key_index,
+                'group': keyframe['group'],
+                'dy': round(dy, 2),
+                'dx': round(dx, 2),
+                'quality': round(quality, 4),
+                'flag': flag,
+            })
+
+    if aligned is not None:
+        aligned.flush()
+        del aligned
+    return rows
+
+def choose_keyframes(frames, links, store, shape, interval, min_quality, patience):
+    """Walk the candidate chain; the keyframe each candidate's segment registers to.
+
+    Returns {candidate index: keyframe}, each keyframe a dict of index,
+    frame, group and its dy/dx from the group reference.
+    """
+    first = {'index': 0, 'frame': frames[0], 'group': 0, 'dy': 0.0, 'dx': 0.0}
+    assigned = {0: first}
+    last_good, previous, rejected = first, 0, 0
+
+    for index in range(interval, len(frames), interval):
+        if last_good['index'] == previous:
+            dy, dx, quality = links[index]
+        else:
+            # the candidate before was rejected: match against the last keyframe
+            dy, dx, quality = correlate(frame_spectrum(frames[index], store),
+                                        frame_spectrum(last_good['frame'], store), shape)
+        previous = index
+
+        if quality >= min_quality:
+            last_good = {'index': index, 'frame': frames[index], 'group': last_good['group'],
+                         'dy': last_good['dy'] + dy, 'dx': last_good['dx'] + dx}
+            rejected = 0
+        else:
+            rejected += 1
+            if rejected > patience:
+                last_good = {'index': index, 'frame': frames[index], 'group': last_good['group'] + 1,
+                             'dy': 0.0, 'dx': 0.0}
+                rejected = 0
+                runlog.warning("Frame %d of %s starts alignment group %d" %
+                               (frames[index][2], frames[index][0], last_good['group']))
+        assigned[index] = last_good
+    return assigned
+
+def align(results_dirs, output_dir=None, workers=None, store='frames', interval=KEYFRAME_INTERVAL,
+          min_quality=MIN_QUALITY, max_shift=MAX_SHIFT, patience=KEYFRAME_PATIENCE, write_aligned=False,
+          chunk_size=CHUNK_SIZE):
+    """Register every frame of the runs to rolling keyframes across a process pool.
+
+    Returns the list of per-frame rows, which is also written to alignment.csv.
+    """
+    output_dir = output_dir or results_dirs[0]
+    os.makedirs(output_dir, exist_ok=True)
+
+    time_start = time.time()
+    frames = find_frames(results_dirs, store)
+    if not frames:
+        runlog.warning("No frames found in %s" % ', '.join(results_dirs))
+        return []
+
+    first = reader(frames[0][0], store)
+    shape, dtype = tuple(first.shape), first.dtype
+    runlog.warning("Aligning %d frames from %d runs" % (len(frames), len(set(f[0] for f in frames))))
+
+    with multiprocessing.Pool(workers or os.cpu_count()) as pool:
+        # links between consecutive keyframe candidates; neighbouring chunks
+        # share a candidate, so each chunk links to the one before it too
+        candidates = [(index, frames[index]) for index in range(0, len(frames), interval)]
+        step = max(1, chunk_size)
+        tasks = [(store, shape, candidates[max(0, i - 1):i + step]) for i in range(1, len(candidates), step)]
+        links = {}
+        for result in pool.imap_unordered(link_chunk, tasks):
+            links.update((index, (dy, dx, quality)) for index, dy, dx, quality in result)
+
+        assigned = choose_keyframes(frames, links, store, shape, interval, min_quality, patience)
+
+        aligned_path = None
+        if write_aligned:
+            aligned_path = os.path.join(output_dir, ALIGNED_NAME)
+            aligned = numpy.lib.format.open_memmap(aligned_path, mode='w+', dtype=dtype,
+                                                   shape=(len(frames),) + shape)
+            del aligned
+
+        segments = [(assigned[start], list(enumerate(frames[start:start + interval], start)))
+                    for start in range(0, len(frames), interval)]
+        per_chunk = max(1, chunk_size // interval)
+        tasks = [(store, shape, segments[i:i + per_chunk], max_shift, min_quality, aligned_path)
+                 for i in range(0, len(segments), per_chunk)]
+        rows = []
+        for result in pool.imap_unordered(register_chunk, tasks):
+            rows.extend(result)
+    rows.sort(key=lambda row: row['index'])
+
+    with open(os.path.join(output_dir, ALIGNMENT_NAME), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=ALIGNMENT_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    elapsed = time.time() - time_start
+    flagged = sum(1 for row in rows if row['flag'])
+    keyframes = set(row['keyframe'] for row in rows)
+    groups = set(row['group'] for row in rows)
+    runlog.warning("Aligned %d frames in %.1f s (%.1f frames/s): %d keyframes, %d groups, %d flagged" %
+                   (len(rows), elapsed, len(rows) / elapsed, len(keyframes), len(groups), flagged))
+
+    return rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Register the infrared frames of one or more results_* directories.')
+    parser.add_argument('results_dirs', nargs='+')
+    parser.add_argument('-o', '--output-dir', default=None)
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='worker processes (default: all cores)')
+    parser.add_argument('--store', default='frames',
+                        help='segment store to read, e.g. continuous (default: frames)')
+    parser.add_argument('--interval', type=int, default=KEYFRAME_INTERVAL,
+                        help='frames between keyframe candidates')
+    parser.add_argument('--min-quality', type=float, default=MIN_QUALITY,
+                        help='phase correlation peak below which a match is poor')
+    parser.add_argument('--max-shift', type=float, default=MAX_SHIFT,
+                        help='shift from the group reference in pixels beyond which a frame is flagged')
+    parser.add_argument('--patience', type=int, default=KEYFRAME_PATIENCE,
+                        help='rejected keyframe candidates in a row before a new group starts')
+    parser.add_argument('--aligned', action='store_true', help='also write the aligned frames to aligned.npy')
+    args = parser.parse_args()
+
+    align(args.results_dirs, args.output_dir, args.workers, args.store, args.interval, args.min_quality,
+          args.max_shift, args.patience, args.aligned)
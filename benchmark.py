@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+
+# Benchmark suite for the acquisition and processing path.
+#
+# Every benchmark reports one or more stages in frames/s and MB/s (of raw
+# 640x480 Mono16 infrared data) together with per-frame latency percentiles.
+# Results are appended to a JSON lines history file and compared with the
+# previous run of the same stage on the same host, so a slowdown shows up
+# before a field season rather than during one.
+#
+# usage: python benchmark.py [BENCHMARK ...] [--history FILE] [--dir DIR] [--quick]
+#
+#   python benchmark.py                    all benchmarks
+#   python benchmark.py conversion save    just those two
+#   python benchmark.py --dir /media/ubuntu/FLIRCAM   write test files to the USB stick
+#
+# Benchmarks: conversion, save, codecs, atlas, loop (the loop benchmark runs
+# thermal_control.py against the simulators for about half a minute).
+#
+
+import os
+import sys
+import json
+import time
+import queue
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import collections
+
+import numpy
+
+FRAME_SHAPE = (480, 640)
+FRAME_BYTES = FRAME_SHAPE[0] * FRAME_SHAPE[1] * 2
+
+HISTORY_FILE = 'benchmark-history.jsonl'
+
+# a stage this much slower than its previous run is flagged
+REGRESSION_THRESHOLD = 0.10
+
+BENCHMARKS = collections.OrderedDict()
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+def synthetic_frames(count=8, seed=1):
+    """Smooth radiometric-looking uint16 frames with sensor noise."""
+    rng = numpy.random.default_rng(seed)
+    yy, xx = numpy.mgrid[0:FRAME_SHAPE[0], 0:FRAME_SHAPE[1]]
+    base = 14000 + 800 * numpy.sin(xx / 90.0) * numpy.cos(yy / 70.0) + 2.0 * yy
+    return [(base + rng.normal(0, 6, FRAME_SHAPE)).astype(numpy.uint16) for _ in range(count)]
+
+def visible_frame(seed=2):
+    rng = numpy.random.default_rng(seed)
+    return rng.integers(0, 255, (720, 1280, 3), dtype=numpy.uint8)
+
+def time_calls(func, count):
+    """Run func(i) count times; per-call durations in seconds."""
+    durations = []
+    for i in range(count):
+        t = time.perf_counter()
+        func(i)
+        durations.append(time.perf_counter() - t)
+    return durations
+
+def stage(name, durations=None, frames=None, elapsed=None, frame_bytes=FRAME_BYTES, **extra):
+    """Summarise a stage from per-frame durations, or from a frame count over elapsed time."""
+    if durations is not None:
+        frames = len(durations)
+        elapsed = sum(durations)
+    result = {
+        'stage': name,
+        'frames': frames,
+        'frames_s': frames / elapsed if elapsed > 0 else float('inf'),
+        'mb_s': frames * frame_bytes / elapsed / 1e6 if elapsed > 0 else float('inf'),
+    }
+    if durations is not None:
+        result['p50_ms'] = float(numpy.percentile(durations, 50)) * 1000
+        result['p95_ms'] = float(numpy.percentile(durations, 95)) * 1000
+    result.update(extra)
+    return result
+
+@benchmark('conversion')
+def bench_conversion(args):
+    from RadiometricData import RadiometricData
+
+    frames = synthetic_frames()
+    n = 10 if args.quick else 50
+    rd = RadiometricData()
+    results = []
+
+    def fast(i):
+        rd.lPixval = frames[i % len(frames)]
+        rd.getTempFast()
+    results.append(stage('getTempFast', time_calls(fast, n)))
+
+    out = numpy.empty(FRAME_SHAPE, dtype=numpy.float32)
+    results.append(stage('getTempBatch', time_calls(
+        lambda i: rd.getTempBatch(frames[i % len(frames)], out=out), n)))
+
+    stack = numpy.stack(frames)
+    stack_out = numpy.empty(stack.shape, dtype=numpy.float32)
+    durations = time_calls(lambda i: rd.getTempBatch(stack, out=stack_out), max(2, n // len(frames)))
+    results.append(stage('getTempBatch_stack', frames=len(durations) * len(frames), elapsed=sum(durations)))
+
+    rd.getTempLUT()
+    results.append(stage('getTempLookup', time_calls(
+        lambda i: rd.getTempLookup(frames[i % len(frames)], out=out), n)))
+
+    return results
+
+@benchmark('save')
+def bench_save(args):
+    import cv2
+    import save_queue
+
+    frames = synthetic_frames()
+    visible = visible_frame()
+    n = 8 if args.quick else 32
+    results = []
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        prefix = os.path.join(tmp, 'bench')
+
+        results.append(stage('npy_write', time_calls(
+            lambda i: numpy.save('%s_%d-infrared-data.npy' % (prefix, i), frames[i % len(frames)]), n)))
+
+        previews = []
+        results.append(stage('preview', time_calls(
+            lambda i: previews.append(save_queue.render_preview(frames[i % len(frames)])), n)))
+
+        results.append(stage('png_infrared', time_calls(
+            lambda i: cv2.imwrite('%s_%d-infrared.png' % (prefix, i), previews[i % len(previews)]), n)))
+
+        results.append(stage('png_visible', time_calls(
+            lambda i: cv2.imwrite('%s_%d-visible.png' % (prefix, i), visible), n)))
+
+        # whole image_worker path through a queue, at several worker counts
+        for workers in (1, 4, 8):
+            items = queue.Queue()
+            for i in range(n):
+                items.put((frames[i % len(frames)], visible, '%s_w%d_%d' % (prefix, workers, i), i, time.time()))
+
+            def worker():
+                while True:
+                    try:
+                        item = items.get_nowait()
+                    except queue.Empty:
+                        return
+                    save_queue.save_item(item)
+
+            threads = [threading.Thread(target=worker) for _ in range(workers)]
+            t = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            results.append(stage('image_worker_x%d' % workers, frames=n, elapsed=time.perf_counter() - t))
+
+        # the same, through each save queue mode, including the put() copy
+        for mode in ('threads', 'processes'):
+            save_queue.initialize_queue('files', tmp, processes=(mode == 'processes'))
+            t = time.perf_counter()
+            for i in range(n):
+                save_queue.save_queue.put((frames[i % len(frames)], visible, '%s_%s_%d' % (prefix, mode, i),
+                                           i, time.time()))
+            save_queue.close_queue()
+            results.append(stage('save_queue_' + mode, frames=n, elapsed=time.perf_counter() - t))
+
+    return results
+
+@benchmark('codecs')
+def bench_codecs(args):
+    import frame_codecs
+
+    frames = synthetic_frames()
+    n = 8 if args.quick else 32
+    results = []
+
+    for name, codec in frame_codecs.CODECS.items():
+        payloads = []
+        durations = time_calls(lambda i: payloads.append(codec.encode(frames[i % len(frames)])), n)
+        ratio = FRAME_BYTES / numpy.mean([memoryview(p).nbytes for p in payloads])
+        results.append(stage('encode_' + name, durations, ratio=ratio))
+
+        decoded = []
+        results.append(stage('decode_' + name, time_calls(
+            lambda i: decoded.append(codec.decode(payloads[i], FRAME_SHAPE, numpy.uint16)), n)))
+
+        if any(not numpy.array_equal(d, frames[i % len(frames)]) for i, d in enumerate(decoded)):
+            raise RuntimeError("codec %s is not lossless" % name)
+
+    return results
+
+@benchmark('atlas')
+def bench_atlas(args):
+    import simulators
+
+    n = 1000 if args.quick else 10000
+    bus = simulators.SimulatedI2CBus()
+    sensor = bus.devices[simulators.EZO_HUM_ADDRESS]
+    sensor.write(b'R\x00')
+    sensor.ready_at = 0.0
+
+    class BenchAtlasI2C(simulators.SimulatedAtlasI2C):
+        def open_bus(self):
+            return simulators.SimulatedI2CFile(bus, self), simulators.SimulatedI2CFile(bus, self)
+
+    # an unnamed EZO reports its name as null padding, which get_devices keeps
+    dev = BenchAtlasI2C(address=simulators.EZO_HUM_ADDRESS, moduletype='HUM', name='\x00' * 24)
+
+    def parse(i):
+        # the same parsing as thermal_control.get_rh_temp
+        fields = dev.read().replace("\x00", "").split(": ", 1)[1].split(",")
+        return float(fields[0]), float(fields[1])
+
+    return [stage('read_parse', time_calls(parse, n), frame_bytes=31)]
+
+@benchmark('loop')
+def bench_loop(args):
+    seconds_per_image = 1.0
+    minutes = 0.1 if args.quick else 0.25
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        env = dict(os.environ, FLIR_SIMULATE='all', FLIR_OUTPUT_ROOT=tmp,
+                   FLIR_RUN_MINUTES=str(minutes), FLIR_SECONDS_PER_IMAGE=str(seconds_per_image))
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thermal_control.py')
+        subprocess.run([sys.executable, script], env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        run_dir = [d for d in os.listdir(tmp) if d.startswith('results_')][0]
+        with open(os.path.join(tmp, run_dir, 'cadence.json')) as f:
+            report = {task['task']: task for task in json.load(f)}
+
+    results = []
+    for name, task in report.items():
+        if task['runs'] < 2:
+            continue
+        results.append(stage('task_' + name, frames=task['runs'] - 1,
+                             elapsed=task['achieved_period_s'] * (task['runs'] - 1),
+                             target_period_s=task['period_s'],
+                             achieved_period_s=task['achieved_period_s'],
+                             duration_p50_ms=task['duration_p50_s'] * 1000,
+                             duration_max_ms=task['duration_max_s'] * 1000,
+                             late_p95_ms=task['late_p95_s'] * 1000,
+                             skipped=task['skipped']))
+    return results
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+def load_history(path):
+    history = []
+    if os.path.exists(path):
+        with open(path) as f:
+            history = [json.loads(line) for line in f if line.strip()]
+    return history
+
+def previous_result(history, host, name, stage_name):
+    for entry in reversed(history):
+        if entry['host'] == host and entry['benchmark'] == name and entry['stage'] == stage_name:
+            return entry
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark conversion, saving and the acquisition loop.')
+    parser.add_argument('benchmarks', nargs='*', help='any of: %s' % ', '.join(BENCHMARKS))
+    parser.add_argument('--history', default=HISTORY_FILE, help='JSON lines results history')
+    parser.add_argument('--dir', default=None, help='directory for test files (default: system temp)')
+    parser.add_argument('--quick', action='store_true', help='fewer repetitions')
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark %r" % name)
+
+    host = socket.gethostname()
+    revision = git_revision()
+    history = load_history(args.history)
+    regressions = 0
+
+    with open(args.history, 'a') as f:
+        for name in args.benchmarks or BENCHMARKS:
+            print("== %s" % name)
+            for result in BENCHMARKS[name](args):
+                before = previous_result(history, host, name, result['stage'])
+                change = ''
+                if before and before['frames_s'] > 0:
+                    delta = result['frames_s'] / before['frames_s'] - 1
+                    change = '%+6.1f%%' % (delta * 100)
+                    if delta < -REGRESSION_THRESHOLD:
+                        change += ' REGRESSION'
+                        regressions += 1
+
+                ratio = '  ratio %.2f' % result['ratio'] if 'ratio' in result else ''
+                print("  %-22s %10.1f frames/s %9.1f MB/s%s  %s" %
+                      (result['stage'], result['frames_s'], result['mb_s'], ratio, change))
+
+                entry = dict(result, benchmark=name, host=host, revision=revision, time=time.time())
+                f.write(json.dumps(entry) + '\n')
+
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
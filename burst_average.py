@@ -0,0 +1,64 @@
+# Temporal averaging of a burst of infrared frames.
+#
+# Averaging N consecutive frames of a static scene lowers the temporal
+# noise (and so the effective NETD) by sqrt(N). The frames are summed into
+# a preallocated uint32 buffer as they arrive, so each camera buffer can be
+# released straight away, and the mean is rounded back to uint16 counts:
+# the stored frame keeps the size, dtype and codecs of a single frame.
+#
+# With noise=True the per-pixel sum of squares is kept as well (uint64,
+# exact), and std() gives the per-pixel temporal standard deviation in
+# counts, a noise map of the burst.
+#
+#   burst = BurstAverage((480, 640), noise=True)
+#   burst.reset()
+#   for i in range(8):
+#       burst.add(image.GetNDArray())
+#   frame, noise_map = burst.mean(), burst.std()
+#
+
+import numpy
+
+class BurstAverage:
+    def __init__(self, shape, noise=False):
+        self.shape = tuple(shape)
+        self.noise = noise
+        self.sum = numpy.zeros(self.shape, dtype=numpy.uint32)
+        self.rounded = numpy.empty(self.shape, dtype=numpy.uint32)
+        self.average = numpy.empty(self.shape, dtype=numpy.uint16)
+        if noise:
+            self.sum_squares = numpy.zeros(self.shape, dtype=numpy.uint64)
+            self.square = numpy.empty(self.shape, dtype=numpy.uint64)
+        self.count = 0
+
+    def reset(self):
+        self.sum.fill(0)
+        if self.noise:
+            self.sum_squares.fill(0)
+        self.count = 0
+
+    def add(self, frame):
+        """Add a uint16 frame; it is not referenced afterwards."""
+        if frame.shape != self.shape:
+            raise ValueError("frame of shape %s in a burst of %s" % (frame.shape, self.shape))
+        numpy.add(self.sum, frame, out=self.sum, dtype=numpy.uint32)
+        if self.noise:
+            numpy.multiply(frame, frame, out=self.square, dtype=numpy.uint64)
+            self.sum_squares += self.square
+        self.count += 1
+
+    def mean(self):
+        """The rounded mean frame as uint16; the buffer is reused by the next burst."""
+        if self.count == 0:
+            raise ValueError("empty burst")
+        numpy.add(self.sum, self.count // 2, out=self.rounded)
+        numpy.floor_divide(self.rounded, self.count, out=self.average, casting='unsafe')
+        return self.average
+
+    def std(self):
+        """Per-pixel sample standard deviation in counts (float32), or None without noise or with one frame."""
+        if not self.noise or self.count < 2:
+            return None
+        total = self.sum.astype(numpy.float64)
+        variance = (self.sum_squares - total * total / self.count) / (self.count - 1)
+        return numpy.sqrt(numpy.maximum(variance, 0.0)).astype(numpy.float32)
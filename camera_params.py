@@ -0,0 +1,175 @@
+# Camera parameter layer.
+#
+# Every GetNode(name) is a lookup by string and every value read or written
+# is a GenICam register access over GigE. CameraParams resolves the node
+# handles once, writes a value only when it differs from what the camera
+# already holds, and reads the calibration set (the values RadiometricData
+# needs, plus FocusDistance and TSens) as one snapshot.
+#
+# Snapshots are versioned: the version goes up only when a value changes,
+# and each new version is appended to calibration.jsonl in the run
+# directory. A stats row then only carries calib_version instead of twenty
+# camera values; read_calibrations() gives them back, as reprocess.py does.
+#
+#   params = CameraParams(nodemap, log_path=os.path.join(output_dir, LOG_NAME))
+#   params.set('AtmosphericTemperature', 291.3)    # no register write if unchanged
+#   stats['calib_version'] = params.commit()
+#
+
+import os
+import json
+import math
+import time
+import collections
+
+import devices
+
+# Logging and print statements
+import logging
+runlog = logging.getLogger()
+
+LOG_NAME = 'calibration.jsonl'
+
+# the calibration set and the PySpin pointer type of each node
+CALIBRATION_NODES = collections.OrderedDict([
+    ('AtmosphericTemperature', 'CFloatPtr'),
+    ('EstimatedTransmission', 'CFloatPtr'),
+    ('ExtOpticsTemperature', 'CFloatPtr'),
+    ('ExtOpticsTransmission', 'CFloatPtr'),
+    ('ObjectDistance', 'CFloatPtr'),
+    ('ObjectEmissivity', 'CFloatPtr'),
+    ('ReflectedTemperature', 'CFloatPtr'),
+    ('RelativeHumidity', 'CFloatPtr'),
+    ('FocusDistance', 'CFloatPtr'),
+    ('TSens', 'CFloatPtr'),
+    ('alpha1', 'CFloatPtr'),
+    ('alpha2', 'CFloatPtr'),
+    ('B', 'CFloatPtr'),
+    ('beta1', 'CFloatPtr'),
+    ('beta2', 'CFloatPtr'),
+    ('F', 'CFloatPtr'),
+    ('J0', 'CIntegerPtr'),
+    ('J1', 'CFloatPtr'),
+    ('R', 'CFloatPtr'),
+    ('X', 'CFloatPtr'),
+])
+
+# values this close count as unchanged; the camera stores some of them as
+# float32, so a value read back is rarely bit-identical to the one written
+REL_TOLERANCE = 1e-6
+
+def same(a, b):
+    if a is None or b is None:
+        return a is b
+    return math.isclose(a, b, rel_tol=REL_TOLERANCE)
+
+class Calibration:
+    """One version of the calibration set: version number, host time and values by node name."""
+
+    def __init__(self, version, timestamp, values):
+        self.version = version
+        self.timestamp = timestamp
+        self.values = values
+
+    def changed(self, values):
+        return any(not same(self.values.get(name), value) for name, value in values.items())
+
+class CameraParams:
+    def __init__(self, nodemap, log_path=None):
+        self.PySpin = devices.pyspin()
+        self.nodemap = nodemap
+        self.nodes = {}
+        for name, ptr in CALIBRATION_NODES.items():
+            self.node(name, ptr)
+
+        self.log_path = log_path
+        self.counts = collections.Counter()
+        self.pending = {}
+        self.current = None
+        self.snapshot()
+
+    def node(self, name, ptr='CFloatPtr'):
+        """Node handle for name, resolved on first use."""
+        node = self.nodes.get(name)
+        if node is None:
+            node = self.nodes[name] = getattr(self.PySpin, ptr)(self.nodemap.GetNode(name))
+        return node
+
+    def get(self, name):
+        """Current value of a calibration node, from the latest snapshot or a set()."""
+        return self.pending.get(name, self.current.values[name])
+
+    def read(self, name):
+        self.counts['reads'] += 1
+        return self.node(name).GetValue()
+
+    def set(self, name, value):
+        """Write value unless the camera already holds it; True if it was written.
+
+        The calibration version changes at the next snapshot() or commit(),
+        so several writes in a row make one new version.
+        """
+        current = self.pending.get(name, self.current.values.get(name))
+        if same(current, value):
+            self.counts['unchanged'] += 1
+            return False
+
+        self.node(name).SetValue(value)
+        self.counts['writes'] += 1
+        if name in CALIBRATION_NODES:
+            self.pending[name] = value
+        return True
+
+    def snapshot(self):
+        """Read the whole calibration set; a new version is recorded if any value changed."""
+        values = collections.OrderedDict((name, self.read(name)) for name in CALIBRATION_NODES)
+        self.pending.clear()
+        if self.current is None or self.current.changed(values):
+            self.record(values)
+        return self.current
+
+    def record(self, values):
+        version = self.current.version + 1 if self.current is not None else 0
+        self.current = Calibration(version, time.time(), values)
+        if self.log_path is not None:
+            try:
+                with open(self.log_path, 'a') as f:
+                    f.write(json.dumps({'version': version, 'timestamp': self.current.timestamp,
+                                        'values': values}) + '\n')
+            except OSError as ex:
+                runlog.warning("Could not log calibration version %d: %s" % (version, ex))
+
+    @property
+    def version(self):
+        """Version of the latest snapshot() or commit(); set() calls since then are not in it."""
+        return self.current.version
+
+    def commit(self):
+        """Record the values written by set() since the last snapshot as a new version; returns the version."""
+        if self.pending:
+            values = collections.OrderedDict(self.current.values)
+            values.update(self.pending)
+            self.pending.clear()
+            if self.current.changed(values):
+                self.record(values)
+        return self.current.version
+
+    def log_status(self):
+        runlog.warning("**** Camera params: calibration version %d, %d reads, %d writes, %d unchanged writes skipped" %
+                       (self.version, self.counts['reads'], self.counts['writes'], self.counts['unchanged']))
+
+def read_calibrations(results_dir):
+    """Calibration values of a run by version; empty if it has no calibration log."""
+    calibrations = {}
+    path = os.path.join(results_dir, LOG_NAME)
+    if not os.path.exists(path):
+        return calibrations
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # e.g. a line cut short by a power loss
+                continue
+            calibrations[entry['version']] = entry['values']
+    return calibrations
@@ -0,0 +1,51 @@
+# Camera timestamps on the host clock.
+#
+# Spinnaker stamps every image with the camera's own clock (nanoseconds
+# since the camera started). To compare an infrared frame with a visible
+# frame stamped on the host, the camera clock is mapped onto time.time()
+# using the smallest (host receive time - device time) over the last
+# WINDOW_SECONDS of frames: that is the frame that reached the host with
+# the least transfer delay, so it gives the best estimate of the offset
+# between the two clocks. The window lets the estimate follow the offset
+# upwards too, as it does when the camera clock runs slow or NTP slews the
+# host clock forward.
+#
+#   clock = DeviceClock()
+#   image = camera.GetNextImage(1000)
+#   captured = clock.host_time(image.GetTimeStamp(), time.time())
+#
+
+import collections
+
+# frames (in camera time) the minimum is taken over; short enough that
+# clock drift within it stays in the milliseconds
+WINDOW_SECONDS = 60.0
+
+# an offset this far from the current estimate means the camera clock was
+# reset (camera restarted), so the estimate starts again
+RESYNC_SECONDS = 1.0
+
+class DeviceClock:
+    """Maps device timestamps in nanoseconds to host epoch seconds."""
+
+    def __init__(self):
+        self.offset = None
+        # (device seconds, offset) of recent frames, offsets increasing, so
+        # the first entry is the minimum of the window
+        self.recent = collections.deque()
+
+    def host_time(self, device_ns, received):
+        """Host time at which a frame stamped device_ns, received at received, was captured."""
+        device_s = device_ns * 1e-9
+        offset = received - device_s
+        if self.recent and (device_s < self.recent[-1][0] or offset - self.offset > RESYNC_SECONDS):
+            self.recent.clear()
+
+        while self.recent and self.recent[-1][1] >= offset:
+            self.recent.pop()
+        self.recent.append((device_s, offset))
+        while self.recent[0][0] < device_s - WINDOW_SECONDS:
+            self.recent.popleft()
+
+        self.offset = self.recent[0][1]
+        return device_s + self.offset
@@ -0,0 +1,59 @@
+# Device layer.
+#
+# Hands out either the real hardware drivers or the in-process simulators
+# from simulators.py, so the acquisition code can be run, profiled and
+# load-tested on a plain Linux box with no camera attached.
+#
+# Set FLIR_SIMULATE to 'all', or to a comma separated list of 'camera',
+# 'tc08', 'atlas' and 'webcam', to simulate those devices:
+#
+#   FLIR_SIMULATE=all FLIR_OUTPUT_ROOT=/tmp/thermal python thermal_control.py
+#
+# Real drivers are only imported when they are asked for.
+#
+
+import os
+
+DEVICES = ('camera', 'tc08', 'atlas', 'webcam')
+
+def simulated_devices():
+    value = os.environ.get('FLIR_SIMULATE', '').strip().lower()
+    if value in ('all', '1', 'yes', 'true'):
+        return set(DEVICES)
+    return {name.strip() for name in value.split(',') if name.strip()}
+
+def simulated(device):
+    return device in simulated_devices()
+
+def pyspin():
+    """The PySpin module, or the simulated camera system."""
+    if simulated('camera'):
+        import simulators
+        return simulators.pyspin
+    import PySpin
+    return PySpin
+
+def tc08():
+    """The (usbtc08, assert_pico2000_ok) pair used by thermocouple_control."""
+    if simulated('tc08'):
+        import simulators
+        return simulators.usbtc08, simulators.assert_pico2000_ok
+    from picosdk.usbtc08 import usbtc08
+    from picosdk.functions import assert_pico2000_ok
+    return usbtc08, assert_pico2000_ok
+
+def atlas_i2c():
+    """The AtlasI2C class, or a drop-in subclass talking to a simulated I2C bus."""
+    if simulated('atlas'):
+        import simulators
+        return simulators.SimulatedAtlasI2C
+    from AtlasI2C import AtlasI2C
+    return AtlasI2C
+
+def video_capture(url):
+    """Open the visible camera stream."""
+    if simulated('webcam'):
+        import simulators
+        return simulators.SimulatedVideoCapture(url)
+    import cv2
+    return cv2.VideoCapture(url)
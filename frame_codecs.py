@@ -0,0 +1,175 @@
+# Lossless codecs for 16-bit infrared frames.
+#
+# Radiometric frames are smooth, so neighbouring pixels differ by a few
+# counts. The '-delta' codecs replace every pixel by its difference from
+# the pixel to its left (mod 2**16), split the result into a low byte plane
+# and a high byte plane (the high plane is almost all 0x00 and 0xff) and
+# hand that to a stdlib compressor. 'png' and 'tiff' are OpenCV's 16-bit
+# PNG and LZW TIFF encoders, readable by any image tool.
+#
+#   name         id  file suffix
+#   raw          0   -infrared-data.npy   (numpy.save, as before)
+#   png          1   -infrared-data.png
+#   zlib-delta   2   -infrared-data.frm
+#   lzma-delta   3   -infrared-data.frm
+#   bz2-delta    4   -infrared-data.frm
+#   tiff         5   -infrared-data.tiff
+#
+# The codec is recorded with every frame: in the segment index and record
+# header for the 'segments' storage backend, and in the file suffix (plus
+# the frame_store record header of a .frm file) for the 'files' backend.
+# load_frame() reads any of these files back.
+#
+#   payload = encode(frame, 'zlib-delta')
+#   frame = decode(payload, 'zlib-delta', (480, 640), '<u2')
+#
+# Compare ratio and speed on the target machine with:
+#   python benchmark.py codecs
+#
+
+import os
+import re
+import abc
+import bz2
+import lzma
+import zlib
+
+import numpy
+
+import frame_store
+
+FILE_INFIX = '-infrared-data'
+
+# name of a frame file of the 'files' backend: date, counter and suffix
+FRAME_PATTERN = re.compile(r'out_(\d{6}-\d{6})_(\d+)' + FILE_INFIX + r'\.(npy|frm|png|tiff)$')
+
+def delta_planes(frame):
+    """Horizontal differences of a 2D uint16 frame, as low and high byte planes."""
+    frame = numpy.ascontiguousarray(frame, dtype='<u2')
+    delta = numpy.empty_like(frame)
+    delta[:, 0] = frame[:, 0]
+    numpy.subtract(frame[:, 1:], frame[:, :-1], out=delta[:, 1:])
+    return delta.view(numpy.uint8).reshape(-1, 2).T.copy()
+
+def undelta_planes(planes, shape):
+    planes = numpy.frombuffer(planes, dtype=numpy.uint8).reshape(2, -1)
+    delta = planes.T.copy().view('<u2').reshape(shape)
+    # uint16 accumulation wraps exactly like the subtraction did
+    return numpy.cumsum(delta, axis=1, dtype='<u2')
+
+class Codec(abc.ABC):
+    """A lossless frame encoding: name, numeric id, file suffix, encode() and decode()."""
+
+    def __init__(self, name, codec_id, suffix):
+        self.name = name
+        self.codec_id = codec_id
+        self.suffix = suffix
+
+    @abc.abstractmethod
+    def encode(self, frame):
+        """The encoded frame, as an object supporting the buffer protocol."""
+
+    @abc.abstractmethod
+    def decode(self, payload, shape, dtype):
+        """The frame of the given shape and dtype encoded in payload."""
+
+class RawCodec(Codec):
+    def encode(self, frame):
+        return numpy.ascontiguousarray(frame)
+
+    def decode(self, payload, shape, dtype):
+        return numpy.frombuffer(payload, dtype=dtype).reshape(shape)
+
+class DeltaCodec(Codec):
+    """Delta filter and byte planes, then a stdlib compressor."""
+
+    def __init__(self, name, codec_id, compress, decompress):
+        Codec.__init__(self, name, codec_id, '.frm')
+        self.compress = compress
+        self.decompress = decompress
+
+    def encode(self, frame):
+        return self.compress(delta_planes(frame))
+
+    def decode(self, payload, shape, dtype):
+        return undelta_planes(self.decompress(bytes(payload)), shape).astype(dtype, copy=False)
+
+class OpenCVCodec(Codec):
+    def __init__(self, name, codec_id, suffix, params=()):
+        Codec.__init__(self, name, codec_id, suffix)
+        self.params = list(params)
+
+    def encode(self, frame):
+        import cv2
+        ok, encoded = cv2.imencode(self.suffix, frame, self.params)
+        if not ok:
+            raise ValueError("OpenCV could not encode a %s frame as %s" % (frame.dtype, self.suffix))
+        return encoded
+
+    def decode(self, payload, shape, dtype):
+        import cv2
+        buf = numpy.frombuffer(payload, dtype=numpy.uint8)
+        return cv2.imdecode(buf, cv2.IMREAD_UNCHANGED).astype(dtype, copy=False)
+
+# cv2.IMWRITE_PNG_COMPRESSION = 16, cv2.IMWRITE_TIFF_COMPRESSION = 259 (5 = LZW),
+# as numbers so this module imports without OpenCV
+CODECS = {codec.name: codec for codec in (
+    RawCodec('raw', frame_store.CODEC_RAW, '.npy'),
+    OpenCVCodec('png', frame_store.CODEC_PNG, '.png', (16, 1)),
+    DeltaCodec('zlib-delta', 2, lambda data: zlib.compress(data, 1), zlib.decompress),
+    DeltaCodec('lzma-delta', 3, lambda data: lzma.compress(data, preset=0), lzma.decompress),
+    DeltaCodec('bz2-delta', 4, lambda data: bz2.compress(data, 1), bz2.decompress),
+    OpenCVCodec('tiff', 5, '.tiff', (259, 5)),
+)}
+
+CODEC_IDS = {codec.codec_id: codec for codec in CODECS.values()}
+
+def get(codec):
+    """Look a codec up by name or numeric id."""
+    try:
+        return CODEC_IDS[codec] if isinstance(codec, (int, numpy.integer)) else CODECS[codec]
+    except KeyError:
+        raise ValueError("unknown frame codec %r" % (codec,)) from None
+
+def encode(frame, codec='raw'):
+    """Encode a frame; returns an object supporting the buffer protocol."""
+    return get(codec).encode(frame)
+
+def decode(payload, codec, shape, dtype='<u2'):
+    return get(codec).decode(payload, tuple(shape), numpy.dtype(dtype))
+
+def save_frame(fileprefix, frame, codec='raw'):
+    """Write fileprefix + '-infrared-data' + the codec's suffix; returns the path."""
+    codec = get(codec)
+    path = fileprefix + FILE_INFIX + codec.suffix
+
+    if codec.name == 'raw':
+        numpy.save(path, frame)
+        return path
+
+    payload = memoryview(codec.encode(frame)).cast('B')
+    with open(path, 'wb') as f:
+        if codec.suffix == '.frm':
+            f.write(frame_store.pack_header(frame_store.KIND_INFRARED, codec.codec_id, 0, 0.0,
+                                            frame.shape, frame.dtype, payload.nbytes))
+        f.write(payload)
+    return path
+
+def load_frame(path, mmap_mode=None):
+    """Read a frame written by save_frame, whatever its codec."""
+    suffix = os.path.splitext(path)[1]
+    if suffix == '.npy':
+        return numpy.load(path, mmap_mode=mmap_mode)
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if suffix == '.frm':
+        header = frame_store.unpack_header(data)
+        payload = memoryview(data)[frame_store.HEADER_SIZE:frame_store.HEADER_SIZE + header['length']]
+        return decode(payload, header['codec'], header['shape'], header['dtype'])
+
+    for codec in CODECS.values():
+        if codec.suffix == suffix:
+            return codec.decode(data, None, numpy.uint16)
+    raise ValueError("unknown frame file type %r" % path)
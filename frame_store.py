@@ -0,0 +1,230 @@
+# Append-only frame container.
+#
+# Frames are appended to large preallocated segment files instead of being
+# written as individual .npy/.png files, so saving a frame costs one
+# sequential append on the USB stick rather than several file creates.
+#
+# Layout of a store directory:
+#   frames-00000.seg, frames-00001.seg, ...   segment files
+#   frames.idx                                 offset index, one record per frame
+#
+# Every record in a segment is a fixed 64-byte header followed by the
+# payload, padded to a multiple of 64 bytes so raw frames can be memory
+# mapped in place. The index holds (counter, timestamp, offset, length,
+# segment, kind) for each record and is the authoritative list of frames;
+# if the index is lost or damaged, scan_index() rebuilds it from the record
+# headers and recover_index() writes it back:
+#
+#   frame_store.recover_index('results_231020-142501')
+#
+
+import os
+import glob
+import struct
+import threading
+
+import numpy
+
+MAGIC = b'FRM1'
+VERSION = 1
+
+# record kinds
+KIND_INFRARED = 0
+KIND_VISIBLE = 1
+KIND_NOISE = 2    # float32 per-pixel std of an averaged burst
+
+# payload encodings
+CODEC_RAW = 0
+CODEC_PNG = 1
+
+ALIGNMENT = 64
+SEGMENT_BYTES = 256 * 1024 * 1024
+
+# magic, version, kind, codec, counter, timestamp, height, width, channels, dtype, payload length
+HEADER = struct.Struct('<4sBBHqdIIH4sI')
+HEADER_SIZE = ALIGNMENT
+
+INDEX_DTYPE = numpy.dtype([
+    ('counter', '<i8'),
+    ('timestamp', '<f8'),
+    ('offset', '<u8'),
+    ('length', '<u4'),
+    ('segment', '<u2'),
+    ('kind', 'u1'),
+    ('codec', 'u1'),
+])
+
+def segment_path(directory, segment, name='frames'):
+    return os.path.join(directory, '%s-%05d.seg' % (name, segment))
+
+def index_path(directory, name='frames'):
+    return os.path.join(directory, '%s.idx' % name)
+
+def read_index(directory, name='frames'):
+    """Read the offset index of a store as a structured array (INDEX_DTYPE)."""
+    path = index_path(directory, name)
+    if not os.path.exists(path):
+        return numpy.zeros(0, dtype=INDEX_DTYPE)
+
+    # drop a trailing partial record left by an interrupted write
+    count = os.path.getsize(path) // INDEX_DTYPE.itemsize
+    return numpy.fromfile(path, dtype=INDEX_DTYPE, count=count)
+
+def scan_index(directory, name='frames'):
+    """Rebuild the index of a store from the record headers in its segments.
+
+    Records follow each other from the start of a segment, and the
+    preallocated rest of it is zeros, so a segment is read up to the first
+    position without a record header.
+    """
+    entries = []
+    for path in sorted(glob.glob(os.path.join(directory, '%s-[0-9]*.seg' % name))):
+        segment = int(os.path.basename(path)[len(name) + 1:-len('.seg')])
+        size = os.path.getsize(path)
+        position = 0
+        with open(path, 'rb') as f:
+            while position + HEADER_SIZE <= size:
+                f.seek(position)
+                try:
+                    header = unpack_header(f.read(HEADER_SIZE))
+                except (ValueError, struct.error):
+                    break
+                if position + HEADER_SIZE + header['length'] > size:
+                    break
+                entries.append((header['counter'], header['timestamp'], position + HEADER_SIZE,
+                                header['length'], segment, header['kind'], header['codec']))
+                position += HEADER_SIZE + padded(header['length'])
+    return numpy.array(entries, dtype=INDEX_DTYPE)
+
+def recover_index(directory, name='frames'):
+    """Replace the index of a store by scan_index(); the old one is kept as .idx.bak. Returns the record count."""
+    index = scan_index(directory, name)
+    path = index_path(directory, name)
+    if os.path.exists(path):
+        os.replace(path, path + '.bak')
+    index.tofile(path)
+    return len(index)
+
+def pack_header(kind, codec, counter, timestamp, shape, dtype, length):
+    height = shape[0] if len(shape) > 0 else 0
+    width = shape[1] if len(shape) > 1 else 0
+    channels = shape[2] if len(shape) > 2 else 1
+    header = HEADER.pack(MAGIC, VERSION, kind, codec, counter, timestamp,
+                         height, width, channels, numpy.dtype(dtype).str.encode('ascii'), length)
+    return header.ljust(HEADER_SIZE, b'\x00')
+
+def unpack_header(buf):
+    """Parse a record header into a dict; raises ValueError on a bad magic."""
+    (magic, version, kind, codec, counter, timestamp,
+     height, width, channels, dtype, length) = HEADER.unpack_from(buf)
+    if magic != MAGIC:
+        raise ValueError("not a frame record (magic %r)" % magic)
+
+    shape = (height, width) if channels == 1 else (height, width, channels)
+    return {
+        'version': version,
+        'kind': kind,
+        'codec': codec,
+        'counter': counter,
+        'timestamp': timestamp,
+        'shape': shape,
+        'dtype': numpy.dtype(dtype.rstrip(b'\x00').decode('ascii')),
+        'length': length,
+    }
+
+def padded(length):
+    return (length + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+class FrameStore:
+    """Appends frames to preallocated segment files; safe to share between save worker threads."""
+
+    def __init__(self, directory, name='frames', segment_bytes=SEGMENT_BYTES):
+        self.directory = directory
+        self.name = name
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+
+        # continue after the last indexed record when reopening a store
+        index = read_index(directory, name)
+        if len(index):
+            last = index[-1]
+            self.segment = int(last['segment'])
+            self.position = int(last['offset']) + padded(int(last['length']))
+        else:
+            self.segment = 0
+            self.position = 0
+
+        self.index_file = open(index_path(directory, name), 'ab')
+        self.segment_file = None
+        self.open_segment(self.segment)
+
+    def open_segment(self, segment):
+        if self.segment_file is not None:
+            self.segment_file.close()
+
+        path = segment_path(self.directory, segment, self.name)
+        exists = os.path.exists(path)
+        self.segment_file = open(path, 'r+b' if exists else 'w+b')
+
+        if not exists:
+            # reserve the whole segment up front so appends never grow the file
+            try:
+                os.posix_fallocate(self.segment_file.fileno(), 0, self.segment_bytes)
+            except (AttributeError, OSError):
+                self.segment_file.truncate(self.segment_bytes)
+
+        self.segment = segment
+
+    def append(self, kind, counter, timestamp, payload, shape=(), dtype='u1', codec=CODEC_RAW):
+        """Append one record; payload is an ndarray or bytes. Returns (segment, offset)."""
+        if isinstance(payload, numpy.ndarray):
+            shape = payload.shape
+            dtype = payload.dtype
+            payload = numpy.ascontiguousarray(payload)
+
+        data = memoryview(payload).cast('B')
+        length = data.nbytes
+        size = HEADER_SIZE + padded(length)
+        if size > self.segment_bytes:
+            raise ValueError("record of %d bytes does not fit in a %d byte segment" % (size, self.segment_bytes))
+
+        header = pack_header(kind, codec, counter, timestamp, shape, dtype, length)
+
+        with self.lock:
+            if self.position + size > self.segment_bytes:
+                self.open_segment(self.segment + 1)
+                self.position = 0
+
+            offset = self.position + HEADER_SIZE
+            self.segment_file.seek(self.position)
+            self.segment_file.write(header)
+            self.segment_file.write(data)
+            self.segment_file.write(b'\x00' * (padded(length) - length))
+            self.segment_file.flush()
+
+            entry = numpy.zeros(1, dtype=INDEX_DTYPE)
+            entry[0] = (counter, timestamp, offset, length, self.segment, kind, codec)
+            self.index_file.write(entry.tobytes())
+            self.index_file.flush()
+
+            self.position += size
+            return self.segment, offset
+
+    def append_frame(self, counter, timestamp, data_infrared):
+        return self.append(KIND_INFRARED, counter, timestamp, data_infrared)
+
+    def append_encoded(self, kind, counter, timestamp, encoded, shape, codec):
+        """Append an already encoded image, e.g. PNG bytes from cv2.imencode."""
+        return self.append(kind, counter, timestamp, memoryview(encoded), shape=shape, dtype='u1', codec=codec)
+
+    def sync(self):
+        with self.lock:
+            os.fsync(self.segment_file.fileno())
+            os.fsync(self.index_file.fileno())
+
+    def close(self):
+        with self.lock:
+            self.segment_file.close()
+            self.index_file.close()
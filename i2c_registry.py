@@ -0,0 +1,112 @@
+# Registry of the Atlas EZO devices found on the I2C bus.
+#
+# A full discovery probes all 128 addresses and then asks every responder
+# for its module type ("I") and name ("name,?"), which takes seconds. The
+# devices found are kept in a small JSON file, so the next start (e.g.
+# after a brown-out reboot in the field) only checks that each known
+# address still answers with the same module type, and falls back to the
+# full scan when one does not.
+#
+#   devices = find_devices(AtlasI2C, '~/pftc7_i2c_devices.json')
+#
+
+import os
+import json
+import time
+
+from AtlasI2C import query_all
+
+# Logging and print statements
+import logging
+runlog = logging.getLogger()
+
+def load_registry(path):
+    """Known devices as a list of {'address', 'moduletype', 'name'} dicts; empty if there is no registry."""
+    try:
+        with open(path) as f:
+            return json.load(f)['devices']
+    except (OSError, ValueError, KeyError):
+        return []
+
+def save_registry(path, devices):
+    entries = [{'address': d.address, 'moduletype': d.moduletype, 'name': clean_name(d.name)} for d in devices]
+    tmp = path + '.tmp'
+    try:
+        with open(tmp, 'w') as f:
+            json.dump({'saved': time.time(), 'devices': entries}, f, indent=1)
+        os.replace(tmp, path)
+    except OSError as ex:
+        runlog.warning("Could not save I2C registry %s: %s" % (path, ex))
+
+def clean_name(name):
+    """A device name without the NUL padding of the EZO response."""
+    return name.replace("\x00", "").strip()
+
+def module_type(device, address):
+    """Module type reported by the EZO device at address, or None if it is not one."""
+    device.set_i2c_address(address)
+    try:
+        return device.query("I").split(",")[1]
+    except (IndexError, IOError):
+        return None
+
+def scan_devices(AtlasI2C):
+    """Probe the whole bus and identify every EZO device on it."""
+    device = AtlasI2C()
+    device_address_list = device.list_i2c_devices()
+    device_list = []
+
+    for i in device_address_list:
+        moduletype = module_type(device, i)
+        try:
+            if moduletype is None:
+                raise IndexError
+            response = clean_name(device.query("name,?").split(",")[1])
+        except IndexError:
+            runlog.warning(f""">> WARNING: device at I1C address {i} has not been identified as an EZO device, and will not be queried""")
+            continue
+        device_list.append(AtlasI2C(address = i, moduletype = moduletype, name = response))
+
+    device.close()
+    return device_list
+
+def validate_devices(AtlasI2C, entries):
+    """Devices for the registry entries, or None if any of them no longer answers as recorded.
+
+    All devices are asked for their module type at once (see query_all).
+    """
+    devices = [AtlasI2C(address=entry['address'], moduletype=entry['moduletype'], name=clean_name(entry['name']))
+               for entry in entries]
+    try:
+        responses = query_all(devices, "I")
+    except IOError as ex:
+        runlog.warning("Known I2C devices did not answer: %s" % ex)
+        responses = [''] * len(devices)
+
+    for device, response in zip(devices, responses):
+        fields = response.split(",")
+        if len(fields) < 2 or fields[1] != device.moduletype:
+            runlog.warning("I2C device %s at %d did not answer as before" % (device.moduletype, device.address))
+            for d in devices:
+                d.close()
+            return None
+    return devices
+
+def find_devices(AtlasI2C, path):
+    """EZO devices on the bus: the registry's if they all still answer, else a full scan (saved)."""
+    path = os.path.expanduser(path)
+    started = time.monotonic()
+
+    entries = load_registry(path)
+    if entries:
+        devices = validate_devices(AtlasI2C, entries)
+        if devices:
+            runlog.warning("Found %d I2C devices from the registry in %.2f s" %
+                           (len(devices), time.monotonic() - started))
+            return devices
+
+    devices = scan_devices(AtlasI2C)
+    if devices:
+        save_registry(path, devices)
+    runlog.warning("Found %d I2C devices by full scan in %.2f s" % (len(devices), time.monotonic() - started))
+    return devices
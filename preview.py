@@ -0,0 +1,91 @@
+# Colored PNG previews of infrared frames.
+#
+# The 1st, 2.5th and 99th percentiles used for the contrast stretch come
+# from a single bincount histogram of the uint16 frame instead of three
+# numpy.percentile partial sorts, and the stretch plus colormap is one
+# precomputed uint16 -> BGR table, applied to the frame with a single
+# gather. Tables are cached by stretch limits, which change little from
+# frame to frame.
+#
+# The stretch is the one the save workers have always used:
+#   (value - p1) / (p99 - p2.5) * 255, clipped to 0..255, then the colormap
+#
+
+import threading
+import collections
+
+import cv2
+import numpy
+
+PERCENTILES = (1.0, 2.5, 99.0)
+LUT_CACHE_SIZE = 8
+
+def colormap_table(colormap):
+    """The 256 BGR colors of an OpenCV colormap, given by name ('OCEAN') or code."""
+    if isinstance(colormap, str):
+        colormap = getattr(cv2, 'COLORMAP_' + colormap.upper())
+    ramp = numpy.arange(256, dtype=numpy.uint8).reshape(256, 1)
+    return cv2.applyColorMap(ramp, colormap).reshape(256, 3)
+
+def histogram_percentiles(frame, percentiles=PERCENTILES):
+    """Percentiles of a uint16 frame from one histogram pass.
+
+    Returns the sample at rank floor(q / 100 * (n - 1)), the lower of the two
+    values numpy.percentile would interpolate between.
+    """
+    counts = numpy.bincount(frame.ravel(), minlength=65536)
+    cumulative = numpy.cumsum(counts)
+    n = cumulative[-1]
+    ranks = [int(q / 100.0 * (n - 1)) for q in percentiles]
+    return [int(v) for v in numpy.searchsorted(cumulative, ranks, side='right')]
+
+class PreviewRenderer:
+    """Renders uint16 infrared frames to BGR previews, optionally downscaled."""
+
+    def __init__(self, colormap='OCEAN', thumbnail_scale=None):
+        self.colormap = colormap
+        self.colors = colormap_table(colormap)
+        self.thumbnail_scale = thumbnail_scale
+        self.luts = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def stretch(self, frame):
+        """The uint16 -> BGR table for this frame's percentiles."""
+        return self.lut(*histogram_percentiles(frame))
+
+    def lut(self, p_low, p_mid, p_high):
+        key = (p_low, p_mid, p_high)
+        with self.lock:
+            lut = self.luts.get(key)
+            if lut is not None:
+                self.luts.move_to_end(key)
+                return lut
+
+        span = float(p_high - p_mid)
+        levels = numpy.arange(65536, dtype=numpy.float32)
+        levels -= p_low
+        if span != 0:
+            levels *= 255.0 / span
+        numpy.clip(levels, 0, 255, out=levels)
+        numpy.rint(levels, out=levels)
+        lut = self.colors[levels.astype(numpy.uint8)]
+
+        with self.lock:
+            self.luts[key] = lut
+            if len(self.luts) > LUT_CACHE_SIZE:
+                self.luts.popitem(last=False)
+        return lut
+
+    def render(self, frame, lut=None, out=None):
+        """BGR preview of a full frame; out, if given, is a (H, W, 3) uint8 array."""
+        if lut is None:
+            lut = self.stretch(frame)
+        return numpy.take(lut, frame, axis=0, out=out, mode='clip')
+
+    def render_thumbnail(self, frame, lut=None):
+        """Preview downscaled by thumbnail_scale, stretched with the full-frame percentiles."""
+        if lut is None:
+            lut = self.stretch(frame)
+        small = cv2.resize(frame, None, fx=1.0 / self.thumbnail_scale, fy=1.0 / self.thumbnail_scale,
+                           interpolation=cv2.INTER_AREA)
+        return numpy.take(lut, small, axis=0, mode='clip')
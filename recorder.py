@@ -0,0 +1,277 @@
+# Continuous recording at the camera's full frame rate.
+#
+# The scheduled capture keeps one frame every SECONDS_PER_IMAGE and the
+# stream runs NewestOnly, so every frame in between is thrown away. In
+# continuous mode the stream is switched to OldestFirst with a fixed pool
+# of camera buffers, and every frame (15 Hz, about 9.2 MB/s of Mono16) is
+# kept by two threads:
+#
+#   grab thread    GetNextImage, copy into a free slot of a preallocated
+#                  host ring, Release. Nothing else, so the camera buffer
+#                  pool is drained at the frame rate.
+#   writer thread  appends each filled slot to a frame_store segment store
+#                  (continuous-*.seg + continuous.idx) and fsyncs every
+#                  SYNC_FRAMES frames, so dirty pages are written back in
+#                  small steps rather than in one stall.
+#
+# If the writer falls behind by the whole ring, new frames are dropped
+# (and counted) instead of stalling the grab thread. Incomplete frames are
+# counted by image status and not stored. Gaps in the camera frame IDs and
+# the stream nodemap counters show frames lost before they reached the host.
+#
+# The store's counter is the camera frame ID and its timestamp the capture
+# time on the host clock (see device_clock.py). Read it back with
+#   RunReader(run_dir, store=recorder.STORE_NAME)
+#
+
+import json
+import time
+import threading
+import collections
+
+import numpy
+
+import devices
+import device_clock
+import frame_codecs
+import frame_store
+
+# Logging and print statements
+import logging
+runlog = logging.getLogger()
+
+STORE_NAME = 'continuous'
+
+# GetNextImage timeout; a timeout only counts, the thread keeps grabbing
+GRAB_TIMEOUT_MS = 1000
+
+# frames written between fsyncs (1 s at 15 Hz)
+SYNC_FRAMES = 15
+
+# number of recent write times kept for the percentiles
+WRITE_HISTORY = 256
+
+# stream nodemap counters reported, where the camera has them
+STREAM_COUNTERS = ('StreamTotalBufferCount', 'StreamFailedBufferCount', 'StreamDroppedFrameCount',
+                   'StreamLostFrameCount', 'StreamBufferUnderrunCount', 'StreamIncompleteFrameCount')
+
+def set_buffer_count(s_node_map, count):
+    """Use a fixed pool of count stream buffers instead of Spinnaker's automatic count."""
+    PySpin = devices.pyspin()
+    count_mode = PySpin.CEnumerationPtr(s_node_map.GetNode('StreamBufferCountMode'))
+    if not PySpin.IsAvailable(count_mode) or not PySpin.IsWritable(count_mode):
+        runlog.warning('Unable to set the stream buffer count mode')
+        return False
+    count_mode.SetIntValue(count_mode.GetEntryByName('Manual').GetValue())
+
+    buffer_count = PySpin.CIntegerPtr(s_node_map.GetNode('StreamBufferCountManual'))
+    if not PySpin.IsAvailable(buffer_count) or not PySpin.IsWritable(buffer_count):
+        runlog.warning('Unable to set the stream buffer count')
+        return False
+    buffer_count.SetValue(count)
+    runlog.warning('Stream buffer count set to %d' % count)
+    return True
+
+def stream_counters(s_node_map):
+    """The STREAM_COUNTERS the stream nodemap has, by name."""
+    PySpin = devices.pyspin()
+    counters = {}
+    for name in STREAM_COUNTERS:
+        node = PySpin.CIntegerPtr(s_node_map.GetNode(name))
+        if PySpin.IsAvailable(node) and PySpin.IsReadable(node):
+            counters[name] = int(node.GetValue())
+    return counters
+
+class RecordedImage:
+    """A copy of a recorded frame, with the parts of the PySpin image interface capture uses."""
+
+    def __init__(self, data, frame_id, device_ns, timestamp, received):
+        self.data = data
+        self.frame_id = frame_id
+        self.device_ns = device_ns
+        self.timestamp = timestamp
+        self.received = received
+
+    def IsIncomplete(self):
+        return False
+
+    def GetImageStatus(self):
+        return 0
+
+    def GetNDArray(self):
+        return self.data
+
+    def GetFrameID(self):
+        return self.frame_id
+
+    def GetTimeStamp(self):
+        return self.device_ns
+
+    def Release(self):
+        pass
+
+class Recorder:
+    """Records every frame of a streaming camera into a segment store."""
+
+    def __init__(self, camera, directory, ring_frames, codec='raw'):
+        self.PySpin = devices.pyspin()
+        self.camera = camera
+        self.ring_frames = ring_frames
+        self.codec = frame_codecs.get(codec)
+        self.store = frame_store.FrameStore(directory, name=STORE_NAME)
+        self.clock = device_clock.DeviceClock()
+
+        self.ring = None
+        self.meta = [None] * ring_frames
+        self.free = collections.deque(range(ring_frames))
+        self.pending = collections.deque()
+        self.written = set()
+        self.newest = None
+        self.cond = threading.Condition()
+
+        self.counts = collections.Counter()
+        self.statuses = collections.Counter()
+        self.write_times = collections.deque(maxlen=WRITE_HISTORY)
+        self.last_frame_id = None
+        self.latest_id = None
+        self.started = None
+
+        self.stopped = threading.Event()
+        self.grabber = threading.Thread(target=self.grab, name='recorder-grab', daemon=True)
+        self.writer = threading.Thread(target=self.write, name='recorder-write', daemon=True)
+
+    def start(self):
+        self.started = time.monotonic()
+        self.writer.start()
+        self.grabber.start()
+
+    def grab(self):
+        while not self.stopped.is_set():
+            try:
+                image = self.camera.GetNextImage(GRAB_TIMEOUT_MS)
+            except self.PySpin.SpinnakerException:
+                self.counts['timeouts'] += 1
+                continue
+            received = time.time()
+
+            try:
+                if image.IsIncomplete():
+                    self.counts['incomplete'] += 1
+                    self.statuses[image.GetImageStatus()] += 1
+                    continue
+
+                frame_id = image.GetFrameID()
+                if self.last_frame_id is not None and frame_id > self.last_frame_id + 1:
+                    self.counts['missed'] += frame_id - self.last_frame_id - 1
+                self.last_frame_id = frame_id
+
+                with self.cond:
+                    slot = self.free.popleft() if self.free else None
+                if slot is None:
+                    self.counts['dropped'] += 1
+                    continue
+
+                data = image.GetNDArray()
+                if self.ring is None:
+                    self.ring = numpy.empty((self.ring_frames,) + data.shape, dtype=data.dtype)
+                numpy.copyto(self.ring[slot], data)
+                device_ns = image.GetTimeStamp()
+            finally:
+                image.Release()
+
+            self.publish(slot, (frame_id, device_ns, self.clock.host_time(device_ns, received), received))
+
+    def publish(self, slot, meta):
+        with self.cond:
+            self.meta[slot] = meta
+            previous, self.newest = self.newest, slot
+            # the newest slot stays readable by latest_image() until it is replaced
+            if previous in self.written:
+                self.written.discard(previous)
+                self.free.append(previous)
+            self.pending.append(slot)
+            self.counts['grabbed'] += 1
+            self.cond.notify_all()
+
+    def write(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending or self.stopped.is_set())
+                if not self.pending:
+                    return
+                slot = self.pending.popleft()
+                backlog = len(self.pending)
+
+            frame_id, device_ns, timestamp, received = self.meta[slot]
+            t = time.perf_counter()
+            try:
+                if self.codec.name == 'raw':
+                    self.store.append_frame(frame_id, timestamp, self.ring[slot])
+                else:
+                    payload = memoryview(self.codec.encode(self.ring[slot])).cast('B')
+                    self.store.append(frame_store.KIND_INFRARED, frame_id, timestamp, payload,
+                                      shape=self.ring[slot].shape, dtype=self.ring.dtype,
+                                      codec=self.codec.codec_id)
+                self.counts['written'] += 1
+                if self.counts['written'] % SYNC_FRAMES == 0:
+                    self.store.sync()
+            except Exception as ex:
+                self.counts['write_errors'] += 1
+                runlog.warning("Error recording frame %d: %s" % (frame_id, ex))
+            self.write_times.append(time.perf_counter() - t)
+
+            with self.cond:
+                self.counts['max_backlog'] = max(self.counts['max_backlog'], backlog)
+                if slot == self.newest:
+                    self.written.add(slot)
+                else:
+                    self.free.append(slot)
+
+    def latest_image(self, timeout=GRAB_TIMEOUT_MS / 1000.0):
+        """A copy of the newest frame not returned before, or the newest one after timeout."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.newest is not None and self.meta[self.newest][0] != self.latest_id,
+                               timeout)
+            if self.newest is None:
+                raise IOError("no frame recorded after %.1f s" % timeout)
+            frame_id, device_ns, timestamp, received = self.meta[self.newest]
+            data = self.ring[self.newest].copy()
+            self.latest_id = frame_id
+        return RecordedImage(data, frame_id, device_ns, timestamp, received)
+
+    def stop(self):
+        """Stop grabbing, then wait for every grabbed frame to be written."""
+        self.stopped.set()
+        if self.grabber.is_alive():
+            self.grabber.join()
+        with self.cond:
+            self.cond.notify_all()
+        if self.writer.is_alive():
+            self.writer.join()
+        self.store.sync()
+        self.store.close()
+
+    def metrics(self):
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+        write_times = numpy.array(self.write_times) if self.write_times else numpy.array([numpy.nan])
+        metrics = {name: self.counts[name] for name in
+                   ('grabbed', 'written', 'incomplete', 'missed', 'dropped', 'timeouts', 'write_errors',
+                    'max_backlog')}
+        metrics['fps'] = self.counts['grabbed'] / elapsed if elapsed > 0 else 0.0
+        metrics['write_p50_s'] = float(numpy.percentile(write_times, 50))
+        metrics['write_max_s'] = float(numpy.max(write_times))
+        metrics['image_status'] = {str(status): n for status, n in self.statuses.items()}
+        metrics['stream'] = stream_counters(self.camera.GetTLStreamNodeMap())
+        return metrics
+
+    def log_metrics(self):
+        m = self.metrics()
+        runlog.warning("**** Recording: %.2f frames/s, %d grabbed, %d written (p50 %.3f s, max %.3f s), "
+                       "%d incomplete %s, %d missed, %d dropped, backlog max %d of %d, stream %s" %
+                       (m['fps'], m['grabbed'], m['written'], m['write_p50_s'], m['write_max_s'],
+                        m['incomplete'], m['image_status'], m['missed'], m['dropped'], m['max_backlog'],
+                        self.ring_frames, m['stream']))
+
+    def write_report(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.metrics(), f, indent=1)
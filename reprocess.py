@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+# Offline reprocessing of a results_YYMMDD-HHMMSS campaign directory.
+#
+# Reads the infrared frames of a run through RunReader, so both storage
+# layouts work: out_<date>_<n>-infrared-data.* files (.npy, or any of the
+# encodings in frame_codecs.py) and segment stores (frames-*.seg, or the
+# continuous-*.seg recording with --store continuous). Pairs every frame
+# with its stats row (by counter; frames of another store, which are
+# numbered by camera frame ID, take the latest row at or before them),
+# converts it to temperature using the camera parameters in effect for that
+# frame, and writes one consolidated dataset plus a per-frame summary table.
+# Replaces the MATLAB conversion step described in manuals/.
+#
+# usage: python reprocess.py results_231020-142501 [-o OUTPUT_DIR] [-j WORKERS] [--store STORE]
+#
+# Output (in OUTPUT_DIR, the results directory by default):
+#   temperature.npy   float32 (N, 480, 640), in frame counter order
+#   frames.csv        counter, date, source file and temperature summary per frame,
+#                     plus the mean ambient and black plate thermocouple
+#                     temperature over +-1 s around the frame when the run
+#                     has a TC-08 stream log (tc08-stream.bin)
+#
+
+import os
+import re
+import csv
+import glob
+import time
+import datetime
+import argparse
+import multiprocessing
+
+# Logging and print statements
+import logging
+runlog = logging.getLogger()
+
+import numpy
+
+from RadiometricData import RadiometricData
+import stats_store
+import camera_params
+import tc08_log
+import frame_store
+from run_reader import RunReader
+
+DATASET_NAME = 'temperature.npy'
+SUMMARY_NAME = 'frames.csv'
+SUMMARY_FIELDS = ['index', 'counter', 'Date', 'file', 'mean', 'std', 'min', 'max']
+WINDOW_FIELDS = ['tc_amb_c_window', 'tc_black_c_window']
+
+# Half width of the thermocouple averaging window around each frame, in seconds
+TC08_WINDOW = 1.0
+
+STATS_PATTERN = re.compile(r'out_(\d{6}-\d{6})_(\d+)-stats\.csv$')
+
+# Frames handed to a worker at a time
+CHUNK_SIZE = 32
+
+# runs opened by this (worker) process
+readers = {}
+
+def reader(results_dir, store):
+    key = (results_dir, store)
+    if key not in readers:
+        readers[key] = RunReader(results_dir, store)
+    return readers[key]
+
+def read_stats(path):
+    """Read a -stats.csv file (header row, value row) into a dict."""
+    with open(path, newline='') as f:
+        rows = list(csv.reader(f))
+    if len(rows) < 2:
+        return {}
+    return dict(zip(rows[0], rows[1]))
+
+def read_stats_rows(results_dir):
+    """Stats rows of a run by counter: from stats.db when there is one, else the -stats.csv files."""
+    db_path = os.path.join(results_dir, stats_store.DB_NAME)
+    if os.path.exists(db_path):
+        return stats_store.read_rows(db_path)
+
+    rows = {}
+    for path in glob.glob(os.path.join(results_dir, 'out_*-stats.csv')):
+        match = STATS_PATTERN.search(os.path.basename(path))
+        if match is not None:
+            rows[int(match.group(2))] = read_stats(path)
+    return rows
+
+def row_time(stats):
+    """Capture time of a stats row: ir_timestamp, or its Date."""
+    try:
+        return float(stats['ir_timestamp'])
+    except (KeyError, TypeError, ValueError):
+        return datetime.datetime.strptime(stats['Date'], '%y%m%d-%H%M%S').timestamp()
+
+def find_frames(results_dir, store='frames'):
+    """List the frames of a run in counter order, each paired with its stats row.
+
+    Frames of the 'frames' store are paired by counter. Other stores (the
+    continuous recording) are numbered by camera frame ID, so each of their
+    frames takes the latest stats row at or before it (or the first row). Rows that refer to a
+    calibration version get the camera values of that version from
+    calibration.jsonl.
+    """
+    run = RunReader(results_dir, store)
+    rows = read_stats_rows(results_dir)
+    calibrations = camera_params.read_calibrations(results_dir)
+
+    if store != 'frames':
+        by_time = sorted((row_time(stats), counter) for counter, stats in rows.items())
+        row_times = numpy.array([t for t, counter in by_time])
+
+    frames = []
+    for position in range(len(run)):
+        counter = int(run.counters[position])
+        timestamp = float(run.timestamps[position])
+        if run.layout == 'files':
+            source = str(run.index['name'][position])
+        else:
+            source = os.path.basename(frame_store.segment_path(results_dir, int(run.index['segment'][position]),
+                                                               store))
+
+        if store == 'frames':
+            stats = rows.get(counter)
+            if stats is not None:
+                # the stats have the capture time to the millisecond, the file name to the second
+                timestamp = row_time(stats)
+        else:
+            # frames recorded before the first row take that row
+            i = max(0, numpy.searchsorted(row_times, timestamp, side='right') - 1)
+            stats = rows[by_time[i][1]] if by_time else None
+        if stats is None:
+            runlog.warning("No stats for frame %d of %s, skipping" % (counter, source))
+            continue
+
+        frames.append({
+            'position': position,
+            'counter': counter,
+            'Date': datetime.datetime.fromtimestamp(timestamp).strftime('%y%m%d-%H%M%S'),
+            'timestamp': timestamp,
+            'file': source,
+            'stats': with_calibration(stats, calibrations),
+        })
+
+    run.close()
+    return frames
+
+def with_calibration(stats, calibrations):
+    """stats plus the values of its calib_version; values already in the row win."""
+    try:
+        calibration = calibrations[int(stats['calib_version'])]
+    except (KeyError, TypeError, ValueError):
+        return stats
+    merged = {name: value for name, value in stats.items() if value is not None}
+    for name, value in calibration.items():
+        merged.setdefault(name, value)
+    return merged
+
+def convert_chunk(args):
+    """Worker: convert a chunk of frames straight into the shared output dataset."""
+    dataset_path, results_dir, store, chunk, celsius = args
+    run = reader(results_dir, store)
+
+    dataset = numpy.load(dataset_path, mmap_mode='r+')
+    rd = RadiometricData()
+    summaries = []
+
+    for index, frame in chunk:
+        rd.setFromStats(frame['stats'])
+        counts = run.frame(frame['position'])
+        temp = rd.getTempLookup(counts, out=dataset[index], celsius=celsius)
+
+        summaries.append({
+            'index': index,
+            'counter': frame['counter'],
+            'Date': frame['Date'],
+            'file': frame['file'],
+            'mean': float(temp.mean(dtype=numpy.float64)),
+            'std': float(temp.std(dtype=numpy.float64)),
+            'min': float(temp.min()),
+            'max': float(temp.max()),
+        })
+
+    dataset.flush()
+    del dataset
+    return summaries
+
+def add_thermocouple_windows(results_dir, frames, summaries, half_width=TC08_WINDOW):
+    """Add WINDOW_FIELDS to the summaries from the run's TC-08 stream log; False if there is none."""
+    log_path = os.path.join(results_dir, tc08_log.LOG_NAME)
+    if not os.path.exists(log_path):
+        return False
+
+    log = tc08_log.read_stream_log(log_path)
+    log = log[numpy.argsort(log['timestamp'], kind='stable')]
+    means = tc08_log.window_means(log, [frames[row['index']]['timestamp'] for row in summaries], half_width)
+
+    amb = tc08_log.CHANNEL_NAMES.index('tc_amb_c')
+    black = tc08_log.CHANNEL_NAMES.index('tc_black_c')
+    for row, mean in zip(summaries, means):
+        row['tc_amb_c_window'] = float(mean[amb])
+        row['tc_black_c_window'] = float(mean[black])
+    return True
+
+def reprocess(results_dir, output_dir=None, workers=None, celsius=True, chunk_size=CHUNK_SIZE,
+              tc_window=TC08_WINDOW, store='frames'):
+    """Convert a whole run to temperature across a process pool.
+
+    Returns the list of per-frame summaries, which is also written to frames.csv.
+    """
+    output_dir = output_dir or results_dir
+    os.makedirs(output_dir, exist_ok=True)
+
+    time_start = time.time()
+    frames = find_frames(results_dir, store)
+    if not frames:
+        runlog.warning("No frames found in %s" % results_dir)
+        return []
+
+    shape = tuple(reader(results_dir, store).shape)
+    dataset_path = os.path.join(output_dir, DATASET_NAME)
+    dataset = numpy.lib.format.open_memmap(dataset_path, mode='w+', dtype=numpy.float32,
+                                           shape=(len(frames),) + shape)
+    del dataset
+
+    indexed = list(enumerate(frames))
+    chunks = [(dataset_path, results_dir, store, indexed[i:i + chunk_size], celsius)
+              for i in range(0, len(indexed), chunk_size)]
+
+    runlog.warning("Reprocessing %d frames from %s" % (len(frames), results_dir))
+
+    summaries = []
+    with multiprocessing.Pool(workers or os.cpu_count()) as pool:
+        for result in pool.imap_unordered(convert_chunk, chunks):
+            summaries.extend(result)
+    summaries.sort(key=lambda row: row['index'])
+
+    fields = SUMMARY_FIELDS
+    if add_thermocouple_windows(results_dir, frames, summaries, tc_window):
+        fields = SUMMARY_FIELDS + WINDOW_FIELDS
+
+    with open(os.path.join(output_dir, SUMMARY_NAME), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(summaries)
+
+    elapsed = time.time() - time_start
+    runlog.warning("Reprocessed %d frames in %.1f s (%.1f frames/s)" %
+                   (len(frames), elapsed, len(frames) / elapsed))
+
+    return summaries
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a results_* directory to temperature.')
+    parser.add_argument('results_dir')
+    parser.add_argument('-o', '--output-dir', default=None)
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='worker processes (default: all cores)')
+    parser.add_argument('--store', default='frames',
+                        help='segment store to read, e.g. continuous (default: frames)')
+    parser.add_argument('--kelvin', action='store_true', help='write Kelvin instead of Celsius')
+    parser.add_argument('--tc-window', type=float, default=TC08_WINDOW,
+                        help='half width in seconds of the thermocouple window around each frame')
+    args = parser.parse_args()
+
+    reprocess(args.results_dir, args.output_dir, args.workers, celsius=not args.kelvin,
+              tc_window=args.tc_window, store=args.store)
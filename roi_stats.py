@@ -0,0 +1,163 @@
+# Per-frame temperature statistics over regions of interest.
+#
+# ROIs (plots, the black reference plate, soil patches, ...) are read from
+# a JSON file and rasterized once into label images: pixel value k marks
+# the k-th ROI of that image, 0 is outside. ROIs that overlap go into
+# separate label images. For each frame, one bincount over
+# label * span + (count - lowest count) gives a histogram of raw counts per
+# ROI; count, mean, std, min, max and percentiles then come from those
+# histograms and the count -> temperature table of RadiometricData, so no
+# temperature frame is ever built. The first label image also covers the
+# pixels outside every ROI, so the whole-frame statistics (ROI 'frame')
+# come from the same pass.
+#
+# ROI file:
+#   {"rois": [
+#     {"name": "black_plate", "rect": [x, y, width, height]},
+#     {"name": "plot1", "polygon": [[x, y], [x, y], [x, y], ...]},
+#     {"name": "soil", "mask": "soil_mask.png"}      # nonzero pixels, path relative to the file
+#   ]}
+#
+# Each ROI adds roi_<name>_n, roi_<name>_mean_c, _std_c, _min_c, _max_c
+# and _p05_c, _p50_c, _p95_c (degrees C) to the stats record.
+#
+#   rois = RoiStats.from_file('~/pftc7_rois.json')
+#   stats.update(rois.stats(frame, rd.getTempLUT(celsius=True)))
+#
+
+import os
+import json
+
+import numpy
+
+# Logging and print statements
+import logging
+runlog = logging.getLogger()
+
+PERCENTILES = (5, 50, 95)
+
+FRAME_ROI = 'frame'
+
+def rasterize(roi, shape, base_dir='.'):
+    """Boolean mask of one ROI definition."""
+    mask = numpy.zeros(shape, dtype=numpy.uint8)
+    if 'rect' in roi:
+        x, y, width, height = roi['rect']
+        mask[y:y + height, x:x + width] = 1
+    elif 'polygon' in roi:
+        import cv2
+        cv2.fillPoly(mask, [numpy.round(roi['polygon']).astype(numpy.int32)], 1)
+    elif 'mask' in roi:
+        import cv2
+        image = cv2.imread(os.path.join(base_dir, roi['mask']), cv2.IMREAD_GRAYSCALE)
+        if image is None or image.shape != shape:
+            raise ValueError("ROI mask %s is not a %dx%d image" % (roi['mask'], shape[1], shape[0]))
+        mask[image > 0] = 1
+    else:
+        raise ValueError("ROI %r has no rect, polygon or mask" % roi.get('name'))
+    return mask.astype(bool)
+
+class LabelImage:
+    """Non-overlapping ROIs of one label image; names[k - 1] is label k."""
+
+    def __init__(self, shape):
+        self.labels = numpy.zeros(shape, dtype=numpy.int64)
+        self.names = []
+
+    def fits(self, mask):
+        return not self.labels[mask].any()
+
+    def add(self, name, mask):
+        self.names.append(name)
+        self.labels[mask] = len(self.names)
+
+class RoiStats:
+    def __init__(self, rois=(), base_dir='.'):
+        self.rois = list(rois)
+        self.base_dir = base_dir
+        names = [roi['name'] for roi in self.rois]
+        if len(set(names)) != len(names) or FRAME_ROI in names:
+            raise ValueError("ROI names must be unique and not %r" % FRAME_ROI)
+        self.shape = None
+        self.layers = []
+
+    @classmethod
+    def from_file(cls, path):
+        """ROIs from a JSON file; with no file, only the whole frame."""
+        path = os.path.expanduser(path)
+        if not os.path.exists(path):
+            runlog.warning("No ROI file %s, only whole-frame statistics" % path)
+            return cls()
+        with open(path) as f:
+            return cls(json.load(f)['rois'], os.path.dirname(path))
+
+    def rasterize(self, shape):
+        self.shape = shape
+        self.layers = [LabelImage(shape)]
+        for roi in self.rois:
+            mask = rasterize(roi, shape, self.base_dir)
+            if not mask.any():
+                runlog.warning("ROI %s is outside the %dx%d frame" % (roi['name'], shape[1], shape[0]))
+            layer = next((l for l in self.layers if l.fits(mask)), None)
+            if layer is None:
+                layer = LabelImage(shape)
+                self.layers.append(layer)
+            layer.add(roi['name'], mask)
+        runlog.warning("Rasterized %d ROIs into %d label images" % (len(self.rois), len(self.layers)))
+
+    def stats(self, frame, lut):
+        """Statistics of every ROI of a uint16 frame, in the units of lut (counts -> temperature)."""
+        frame = numpy.asarray(frame)
+        if frame.dtype != numpy.uint16:
+            raise ValueError("ROI statistics need uint16 counts, got %s" % frame.dtype)
+        if frame.shape != self.shape:
+            self.rasterize(frame.shape)
+
+        lowest = int(frame.min())
+        span = int(frame.max()) - lowest + 1
+        temps = numpy.asarray(lut[lowest:lowest + span], dtype=numpy.float64)
+        offsets = frame.astype(numpy.int64) - lowest
+
+        stats = {}
+        for i, layer in enumerate(self.layers):
+            bins = (len(layer.names) + 1) * span
+            hist = numpy.bincount((layer.labels * span + offsets).ravel(), minlength=bins).reshape(-1, span)
+            names = layer.names
+            if i == 0:
+                # label 0 of the first image plus its ROIs is the whole frame
+                hist = numpy.vstack([hist.sum(axis=0), hist[1:]])
+                names = [FRAME_ROI] + names
+            else:
+                hist = hist[1:]
+            stats.update(histogram_stats(names, hist, temps))
+        return stats
+
+def histogram_stats(names, hist, temps):
+    """Stats keys for ROIs with histograms hist (one row per ROI) over the values temps."""
+    n = hist.sum(axis=1)
+    present = hist > 0
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = hist @ temps / n
+        std = numpy.sqrt((hist * (temps[None, :] - mean[:, None]) ** 2).sum(axis=1) / n)
+    lowest = numpy.where(present, temps[None, :], numpy.inf).min(axis=1)
+    highest = numpy.where(present, temps[None, :], -numpy.inf).max(axis=1)
+    cumulative = numpy.cumsum(hist, axis=1)
+
+    stats = {}
+    for k, name in enumerate(names):
+        prefix = 'roi_%s_' % name
+        stats[prefix + 'n'] = int(n[k])
+        if n[k] == 0:
+            for key in ['mean_c', 'std_c', 'min_c', 'max_c'] + ['p%02d_c' % q for q in PERCENTILES]:
+                stats[prefix + key] = None
+            continue
+        stats[prefix + 'mean_c'] = round(float(mean[k]), 3)
+        stats[prefix + 'std_c'] = round(float(std[k]), 3)
+        stats[prefix + 'min_c'] = round(float(lowest[k]), 3)
+        stats[prefix + 'max_c'] = round(float(highest[k]), 3)
+        # the sample at rank floor(q / 100 * (n - 1)), as preview.histogram_percentiles;
+        # counts map to temperature monotonically, so ranks carry over
+        ranks = [int(q / 100.0 * (n[k] - 1)) for q in PERCENTILES]
+        for q, b in zip(PERCENTILES, numpy.searchsorted(cumulative[k], ranks, side='right')):
+            stats[prefix + 'p%02d_c' % q] = round(float(temps[b]), 3)
+    return stats
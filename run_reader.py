@@ -0,0 +1,261 @@
+# Random access to a recorded run without reading it into memory.
+#
+# Works on both storage layouts written by save_queue:
+#   'segments'  frames-*.seg + frames.idx (see frame_store.py)
+#               (or another store in the run, e.g. continuous-*.seg from recorder.py)
+#   'files'     one out_<date>_<n>-infrared-data.npy (or .frm/.png/.tiff) per frame
+#
+# For the 'files' layout the frame number -> timestamp -> byte offset index
+# is built once by reading the .npy headers and cached next to the data in
+# frames-files.npz, so reopening a run does not read every file again; the
+# cache is rebuilt when the frame file names or their newest mtime change.
+#
+# Frames are returned as read-only views on memory-mapped files; nothing is
+# copied until the caller asks for it (e.g. numpy.array(view) or stack()).
+# Frames saved with a compressing codec (see frame_codecs.py) are decoded
+# into a new array instead.
+#
+#   run = RunReader('results_231020-142501')
+#   noon = run.between(datetime.time(11), datetime.time(13))
+#   frames = run.frames(noon)              # list of zero-copy views
+#   hourly = run.frames(slice(None, None, 12))
+#
+
+import os
+import glob
+import datetime
+import collections
+
+import numpy
+
+import frame_store
+import frame_codecs
+
+FILES_INDEX_NAME = 'frames-files.npz'
+
+# memory maps kept open for the 'files' layout; each one holds a descriptor
+OPEN_FILES = 64
+
+def date_to_timestamp(date):
+    """Convert a file name date (YYMMDD-HHMMSS, local time) to a unix timestamp."""
+    return datetime.datetime.strptime(date, '%y%m%d-%H%M%S').timestamp()
+
+def frame_files(run_dir):
+    paths = glob.glob(os.path.join(run_dir, 'out_*-infrared-data.*'))
+    return [path for path in paths if frame_codecs.FRAME_PATTERN.search(os.path.basename(path))]
+
+def build_files_index(run_dir):
+    """Index the frame files of a run: counters, timestamps, names, data offsets, shape and dtype.
+
+    Encoded (non-.npy) frames get an offset of -1.
+    """
+    entries = []
+    shape = dtype = None
+
+    for path in frame_files(run_dir):
+        name = os.path.basename(path)
+        match = frame_codecs.FRAME_PATTERN.search(name)
+
+        if not name.endswith('.npy'):
+            if shape is None:
+                first = frame_codecs.load_frame(path)
+                shape, dtype = first.shape, first.dtype
+            entries.append((int(match.group(2)), date_to_timestamp(match.group(1)), name, -1))
+            continue
+
+        with open(path, 'rb') as f:
+            version = numpy.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran, dtype = numpy.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = numpy.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+
+        entries.append((int(match.group(2)), date_to_timestamp(match.group(1)), name, offset))
+
+    entries.sort()
+    return {
+        'counter': numpy.array([e[0] for e in entries], dtype=numpy.int64),
+        'timestamp': numpy.array([e[1] for e in entries], dtype=numpy.float64),
+        'name': numpy.array([e[2] for e in entries], dtype=str),
+        'offset': numpy.array([e[3] for e in entries], dtype=numpy.int64),
+        'shape': numpy.array(shape if shape is not None else (), dtype=numpy.int64),
+        'dtype': numpy.array(numpy.dtype(dtype).str if dtype is not None else '<u2'),
+    }
+
+def load_files_index(run_dir):
+    """Return the cached 'files' index, rebuilding it if the run has changed since."""
+    cache = os.path.join(run_dir, FILES_INDEX_NAME)
+    paths = frame_files(run_dir)
+    names = sorted(os.path.basename(path) for path in paths)
+    # a frame replaced in place (e.g. re-encoded) keeps the count but not the mtime
+    newest = max((os.path.getmtime(path) for path in paths), default=0.0)
+
+    if os.path.exists(cache):
+        with numpy.load(cache) as cached:
+            if ('newest_mtime' in cached.files and float(cached['newest_mtime']) == newest and
+                    sorted(str(name) for name in cached['name']) == names):
+                return {key: cached[key] for key in cached.files}
+
+    index = build_files_index(run_dir)
+    index['newest_mtime'] = numpy.array(newest)
+    try:
+        numpy.savez(cache, **index)
+    except OSError:
+        pass # read-only media: index is simply rebuilt next time
+    return index
+
+class RunReader:
+    """Memory-mapped, time-indexed access to the infrared frames of one run."""
+
+    def __init__(self, run_dir, store='frames'):
+        self.run_dir = run_dir
+        self.store = store
+        self.maps = collections.OrderedDict()
+
+        if os.path.exists(frame_store.index_path(run_dir, store)):
+            self.layout = 'segments'
+            index = frame_store.read_index(run_dir, store)
+            self.visible_index = index[index['kind'] == frame_store.KIND_VISIBLE]
+            index = index[index['kind'] == frame_store.KIND_INFRARED]
+
+            # save workers may append slightly out of order
+            index = index[numpy.argsort(index['counter'], kind='stable')]
+            self.index = index
+            self.counters = index['counter']
+            self.timestamps = index['timestamp']
+
+            if len(index):
+                self.shape, self.dtype = self.read_header(0)
+        else:
+            self.layout = 'files'
+            index = load_files_index(run_dir)
+            self.index = index
+            self.counters = index['counter']
+            self.timestamps = index['timestamp']
+            self.shape = tuple(int(n) for n in index['shape'])
+            self.dtype = numpy.dtype(str(index['dtype']))
+
+        # timestamps are usually increasing already; the order array keeps
+        # time lookups O(log n) even if the clock stepped during the run
+        self.time_order = numpy.argsort(self.timestamps, kind='stable')
+        self.sorted_timestamps = self.timestamps[self.time_order]
+
+    def __len__(self):
+        return len(self.counters)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self.frames(item)
+        return self.frame(item)
+
+    def read_header(self, position):
+        entry = self.index[position]
+        with open(frame_store.segment_path(self.run_dir, int(entry['segment']), self.store), 'rb') as f:
+            f.seek(int(entry['offset']) - frame_store.HEADER_SIZE)
+            header = frame_store.unpack_header(f.read(frame_store.HEADER_SIZE))
+        return header['shape'], header['dtype']
+
+    def mapping(self, key, path, **kwargs):
+        """Open (or reuse) a read-only memory map, keeping at most OPEN_FILES of them."""
+        mm = self.maps.get(key)
+        if mm is None:
+            mm = numpy.memmap(path, mode='r', **kwargs)
+            self.maps[key] = mm
+            if len(self.maps) > OPEN_FILES:
+                self.maps.popitem(last=False)
+        else:
+            self.maps.move_to_end(key)
+        return mm
+
+    def frame(self, position):
+        """Zero-copy view of the frame at a position in counter order (decoded if it was encoded)."""
+        if self.layout == 'segments':
+            entry = self.index[position]
+            segment = int(entry['segment'])
+            mm = self.mapping(segment, frame_store.segment_path(self.run_dir, segment, self.store), dtype=numpy.uint8)
+            if entry['codec'] != frame_store.CODEC_RAW:
+                payload = mm[int(entry['offset']):int(entry['offset']) + int(entry['length'])]
+                return frame_codecs.decode(payload, int(entry['codec']), self.shape, self.dtype)
+            return numpy.ndarray(self.shape, dtype=self.dtype, buffer=mm, offset=int(entry['offset']))
+
+        name = str(self.index['name'][position])
+        if self.index['offset'][position] < 0:
+            return frame_codecs.load_frame(os.path.join(self.run_dir, name))
+        return self.mapping(name, os.path.join(self.run_dir, name), dtype=self.dtype,
+                            offset=int(self.index['offset'][position]), shape=self.shape)
+
+    def positions(self, selection=slice(None)):
+        """Positions selected by a slice, an index array or a boolean mask."""
+        return numpy.arange(len(self))[selection]
+
+    def frames(self, selection=slice(None)):
+        """List of zero-copy views, e.g. frames(slice(None, None, 12)) for every 12th frame."""
+        return [self.frame(p) for p in self.positions(selection)]
+
+    def stack(self, selection=slice(None), out=None):
+        """Copy the selected frames into one (N, H, W) array (allocated if out is None)."""
+        positions = self.positions(selection)
+        if out is None:
+            out = numpy.empty((len(positions),) + self.shape, dtype=self.dtype)
+        for i, p in enumerate(positions):
+            out[i] = self.frame(p)
+        return out
+
+    def position_of(self, counter):
+        """Position of a frame counter, or None if that frame was not saved."""
+        position = numpy.searchsorted(self.counters, counter)
+        if position < len(self) and self.counters[position] == counter:
+            return int(position)
+        return None
+
+    def to_timestamp(self, when):
+        if isinstance(when, datetime.datetime):
+            return when.timestamp()
+        if isinstance(when, datetime.time):
+            # time of day on the date the run started
+            day = datetime.datetime.fromtimestamp(self.sorted_timestamps[0]).date()
+            return datetime.datetime.combine(day, when).timestamp()
+        return float(when)
+
+    def between(self, start, end):
+        """Positions (in counter order) of frames with start <= timestamp < end.
+
+        start and end are unix timestamps, datetimes, or times of day on the
+        first day of the run.
+        """
+        lo = numpy.searchsorted(self.sorted_timestamps, self.to_timestamp(start), side='left')
+        hi = numpy.searchsorted(self.sorted_timestamps, self.to_timestamp(end), side='left')
+        return numpy.sort(self.time_order[lo:hi])
+
+    def nearest(self, when):
+        """Position of the frame closest in time to when, or None if the run has no frames."""
+        if len(self) == 0:
+            return None
+        t = self.to_timestamp(when)
+        i = numpy.searchsorted(self.sorted_timestamps, t)
+        candidates = [c for c in (i - 1, i) if 0 <= c < len(self)]
+        best = min(candidates, key=lambda c: abs(self.sorted_timestamps[c] - t))
+        return int(self.time_order[best])
+
+    def visible(self, position):
+        """Decode the visible image saved with a frame, or None if there is none."""
+        import cv2
+
+        counter = self.counters[position]
+        if self.layout == 'files':
+            name = str(self.index['name'][position])
+            path = os.path.join(self.run_dir, name[:name.rindex(frame_codecs.FILE_INFIX)] + '-visible.png')
+            return cv2.imread(path) if os.path.exists(path) else None
+
+        matches = numpy.flatnonzero(self.visible_index['counter'] == counter)
+        if len(matches) == 0:
+            return None
+        entry = self.visible_index[matches[0]]
+        segment = int(entry['segment'])
+        mm = self.mapping(segment, frame_store.segment_path(self.run_dir, segment, self.store), dtype=numpy.uint8)
+        encoded = mm[int(entry['offset']):int(entry['offset']) + int(entry['length'])]
+        return cv2.imdecode(encoded, cv2.IMREAD_UNCHANGED)
+
+    def close(self):
+        self.maps.clear()
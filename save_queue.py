@@ -1,56 +1,560 @@
-import queue
 import time
+import atexit
+import threading
+import collections
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
 from threading import Thread
 import cv2
 import os
 import numpy
+import frame_store as frame_store_module
+import frame_codecs
+import preview as preview_module
+
+# Logging and print statements
+import logging
+runlog = logging.getLogger()
+
+# number of recent saves kept for the latency percentiles
+LATENCY_HISTORY = 1024
+
+OVERFLOW_POLICIES = ('block', 'drop_previews', 'drop_visible', 'spill')
+
+# suffix of the optional per-pixel noise map saved with a frame (see burst_average.py)
+NOISE_SUFFIX = '-infrared-std.npy'
+
+def item_bytes(item):
+    return sum(getattr(part, 'nbytes', 0) for part in item[:2] + item[5:6])
+
+def item_noise(item):
+    """The noise map of an item, or None; it is the optional sixth element."""
+    return item[5] if len(item) > 5 else None
+
+def copy_images(item):
+    """The item with its own copy of the images, so camera buffers can be released."""
+    data_infrared = numpy.array(item[0])
+    img_visible = numpy.array(item[1]) if item[1] is not None else None
+    return (data_infrared, img_visible) + tuple(item[2:])
+
+class SaveEntry:
+    """A queued item plus its bookkeeping."""
+
+    def __init__(self, item):
+        self.item = item
+        self.nbytes = item_bytes(item)
+        self.enqueued = time.monotonic()
+        self.preview = True
+
+class SaveQueue:
+    """Save queue bounded by the bytes it holds rather than by item count.
+
+    Bytes stay in flight from put() until the worker calls task_done(), so
+    frames being written still count against the budget. When an item does
+    not fit, the overflow policy decides what happens:
+
+      'block'          wait for the workers (what queue.Queue did)
+      'drop_previews'  skip the infrared PNG preview for everything queued,
+                       so the workers catch up faster, then wait
+      'drop_visible'   drop visible images, oldest first, until the item
+                       fits, then wait
+      'spill'          write the raw infrared frame straight to spill_dir
+                       and do not queue the item
+    """
+
+    def __init__(self, max_bytes, policy='block', spill_dir=None):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError("unknown overflow policy %r" % policy)
+        if policy == 'spill' and not spill_dir:
+            raise ValueError("the 'spill' policy needs a spill_dir")
+
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.spill_dir = spill_dir
+
+        self.cond = threading.Condition()
+        self.entries = collections.deque()
+        self.bytes_in_flight = 0
+        self.unfinished = 0
+
+        self.latencies = collections.deque(maxlen=LATENCY_HISTORY)
+        self.counts = collections.Counter()
+        self.blocked_seconds = 0.0
+
+    def fits(self, nbytes):
+        # an empty queue always takes the item, however large
+        return self.bytes_in_flight == 0 or self.bytes_in_flight + nbytes <= self.max_bytes
+
+    def put(self, item):
+        """Queue (data_infrared, img_visible, fileprefix, counter, timestamp[, noise_map]).
+
+        The images are copied before put() returns, so item[0] may be a view
+        on a camera buffer that is released straight afterwards. A noise map
+        is not copied, so it must not be modified after put().
+        """
+        entry = SaveEntry(copy_images(item))
+
+        with self.cond:
+            self.counts['enqueued'] += 1
+
+            if not self.fits(entry.nbytes):
+                if self.policy == 'drop_previews':
+                    self.drop_previews(entry)
+                elif self.policy == 'drop_visible':
+                    self.drop_visible(entry)
+
+            if not self.fits(entry.nbytes) and self.policy == 'spill':
+                self.counts['spilled'] += 1
+                spill = True
+            else:
+                spill = False
+                if not self.fits(entry.nbytes):
+                    self.counts['blocked'] += 1
+                    t = time.monotonic()
+                    while not self.fits(entry.nbytes):
+                        self.cond.wait()
+                    self.blocked_seconds += time.monotonic() - t
+
+                self.entries.append(entry)
+                self.bytes_in_flight += entry.nbytes
+                self.unfinished += 1
+                self.cond.notify_all()
+
+        if spill:
+            self.spill(entry.item)
+
+    def drop_previews(self, entry):
+        for queued in list(self.entries) + [entry]:
+            if queued.preview:
+                queued.preview = False
+                self.counts['dropped_previews'] += 1
+
+    def drop_visible(self, entry):
+        for queued in list(self.entries) + [entry]:
+            if self.fits(entry.nbytes):
+                break
+            visible = queued.item[1]
+            if visible is None:
+                continue
+            queued.item = (queued.item[0], None) + tuple(queued.item[2:])
+            if queued is not entry:
+                self.bytes_in_flight -= visible.nbytes
+            queued.nbytes -= visible.nbytes
+            self.counts['dropped_visible'] += 1
+
+    def spill(self, item):
+        path = os.path.join(self.spill_dir, os.path.basename(item[2]) + '-infrared-data.npy')
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            numpy.save(path, item[0])
+            if item_noise(item) is not None:
+                numpy.save(os.path.join(self.spill_dir, os.path.basename(item[2]) + NOISE_SUFFIX), item_noise(item))
+        except OSError as ex:
+            runlog.warning("Could not spill frame to %s: %s" % (path, ex))
+            with self.cond:
+                self.counts['lost'] += 1
+
+    def get(self):
+        """Block until an entry is available and return it."""
+        with self.cond:
+            while not self.entries:
+                self.cond.wait()
+            return self.entries.popleft()
+
+    def task_done(self, entry):
+        with self.cond:
+            self.bytes_in_flight -= entry.nbytes
+            self.unfinished -= 1
+            self.latencies.append(time.monotonic() - entry.enqueued)
+            self.counts['saved'] += 1
+            self.cond.notify_all()
+
+    def join(self):
+        with self.cond:
+            while self.unfinished:
+                self.cond.wait()
+
+    def qsize(self):
+        with self.cond:
+            return len(self.entries)
+
+    def metrics(self):
+        """Live queue metrics; latency is from put() until the item was written and, with sync_saves, fsynced."""
+        with self.cond:
+            latencies = numpy.array(self.latencies) if self.latencies else numpy.array([numpy.nan])
+            metrics = {
+                'depth': len(self.entries),
+                'in_progress': self.unfinished - len(self.entries),
+                'mb_in_flight': self.bytes_in_flight / 1e6,
+                'mb_budget': self.max_bytes / 1e6,
+                'latency_p50_s': float(numpy.percentile(latencies, 50)),
+                'latency_p95_s': float(numpy.percentile(latencies, 95)),
+                'latency_max_s': float(numpy.max(latencies)),
+                'blocked_s': self.blocked_seconds,
+            }
+            for name in ('enqueued', 'saved', 'blocked', 'dropped_previews', 'dropped_visible',
+                         'spilled', 'lost', 'errors'):
+                metrics[name] = self.counts[name]
+            return metrics
+
+    def log_metrics(self):
+        m = self.metrics()
+        runlog.warning("**** Save queue: %d queued, %d saving, %.1f/%.0f MB, latency p50 %.2f s p95 %.2f s, "
+                       "blocked %d (%.1f s), dropped %d previews %d visible, spilled %d, errors %d" %
+                       (m['depth'], m['in_progress'], m['mb_in_flight'], m['mb_budget'],
+                        m['latency_p50_s'], m['latency_p95_s'], m['blocked'], m['blocked_s'],
+                        m['dropped_previews'], m['dropped_visible'], m['spilled'], m['errors']))
+
+class RingSaveQueue(SaveQueue):
+    """Save queue feeding worker processes through a shared memory frame ring.
+
+    The ring is one multiprocessing.shared_memory block of fixed slots, each
+    holding an infrared frame and a visible frame. put() copies the images
+    into a free slot (the only copy the acquisition process makes) and sends
+    the slot number and file name to the workers, which save straight from
+    the shared memory and hand the slot back. The ring is sized from the
+    byte budget when the first frame arrives, since that fixes the slot
+    shapes. Until the visible stream delivers, frames come without a visible
+    image; the ring is then rebuilt with visible slots when the first one
+    arrives.
+
+    Overflow policies work on slots: 'drop_previews' and 'drop_visible' kick
+    in once the ring is three quarters full, 'spill' when it is full.
+    """
+
+    def __init__(self, max_bytes, policy='block', spill_dir=None, workers=4):
+        SaveQueue.__init__(self, max_bytes, policy, spill_dir)
+
+        # fork, so the workers do not re-run the acquisition script on import,
+        # after starting the resource tracker so the workers share it
+        context = multiprocessing.get_context('fork')
+        resource_tracker.ensure_running()
+        self.tasks = context.Queue()
+        self.done = context.Queue()
+        self.processes = [context.Process(target=ring_worker, args=(self.tasks, self.done), daemon=True)
+                          for i in range(workers)]
+        for process in self.processes:
+            process.start()
+
+        self.shm = None
+        self.vis_shape = None
+        self.free = collections.deque()
+        atexit.register(self.close)
+        self.collector = Thread(target=self.collect, daemon=True)
+        self.collector.start()
+
+    def create_ring(self, data_infrared, img_visible):
+        self.ir_shape = data_infrared.shape
+        self.ir_dtype = data_infrared.dtype
+        self.vis_shape = img_visible.shape if img_visible is not None else (0,)
+        ir_bytes = data_infrared.nbytes
+        vis_bytes = img_visible.nbytes if img_visible is not None else 0
+
+        self.slot_bytes = ir_bytes + vis_bytes
+        self.slots = max(2, int(self.max_bytes // self.slot_bytes))
+        self.shm = shared_memory.SharedMemory(create=True, size=self.slots * self.slot_bytes)
+
+        self.layout = (self.shm.name, self.slots, self.ir_shape, self.ir_dtype.str, self.vis_shape)
+        self.ir_slots, self.vis_slots = ring_views(self.shm, self.layout)
+        self.free.extend(range(self.slots))
+        runlog.warning("Save ring: %d slots of %.1f MB (visible %s)" %
+                       (self.slots, self.slot_bytes / 1e6, self.vis_shape))
+
+    def rebuild_ring(self, data_infrared, img_visible):
+        """Replace the ring once every slot is back; called with cond held."""
+        while self.unfinished:
+            self.cond.wait()
+        self.ir_slots = self.vis_slots = None
+        self.shm.close()
+        self.shm.unlink()
+        self.free.clear()
+        # the workers open the new block when they see its name in a task
+        self.create_ring(data_infrared, img_visible)
+
+    def put(self, item):
+        data_infrared, img_visible = item[0], item[1]
+
+        with self.cond:
+            self.counts['enqueued'] += 1
+            if self.shm is None:
+                self.create_ring(data_infrared, img_visible)
+            elif img_visible is not None and self.vis_shape == (0,):
+                # the first visible image: the ring so far has no room for it
+                self.rebuild_ring(data_infrared, img_visible)
+
+            preview = True
+            if len(self.free) <= self.slots // 4:
+                if self.policy == 'drop_previews':
+                    preview = False
+                    self.counts['dropped_previews'] += 1
+                elif self.policy == 'drop_visible' and img_visible is not None:
+                    img_visible = None
+                    self.counts['dropped_visible'] += 1
+
+            if not self.free and self.policy == 'spill':
+                self.counts['spilled'] += 1
+                slot = None
+            else:
+                if not self.free:
+                    self.counts['blocked'] += 1
+                    t = time.monotonic()
+                    while not self.free:
+                        self.cond.wait()
+                    self.blocked_seconds += time.monotonic() - t
+
+                slot = self.free.popleft()
+                self.bytes_in_flight += self.slot_bytes
+                self.unfinished += 1
+
+        if slot is None:
+            self.spill(item)
+            return
+
+        numpy.copyto(self.ir_slots[slot], data_infrared)
+        has_visible = img_visible is not None and img_visible.shape == self.vis_shape
+        if has_visible:
+            numpy.copyto(self.vis_slots[slot], img_visible)
+        elif img_visible is not None:
+            runlog.warning("Visible image of shape %s does not fit the save ring's %s slots, dropped" %
+                           (img_visible.shape, self.vis_shape))
+            with self.cond:
+                self.counts['dropped_visible'] += 1
+
+        # the rare noise map goes through the task queue rather than the ring
+        self.tasks.put((self.layout, slot, has_visible, item[2], item[3], item[4], preview, time.monotonic(),
+                        item_noise(item)))
+
+    def collect(self):
+        # slots come back from the workers once their frame is written
+        while True:
+            slot, latency, error = self.done.get()
+            with self.cond:
+                self.free.append(slot)
+                self.bytes_in_flight -= self.slot_bytes
+                self.unfinished -= 1
+                self.latencies.append(latency)
+                self.counts['errors' if error else 'saved'] += 1
+                self.cond.notify_all()
+
+    def qsize(self):
+        with self.cond:
+            return self.unfinished
+
+    def metrics(self):
+        metrics = SaveQueue.metrics(self)
+        # depth is frames waiting in or being saved from the ring
+        metrics['depth'] = metrics['depth'] + metrics['in_progress']
+        metrics['in_progress'] = 0
+        return metrics
+
+    def close(self):
+        for process in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(5)
+        if self.shm is not None:
+            self.ir_slots = self.vis_slots = None
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+def ring_views(shm, layout):
+    name, slots, ir_shape, ir_dtype, vis_shape = layout
+    ir_dtype = numpy.dtype(ir_dtype)
+    ir_bytes = int(numpy.prod(ir_shape)) * ir_dtype.itemsize
+    ir_slots = numpy.ndarray((slots,) + tuple(ir_shape), dtype=ir_dtype, buffer=shm.buf)
+    vis_slots = numpy.ndarray((slots,) + tuple(vis_shape), dtype=numpy.uint8, buffer=shm.buf,
+                              offset=slots * ir_bytes)
+    return ir_slots, vis_slots
+
+def ring_worker(tasks, done):
+    shm = None
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        layout, slot, has_visible, fileprefix, counter, timestamp, preview, enqueued, noise = task
+        if shm is None or shm.name != layout[0]:
+            # forked workers share the acquisition process's resource
+            # tracker, which unlinks the block once, in close()
+            shm = shared_memory.SharedMemory(name=layout[0])
+            ir_slots, vis_slots = ring_views(shm, layout)
+
+        item = (ir_slots[slot], vis_slots[slot] if has_visible else None, fileprefix, counter, timestamp, noise)
+        error = False
+        try:
+            save_item(item, preview=preview)
+        except Exception as ex:
+            runlog.warning("Error saving %s: %s" % (fileprefix, ex))
+            error = True
+        done.put((slot, time.monotonic() - enqueued, error))
+
+    # worker processes exit without flushing Python file buffers
+    if frame_store is not None:
+        frame_store.close()
 
 def image_worker():
     global save_queue
 
     while True:
-        item = save_queue.get(True, None) # block until item available
-        
-        data_infrared = item[0]
-        img_visible = item[1]
-        fileprefix = item[2]
-        #uid = item[3]
-        #gid = item[4]
-
-        print("Saving to %s" % fileprefix)
-
-        # save the infrared data
-        numpy.save(fileprefix + '-infrared-data.npy', data_infrared)
-#        os.chown(fileprefix + "-infrared-data.npy", uid, gid)
-
-        # generate a PNG preview of the infrared data, coloring by temperature
-        imgscaled = ((data_infrared - numpy.percentile(data_infrared,1)).astype(float) / (numpy.percentile(data_infrared,99) - numpy.percentile(data_infrared,2.5)).astype(float)) * 255
-        imgscaled[imgscaled < 0] = 0
-        imgscaled[imgscaled > 255] = 255
-        imgscaled = cv2.convertScaleAbs(imgscaled)
-        imgscaledcolored = cv2.applyColorMap(imgscaled, cv2.COLORMAP_OCEAN)
-        cv2.imwrite(fileprefix + '-infrared.png', imgscaledcolored)
+        entry = save_queue.get() # block until item available
+        try:
+            save_item(entry.item, preview=entry.preview)
+        except Exception as ex:
+            runlog.warning("Error saving %s: %s" % (entry.item[2], ex))
+            with save_queue.cond:
+                save_queue.counts['errors'] += 1
+        finally:
+            save_queue.task_done(entry)
+
+def save_item(item, preview=True):
+    data_infrared = item[0]
+    img_visible = item[1]
+    fileprefix = item[2]
+    counter = item[3]
+    timestamp = item[4]
+    #uid = item[5]
+    #gid = item[6]
+
+    noise = item_noise(item)
+
+    if storage_backend == 'segments':
+        save_segments(data_infrared, img_visible, counter, timestamp)
+        if noise is not None:
+            frame_store.append(frame_store_module.KIND_NOISE, counter, timestamp, noise)
+        if sync_saves:
+            frame_store.sync()
+        return
+
+    print("Saving to %s" % fileprefix)
+
+    # save the infrared data
+    written = [frame_codecs.save_frame(fileprefix, data_infrared, infrared_codec)]
+    if noise is not None:
+        numpy.save(fileprefix + NOISE_SUFFIX, noise)
+        written.append(fileprefix + NOISE_SUFFIX)
+#    os.chown(fileprefix + "-infrared-data.npy", uid, gid)
+
+    # generate a PNG preview of the infrared data, coloring by temperature
+    if preview:
+        lut = preview_renderer.stretch(data_infrared)
+        cv2.imwrite(fileprefix + '-infrared.png', preview_renderer.render(data_infrared, lut))
+        written.append(fileprefix + '-infrared.png')
 #        os.chown(fileprefix + "-infrared.png", uid, gid)
+        if preview_renderer.thumbnail_scale:
+            cv2.imwrite(fileprefix + '-infrared-thumb.png', preview_renderer.render_thumbnail(data_infrared, lut))
+            written.append(fileprefix + '-infrared-thumb.png')
 
-        # save the visible data
+    # save the visible data
+    if img_visible is not None:
         cv2.imwrite(fileprefix + "-visible.png",img_visible)
+        written.append(fileprefix + "-visible.png")
 #        os.chown(fileprefix + "-visible.png", uid, gid)
 
-        save_queue.task_done()
+    if sync_saves:
+        sync_files(written)
+
+def sync_files(paths):
+    """fsync the files of an item, then their directory, so they survive a power cut."""
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(paths[0])), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass # not every filesystem can fsync a directory
+
+def render_preview(data_infrared):
+    return preview_renderer.render(data_infrared)
+
+def save_segments(data_infrared, img_visible, counter, timestamp):
+    # one sequential append per image instead of a file per image;
+    # the infrared PNG preview is not stored and can be rendered later
+    codec = frame_codecs.get(infrared_codec)
+    if codec.name == 'raw':
+        frame_store.append_frame(counter, timestamp, data_infrared)
+    else:
+        payload = memoryview(codec.encode(data_infrared)).cast('B')
+        frame_store.append(frame_store_module.KIND_INFRARED, counter, timestamp, payload,
+                           shape=data_infrared.shape, dtype=data_infrared.dtype, codec=codec.codec_id)
+
+    if img_visible is not None:
+        ok, encoded = cv2.imencode('.png', img_visible)
+        if ok:
+            frame_store.append_encoded(frame_store_module.KIND_VISIBLE, counter, timestamp,
+                                       encoded, img_visible.shape, frame_store_module.CODEC_PNG)
 
 num_workers = 4
-queue_size = 256
+
+# The queue holds at most this many bytes of image data (an infrared frame
+# is 614 KB, a visible frame several MB), and what happens when it is full
+queue_bytes = 128 * 1024 * 1024
+overflow_policy = 'block'
+
+# infrared previews: OpenCV colormap name, and an optional extra thumbnail
+# downscaled by this factor (e.g. 4 for 160x120)
+preview_colormap = 'OCEAN'
+thumbnail_scale = None
+preview_renderer = preview_module.PreviewRenderer(preview_colormap, thumbnail_scale)
+
+# lossless encoding of the infrared frames, see frame_codecs.py
+infrared_codec = 'raw'
+
+# True saves from worker processes fed through a shared memory ring
+# (RingSaveQueue) instead of threads in the acquisition process
+use_processes = False
+
+# 'files' writes -infrared-data.npy, -infrared.png and -visible.png per frame,
+# 'segments' appends to a frame_store.FrameStore in the output directory
+storage_backend = 'files'
+
+# fsync every saved item before it counts as saved, so the save latency
+# runs from put() to durable storage and includes the write-back of the
+# USB stick, not just the copy into the page cache
+sync_saves = True
 
 save_queue = None
+frame_store = None
 
-def initialize_queue():
-    global save_queue
+def initialize_queue(backend='files', output_dir=None, max_bytes=None, policy=None, spill_dir=None,
+                     colormap=None, thumbnail=None, processes=None, codec=None):
+    global save_queue, storage_backend, frame_store, preview_renderer, infrared_codec
+
+    infrared_codec = frame_codecs.get(codec or infrared_codec).name
+
+    preview_renderer = preview_module.PreviewRenderer(colormap or preview_colormap, thumbnail or thumbnail_scale)
+
+    storage_backend = backend
+    if backend == 'segments':
+        frame_store = frame_store_module.FrameStore(output_dir)
+    elif backend != 'files':
+        raise ValueError("unknown storage backend %r" % backend)
+
+    if processes if processes is not None else use_processes:
+        # a segment store has a single writer
+        workers = 1 if backend == 'segments' else num_workers
+        save_queue = RingSaveQueue(max_bytes or queue_bytes, policy or overflow_policy, spill_dir, workers)
+        return
 
-    save_queue = queue.Queue(maxsize=queue_size)
+    save_queue = SaveQueue(max_bytes or queue_bytes, policy or overflow_policy, spill_dir)
 
     for i in range(num_workers):
         t = Thread(target=image_worker)
         t.daemon = True
         t.start()
 
-#q.join()       # block until all tasks are done
+def close_queue():
+    """Wait for every queued frame to be written, then stop any worker processes."""
+    save_queue.join()
+    if isinstance(save_queue, RingSaveQueue):
+        save_queue.close()
+    if frame_store is not None:
+        frame_store.close()
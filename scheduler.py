@@ -0,0 +1,167 @@
+# Deadline scheduler for the acquisition loop.
+#
+# Each piece of periodic work (frame capture, NUC, autofocus, pushing
+# weather data to the camera, disk checks, ...) is a task with its own
+# period. Deadlines are fixed multiples of the period from the start time
+# on the monotonic clock, so time spent inside a task never accumulates as
+# drift: a 5 s capture task runs at t0, t0+5, t0+10, ... however long each
+# run takes. If a task falls more than a whole period behind, the missed
+# ticks are skipped (and counted) rather than run back to back.
+#
+# Work that has to wait on the hardware (NUC settle, autofocus travel) is
+# split with call_later() instead of sleeping inside a task, so it never
+# holds up the other tasks.
+#
+#   sched = Scheduler()
+#   sched.add('capture', 5.0, capture)
+#   sched.add('nuc', 120.0, nuc)
+#   sched.run(until=lambda: counter >= TOTAL_RUNTIME)
+#   sched.log_report()
+#
+
+import json
+import time
+import heapq
+import collections
+
+# Logging and print statements
+import logging
+runlog = logging.getLogger()
+
+# number of recent runs kept per task for the cadence report
+HISTORY = 1024
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100.0 * (len(ordered) - 1))))]
+
+class PeriodicTask:
+    """A named action run every period seconds, offset seconds after the scheduler starts."""
+
+    def __init__(self, name, period, action, offset=0.0):
+        self.name = name
+        self.period = float(period)
+        self.action = action
+        self.offset = float(offset)
+
+        self.next_deadline = None
+        self.first_start = None
+        self.last_start = None
+        self.runs = 0
+        self.skipped = 0
+        self.intervals = collections.deque(maxlen=HISTORY)
+        self.lateness = collections.deque(maxlen=HISTORY)
+        self.durations = collections.deque(maxlen=HISTORY)
+
+    def stats(self):
+        """Achieved versus target cadence of this task."""
+        achieved = float('nan')
+        if self.runs > 1:
+            achieved = (self.last_start - self.first_start) / (self.runs - 1)
+
+        return {
+            'task': self.name,
+            'period_s': self.period,
+            'achieved_period_s': achieved,
+            'runs': self.runs,
+            'skipped': self.skipped,
+            'interval_p50_s': percentile(self.intervals, 50),
+            'interval_max_s': max(self.intervals) if self.intervals else float('nan'),
+            'late_p95_s': percentile(self.lateness, 95),
+            'duration_p50_s': percentile(self.durations, 50),
+            'duration_max_s': max(self.durations) if self.durations else float('nan'),
+        }
+
+class Scheduler:
+    """Runs periodic tasks and one-shot callbacks against monotonic deadlines."""
+
+    def __init__(self, clock=time.monotonic, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.tasks = []
+        self.oneshots = []
+        self.sequence = 0
+        self.running = False
+
+    def add(self, name, period, action, offset=0.0):
+        """Register a periodic task; tasks due at the same time run in registration order."""
+        task = PeriodicTask(name, period, action, offset)
+        self.tasks.append(task)
+        return task
+
+    def call_later(self, delay, action):
+        """Run action once, delay seconds from now, without blocking anything meanwhile."""
+        self.sequence += 1
+        heapq.heappush(self.oneshots, (self.clock() + delay, self.sequence, action))
+
+    def stop(self):
+        self.running = False
+
+    def run(self, until=None):
+        """Run tasks until stop() is called or until() returns True."""
+        start = self.clock()
+        for task in self.tasks:
+            task.next_deadline = start + task.offset
+
+        self.running = True
+        while self.running and not (until and until()):
+            # earliest periodic task, ties broken by registration order
+            task = min(self.tasks, key=lambda t: t.next_deadline) if self.tasks else None
+            deadline = task.next_deadline if task else float('inf')
+
+            if self.oneshots and self.oneshots[0][0] <= deadline:
+                deadline, _, action = self.oneshots[0]
+                self.wait_until(deadline)
+                heapq.heappop(self.oneshots)
+                action()
+                continue
+
+            if task is None:
+                break
+
+            self.wait_until(deadline)
+            self.run_task(task, deadline)
+
+    def wait_until(self, deadline):
+        delay = deadline - self.clock()
+        if delay > 0:
+            self.sleep(delay)
+
+    def run_task(self, task, deadline):
+        started = self.clock()
+        if task.last_start is not None:
+            task.intervals.append(started - task.last_start)
+        else:
+            task.first_start = started
+        task.last_start = started
+        task.lateness.append(started - deadline)
+
+        try:
+            task.action()
+        finally:
+            finished = self.clock()
+            task.runs += 1
+            task.durations.append(finished - started)
+
+            # next tick on the original grid; skip any we are already past
+            task.next_deadline = deadline + task.period
+            if task.next_deadline <= finished:
+                missed = int((finished - task.next_deadline) // task.period) + 1
+                task.skipped += missed
+                task.next_deadline += missed * task.period
+
+    def report(self):
+        return [task.stats() for task in self.tasks]
+
+    def log_report(self):
+        for s in self.report():
+            runlog.warning("**** %s: target %.2f s, achieved %.2f s over %d runs (%d skipped), "
+                           "late p95 %.3f s, duration p50 %.3f s max %.3f s" %
+                           (s['task'], s['period_s'], s['achieved_period_s'], s['runs'], s['skipped'],
+                            s['late_p95_s'], s['duration_p50_s'], s['duration_max_s']))
+
+    def write_report(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=1)
@@ -0,0 +1,130 @@
+# Background sampling of the slow sensors.
+#
+# The Atlas EZO-HUM query sleeps 1.5 s and the TC-08 single read takes a
+# conversion per channel, so reading them inline put about 2 s of dead
+# time in front of every frame. Each sensor now gets its own thread that
+# samples it on its own period (on a fixed monotonic grid, like
+# scheduler.py) and keeps the latest reading. The acquisition loop only
+# takes a snapshot, which never waits on a device.
+#
+# A snapshot holds the last good values of every sensor plus, per sensor,
+#   <name>_age_s    seconds since that reading was taken (None if never)
+#   <name>_stale    1 if the reading is older than max_age or missing, else 0
+# so stale data is flagged rather than replaced by -999. Values are None
+# until a sensor has been read successfully once.
+#
+#   sampling = SensorSampling()
+#   sampling.add('wx', 5.0, read_weather, keys=('wx_temp_air_c', 'wx_rel_hum'))
+#   sampling.start()
+#   stats.update(sampling.snapshot())
+#
+
+import time
+import threading
+import collections
+
+# Logging and print statements
+import logging
+runlog = logging.getLogger()
+
+# a reading older than this many periods is stale, unless max_age is given
+STALE_PERIODS = 3
+
+class SensorSampler(threading.Thread):
+    """Calls read() every period seconds and keeps the latest dict it returns.
+
+    read() may return None when the sensor has nothing new yet.
+    """
+
+    def __init__(self, name, period, read, keys=(), max_age=None):
+        threading.Thread.__init__(self, name='sampler-' + name, daemon=True)
+        self.sensor = name
+        self.period = float(period)
+        self.read = read
+        self.keys = tuple(keys)
+        self.max_age = max_age if max_age is not None else STALE_PERIODS * self.period
+
+        self.lock = threading.Lock()
+        self.values = dict.fromkeys(self.keys)
+        self.read_at = None
+        self.read_time = None
+        self.counts = collections.Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        deadline = time.monotonic()
+        while not self.stopped.is_set():
+            self.sample()
+
+            # next tick on the grid, skipping any the read overran
+            deadline += self.period
+            now = time.monotonic()
+            if deadline <= now:
+                deadline += ((now - deadline) // self.period + 1) * self.period
+            self.stopped.wait(deadline - now)
+
+    def sample(self):
+        started = time.monotonic()
+        try:
+            values = self.read()
+        except Exception as ex:
+            self.counts['errors'] += 1
+            runlog.warning("Error reading %s: %s" % (self.sensor, ex))
+            return
+        if values is None:
+            return
+
+        with self.lock:
+            self.values.update(values)
+            self.read_at = time.monotonic()
+            self.read_time = self.read_at - started
+            self.counts['reads'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = dict(self.values)
+            age = time.monotonic() - self.read_at if self.read_at is not None else None
+        snapshot[self.sensor + '_age_s'] = round(age, 2) if age is not None else None
+        snapshot[self.sensor + '_stale'] = int(age is None or age > self.max_age)
+        return snapshot
+
+    def stop(self):
+        self.stopped.set()
+
+class SensorSampling:
+    """A set of sensor samplers, read together with one snapshot() call."""
+
+    def __init__(self):
+        self.samplers = []
+
+    def add(self, name, period, read, keys=(), max_age=None):
+        sampler = SensorSampler(name, period, read, keys, max_age)
+        self.samplers.append(sampler)
+        return sampler
+
+    def start(self):
+        for sampler in self.samplers:
+            sampler.start()
+
+    def stop(self, timeout=5.0):
+        """Stop sampling and wait for reads in progress, so devices can be closed safely."""
+        for sampler in self.samplers:
+            sampler.stop()
+        for sampler in self.samplers:
+            if sampler.is_alive():
+                sampler.join(timeout)
+
+    def snapshot(self):
+        """Latest values of all sensors with their age and stale flags; never blocks on a device."""
+        snapshot = {}
+        for sampler in self.samplers:
+            snapshot.update(sampler.snapshot())
+        return snapshot
+
+    def log_status(self):
+        for sampler in self.samplers:
+            s = sampler.snapshot()
+            runlog.warning("**** Sensor %s: %d reads, %d errors, last read took %s s, age %s s%s" %
+                           (sampler.sensor, sampler.counts['reads'], sampler.counts['errors'],
+                            '%.2f' % sampler.read_time if sampler.read_time is not None else '-',
+                            s[sampler.sensor + '_age_s'], ' (stale)' if s[sampler.sensor + '_stale'] else ''))
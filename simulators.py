@@ -0,0 +1,710 @@
+# In-process simulators for the field rig hardware.
+#
+#   pyspin                 stand-in for the PySpin module: one FLIR camera
+#                          producing synthetic radiometric Mono16 frames at
+#                          the IRFrameRate set on its nodemap
+#   usbtc08                stand-in for picosdk.usbtc08 (Pico TC-08 logger)
+#   SimulatedAtlasI2C      AtlasI2C on a simulated I2C bus with an EZO-HUM
+#   SimulatedVideoCapture  stand-in for the RTSP cv2.VideoCapture
+#
+# All devices read the same slowly varying weather (environment()), so the
+# simulated camera, thermocouples and humidity sensor agree with each other.
+# Selected through devices.py with FLIR_SIMULATE; the module constants
+# below set rates, latencies and noise.
+#
+
+import math
+import time
+import types
+import random
+import ctypes
+import threading
+
+import numpy
+
+from AtlasI2C import AtlasI2C
+from RadiometricData import RadiometricData
+
+# camera
+WIDTH = 640
+HEIGHT = 480
+FRAME_RATE = None          # frames/s; None follows the IRFrameRate node
+INCOMPLETE_RATE = 0.0      # fraction of frames delivered incomplete
+NOISE_K = 0.05             # per-pixel temporal noise, Kelvin (roughly the NETD)
+NOISE_FRAMES = 8
+IR_FRAME_RATES = {'Rate60Hz': 60.0, 'Rate30Hz': 30.0, 'Rate15Hz': 15.0, 'Rate7Hz': 7.5}
+
+# Pico TC-08: conversion time per enabled channel, plus the cold junction
+TC08_CONVERSION_TIME = 0.1
+TC08_BUFFER_READINGS = 600
+
+# Atlas EZO: (mean, jitter) processing time in seconds per command
+EZO_LATENCY = {'R': (0.6, 0.15)}
+EZO_DEFAULT_LATENCY = (0.15, 0.05)
+EZO_HUM_ADDRESS = 111
+
+# visible stream
+VISIBLE_FPS = 25.0
+VISIBLE_SHAPE = (720, 1280, 3)
+
+def environment(t=None):
+    """Weather at time t: air temperature (C), relative humidity (%), PPFD (umol/m2/s)."""
+    t = time.time() if t is None else t
+    day = 2 * math.pi * ((t % 86400.0) / 86400.0 - 0.375)   # warmest mid afternoon
+    sun = max(0.0, math.cos(day))
+    air_c = 18.0 + 8.0 * math.cos(day) + 0.3 * math.sin(t / 97.0)
+    rh = min(99.0, max(5.0, 55.0 - 25.0 * math.cos(day) + 2.0 * math.sin(t / 131.0)))
+    ppfd = 1800.0 * sun * (0.8 + 0.2 * math.sin(t / 53.0) ** 2)
+    return air_c, rh, ppfd
+
+# - - - - - - - - - - - - - - - - - #
+#    CAMERA (PySpin stand-in)       #
+# - - - - - - - - - - - - - - - - - #
+
+class SpinnakerException(Exception):
+    pass
+
+EVENT_TIMEOUT_INFINITE = 0xFFFFFFFFFFFFFFFF
+
+class Node:
+    def __init__(self, name, value=None, readable=True, writable=True):
+        self.name = name
+        self.value = value
+        self.readable = readable
+        self.writable = writable
+
+    def GetName(self):
+        return self.name
+
+    def GetValue(self):
+        return self.value
+
+    def SetValue(self, value):
+        if not self.writable:
+            raise SpinnakerException("node %s is not writable" % self.name)
+        self.value = value
+
+    def ToString(self):
+        return str(self.value)
+
+class EnumEntry(Node):
+    def GetSymbolic(self):
+        return self.name
+
+    def GetDisplayName(self):
+        return self.name
+
+class EnumNode(Node):
+    def __init__(self, name, entries, current):
+        self.entries = [EnumEntry(entry, i) for i, entry in enumerate(entries)]
+        Node.__init__(self, name, entries.index(current))
+
+    def GetEntryByName(self, name):
+        for entry in self.entries:
+            if entry.name == name:
+                return entry
+        return None
+
+    def GetEntries(self):
+        return list(self.entries)
+
+    def GetIntValue(self):
+        return self.value
+
+    def SetIntValue(self, value):
+        self.SetValue(value)
+
+    def GetCurrentEntry(self):
+        return self.entries[self.value]
+
+    def ToString(self):
+        return self.entries[self.value].name
+
+class CommandNode(Node):
+    def __init__(self, name, action):
+        Node.__init__(self, name)
+        self.action = action
+
+    def Execute(self):
+        self.action()
+
+    def IsDone(self):
+        return True
+
+class CategoryNode(Node):
+    def __init__(self, name, features):
+        Node.__init__(self, name)
+        self.features = features
+
+    def GetFeatures(self):
+        return list(self.features)
+
+class NodeMap:
+    def __init__(self, nodes):
+        self.nodes = {node.name: node for node in nodes}
+
+    def GetNode(self, name):
+        return self.nodes.get(name)
+
+    def GetNodes(self):
+        return list(self.nodes.values())
+
+def node_ptr(node):
+    # the CxxxPtr casts are no-ops on simulated nodes
+    return node
+
+def IsAvailable(node):
+    return node is not None
+
+def IsReadable(node):
+    return node is not None and node.readable
+
+def IsWritable(node):
+    return node is not None and node.writable
+
+class SimulatedImage:
+    def __init__(self, data, frame_id, timestamp_ns, incomplete):
+        self.data = data
+        self.frame_id = frame_id
+        self.timestamp_ns = timestamp_ns
+        self.incomplete = incomplete
+
+    def IsIncomplete(self):
+        return self.incomplete
+
+    def GetImageStatus(self):
+        return 1 if self.incomplete else 0
+
+    def GetNDArray(self):
+        return self.data
+
+    def GetFrameID(self):
+        return self.frame_id
+
+    def GetTimeStamp(self):
+        return self.timestamp_ns
+
+    def GetWidth(self):
+        return self.data.shape[1]
+
+    def GetHeight(self):
+        return self.data.shape[0]
+
+    def Release(self):
+        self.data = None
+
+class SceneGenerator:
+    """Synthetic radiometric counts for a canopy scene with a black reference plate."""
+
+    def __init__(self, nodemap, seed=7):
+        self.nodemap = nodemap
+        rng = numpy.random.default_rng(seed)
+
+        yy, xx = numpy.mgrid[0:HEIGHT, 0:WIDTH].astype(numpy.float32)
+        scene = numpy.zeros((HEIGHT, WIDTH), dtype=numpy.float32)
+        for _ in range(40):
+            cy, cx = rng.uniform(0, HEIGHT), rng.uniform(0, WIDTH)
+            r = rng.uniform(15, 60)
+            scene += rng.uniform(-2.5, 2.5) * numpy.exp(-((yy - cy) ** 2 + (xx - cx) ** 2) / (2 * r * r))
+        scene += 1.5 * (yy / HEIGHT)                       # warmer soil towards the bottom
+        scene[40:100, 40:100] += 6.0                       # black reference plate
+        self.offsets_k = scene
+
+        self.noise = [(rng.normal(0.0, 1.0, (HEIGHT, WIDTH)).astype(numpy.float32))
+                      for _ in range(NOISE_FRAMES)]
+        self.base = None
+        self.base_air_c = None
+
+    def calibration(self):
+        rd = RadiometricData()
+        get = lambda name: self.nodemap.GetNode(name).GetValue()
+        rd.setFromStats({name: get(name) for name in (
+            'J0', 'J1', 'R', 'B', 'F', 'X', 'alpha1', 'alpha2', 'beta1', 'beta2',
+            'ObjectEmissivity', 'ObjectDistance', 'AtmosphericTemperature', 'RelativeHumidity',
+            'ReflectedTemperature', 'ExtOpticsTemperature', 'ExtOpticsTransmission')})
+        rd.doUpdateCalcConst()
+        return rd
+
+    def counts(self, kelvin, rd):
+        sig = rd.m_R / (numpy.exp(rd.m_B / kelvin) - rd.m_F)
+        return rd.m_J0 + rd.m_J1 * (sig + rd.m_K2) / rd.m_K1
+
+    def rebuild(self, air_c):
+        # counts for the scene at the current air temperature, and the count
+        # change per Kelvin used to apply the noise without another exp()
+        rd = self.calibration()
+        kelvin = self.offsets_k + (air_c + 273.15)
+        self.base = self.counts(kelvin, rd).astype(numpy.float32)
+        self.gain = (self.counts(kelvin + 1.0, rd) - self.base).astype(numpy.float32)
+        self.base_air_c = air_c
+
+    def frame(self, frame_id, t):
+        air_c = environment(t)[0]
+        if self.base is None or abs(air_c - self.base_air_c) > 0.25:
+            self.rebuild(air_c)
+
+        noisy = self.noise[frame_id % NOISE_FRAMES] * (NOISE_K * self.gain)
+        noisy += self.base
+        numpy.clip(noisy, 0, 65535, out=noisy)
+        return noisy.astype(numpy.uint16)
+
+class SimulatedCamera:
+    def __init__(self, ip_hex='0xC0A80164', serial='SIM0001'):
+        self.initialized = False
+        self.streaming = False
+        self.lock = threading.Lock()
+
+        self.tl_nodemap = NodeMap([
+            CategoryNode('DeviceInformation', [
+                Node('DeviceVendorName', 'FLIR Systems (simulated)', writable=False),
+                Node('DeviceModelName', 'A700 simulator', writable=False),
+                Node('DeviceSerialNumber', serial, writable=False),
+                Node('GevDeviceIPAddress', ip_hex, writable=False),
+            ]),
+        ])
+        self.tl_nodemap.nodes.update({n.name: n for n in self.tl_nodemap.nodes['DeviceInformation'].features})
+
+        floats = {
+            'AtmosphericTemperature': 293.15, 'EstimatedTransmission': 0.99,
+            'ExtOpticsTemperature': 293.15, 'ExtOpticsTransmission': 1.0,
+            'ObjectDistance': 2.0, 'ObjectEmissivity': 0.95, 'ReflectedTemperature': 293.15,
+            'RelativeHumidity': 0.5, 'FocusDistance': 2.0, 'TSens': 305.0,
+            'alpha1': 0.006569, 'alpha2': 0.01262, 'B': 1430.1, 'beta1': -0.002276,
+            'beta2': -0.00667, 'F': 1.0, 'J1': 69.6245, 'R': 16671.9043, 'X': 1.9,
+        }
+        nodes = [Node(name, value) for name, value in floats.items()]
+        nodes += [Node('J0', 4214), Node('OffsetX', 0), Node('OffsetY', 0),
+                  Node('Height', HEIGHT), Node('Width', WIDTH)]
+        nodes += [
+            EnumNode('VideoSourceSelector', ['IR', 'Visual'], 'IR'),
+            EnumNode('PixelFormat', ['Mono8', 'Mono16'], 'Mono16'),
+            EnumNode('IRFormat', ['Radiometric', 'TemperatureLinear100mK', 'TemperatureLinear10mK'], 'Radiometric'),
+            EnumNode('IRFrameRate', list(IR_FRAME_RATES), 'Rate30Hz'),
+            EnumNode('NUCMode', ['Off', 'Automatic'], 'Automatic'),
+            EnumNode('AutoFocusMethod', ['Coarse', 'Fine'], 'Coarse'),
+            EnumNode('AcquisitionMode', ['Continuous', 'SingleFrame', 'MultiFrame'], 'Continuous'),
+            CommandNode('NUCAction', lambda: None),
+            CommandNode('AutoFocus', self.autofocus),
+        ]
+        self.nodemap = NodeMap(nodes)
+
+        self.stream_nodemap = NodeMap([
+            EnumNode('StreamBufferHandlingMode',
+                     ['OldestFirst', 'OldestFirstOverwrite', 'NewestFirst', 'NewestOnly'], 'OldestFirst'),
+            EnumNode('StreamBufferCountMode', ['Auto', 'Manual'], 'Auto'),
+            Node('StreamBufferCountManual', 10),
+            Node('StreamTotalBufferCount', 0, writable=False),
+            Node('StreamDroppedFrameCount', 0, writable=False),
+            Node('StreamLostFrameCount', 0, writable=False),
+            Node('StreamFailedBufferCount', 0, writable=False),
+        ])
+
+        self.scene = SceneGenerator(self.nodemap)
+
+    def autofocus(self):
+        self.nodemap.GetNode('FocusDistance').value = round(random.uniform(1.5, 3.0), 2)
+
+    def GetTLDeviceNodeMap(self):
+        return self.tl_nodemap
+
+    def GetNodeMap(self):
+        return self.nodemap
+
+    def GetTLStreamNodeMap(self):
+        return self.stream_nodemap
+
+    def Init(self):
+        self.initialized = True
+
+    def IsInitialized(self):
+        return self.initialized
+
+    def DeInit(self):
+        self.initialized = False
+
+    def IsStreaming(self):
+        return self.streaming
+
+    def BeginAcquisition(self):
+        self.start = time.monotonic()
+        self.start_epoch = time.time()
+        self.delivered = -1
+        self.streaming = True
+
+    def EndAcquisition(self):
+        self.streaming = False
+
+    def frame_period(self):
+        rate = FRAME_RATE or IR_FRAME_RATES[self.nodemap.GetNode('IRFrameRate').ToString()]
+        return 1.0 / rate
+
+    def stream_count(self, name, increment):
+        self.stream_nodemap.GetNode(name).value += increment
+
+    def GetNextImage(self, timeout_ms=EVENT_TIMEOUT_INFINITE):
+        if not self.streaming:
+            raise SpinnakerException("camera is not streaming")
+
+        with self.lock:
+            period = self.frame_period()
+            mode = self.stream_nodemap.GetNode('StreamBufferHandlingMode').ToString()
+            buffers = self.stream_nodemap.GetNode('StreamBufferCountManual').GetValue()
+            latest = int((time.monotonic() - self.start) / period)
+
+            if mode in ('NewestOnly', 'NewestFirst') and latest > self.delivered:
+                frame_id = latest
+            else:
+                # oldest first: frames that fell out of the buffer pool are lost
+                frame_id = max(self.delivered + 1, latest - buffers + 1)
+
+            lost = frame_id - self.delivered - 1
+            if lost > 0:
+                self.stream_count('StreamDroppedFrameCount', lost)
+
+            wait = self.start + frame_id * period - time.monotonic()
+            if wait > 0:
+                if timeout_ms != EVENT_TIMEOUT_INFINITE and wait * 1000.0 > timeout_ms:
+                    time.sleep(timeout_ms / 1000.0)
+                    raise SpinnakerException("Spinnaker: GetNextImage timed out")
+                time.sleep(wait)
+
+            self.delivered = frame_id
+            self.stream_count('StreamTotalBufferCount', 1)
+
+            incomplete = random.random() < INCOMPLETE_RATE
+            if incomplete:
+                self.stream_count('StreamFailedBufferCount', 1)
+
+            t = self.start_epoch + frame_id * period
+            data = self.scene.frame(frame_id, t)
+            return SimulatedImage(data, frame_id, int(frame_id * period * 1e9), incomplete)
+
+class SimulatedCameraList:
+    def __init__(self, cameras):
+        self.cameras = list(cameras)
+
+    def GetSize(self):
+        return len(self.cameras)
+
+    def GetByIndex(self, index):
+        return self.cameras[index]
+
+    def Clear(self):
+        self.cameras = []
+
+    def __len__(self):
+        return len(self.cameras)
+
+    def __getitem__(self, index):
+        return self.cameras[index]
+
+class SimulatedSystem:
+    instance = None
+    num_cameras = 1
+
+    @staticmethod
+    def GetInstance():
+        if SimulatedSystem.instance is None:
+            SimulatedSystem.instance = SimulatedSystem()
+        return SimulatedSystem.instance
+
+    def __init__(self):
+        self.cameras = [SimulatedCamera() for _ in range(self.num_cameras)]
+
+    def GetLibraryVersion(self):
+        return types.SimpleNamespace(major=0, minor=0, type=0, build=0)
+
+    def GetCameras(self):
+        return SimulatedCameraList(self.cameras)
+
+    def ReleaseInstance(self):
+        SimulatedSystem.instance = None
+
+pyspin = types.SimpleNamespace(
+    System=SimulatedSystem,
+    SpinnakerException=SpinnakerException,
+    EVENT_TIMEOUT_INFINITE=EVENT_TIMEOUT_INFINITE,
+    IsAvailable=IsAvailable,
+    IsReadable=IsReadable,
+    IsWritable=IsWritable,
+    CValuePtr=node_ptr,
+    CCategoryPtr=node_ptr,
+    CFloatPtr=node_ptr,
+    CIntegerPtr=node_ptr,
+    CBooleanPtr=node_ptr,
+    CStringPtr=node_ptr,
+    CCommandPtr=node_ptr,
+    CEnumerationPtr=node_ptr,
+    CEnumEntryPtr=node_ptr,
+)
+
+# - - - - - - - - - - - - - - - - - #
+#    PICO TC-08 (usbtc08 stand-in)  #
+# - - - - - - - - - - - - - - - - - #
+
+class PicoSDKCtypesError(Exception):
+    pass
+
+def assert_pico2000_ok(status):
+    if status <= 0:
+        raise PicoSDKCtypesError("Unsuccessful API call")
+
+def deref(ptr):
+    # ctypes.byref() objects keep the referenced object in _obj
+    return getattr(ptr, '_obj', ptr)
+
+class SimulatedTC08:
+    def __init__(self):
+        self.channels = {}
+        self.interval_ms = None
+        self.run_start = None
+        self.read_upto = {}
+
+    def reading(self, channel, t):
+        air_c, rh, ppfd = environment(t)
+        wobble = 0.05 * math.sin(t * 1.7 + channel)
+        if channel == 0:
+            return air_c + 1.0 + wobble                       # cold junction, inside the box
+        if channel in (1, 2, 3):
+            return air_c - 3.0 + 0.5 * channel + 0.5 * wobble  # soil
+        if channel == 5:
+            return air_c + wobble                             # ambient
+        if channel == 6:
+            return ppfd / 239.34 + 0.01 * wobble              # PAR sensor, mV
+        if channel == 8:
+            return air_c + 0.004 * ppfd + wobble              # black reference plate
+        return air_c + wobble
+
+tc08_units = {}
+
+def usb_tc08_open_unit():
+    handle = len(tc08_units) + 1
+    tc08_units[handle] = SimulatedTC08()
+    return handle
+
+def usb_tc08_set_mains(handle, sixty_hertz):
+    return 1
+
+def usb_tc08_set_channel(handle, channel, tc_type):
+    tc08_units[handle].channels[channel] = tc_type
+    return 1
+
+def usb_tc08_get_minimum_interval_ms(handle):
+    return int(TC08_CONVERSION_TIME * 1000 * (len(tc08_units[handle].channels) + 1))
+
+def usb_tc08_get_single(handle, temp, overflow, units):
+    unit = tc08_units[handle]
+    time.sleep(TC08_CONVERSION_TIME * (len(unit.channels) + 1))
+    temp = deref(temp)
+    now = time.time()
+    temp[0] = unit.reading(0, now)
+    for channel in unit.channels:
+        temp[channel] = unit.reading(channel, now)
+    deref(overflow).value = 0
+    return 1
+
+def usb_tc08_run(handle, interval_ms):
+    unit = tc08_units[handle]
+    unit.interval_ms = max(int(interval_ms), usb_tc08_get_minimum_interval_ms(handle))
+    unit.run_start = time.time()
+    unit.read_upto = {}
+    return unit.interval_ms
+
+def usb_tc08_get_temp(handle, temp_buffer, times_ms_buffer, buffer_length, overflow, channel, units, fill_missing):
+    unit = tc08_units[handle]
+    if unit.run_start is None:
+        return -1
+
+    interval = unit.interval_ms / 1000.0
+    available = int((time.time() - unit.run_start) / interval)
+    first = unit.read_upto.get(channel, 0)
+    overflowed = first < available - TC08_BUFFER_READINGS
+    first = max(first, available - TC08_BUFFER_READINGS)   # device buffer overflowed
+    count = min(buffer_length, available - first)
+
+    temps = deref(temp_buffer)
+    times = deref(times_ms_buffer)
+    for i in range(count):
+        n = first + i
+        temps[i] = unit.reading(channel, unit.run_start + n * interval)
+        times[i] = int(n * unit.interval_ms)
+    unit.read_upto[channel] = first + count
+    deref(overflow).value = 1 if overflowed else 0
+    return count
+
+def usb_tc08_stop(handle):
+    tc08_units[handle].run_start = None
+    return 1
+
+def usb_tc08_close_unit(handle):
+    tc08_units.pop(handle, None)
+    return 1
+
+usbtc08 = types.SimpleNamespace(
+    USBTC08_UNITS={"USBTC08_UNITS_CENTIGRADE": 0, "USBTC08_UNITS_FAHRENHEIT": 1,
+                   "USBTC08_UNITS_KELVIN": 2, "USBTC08_UNITS_RANKINE": 3},
+    usb_tc08_open_unit=usb_tc08_open_unit,
+    usb_tc08_set_mains=usb_tc08_set_mains,
+    usb_tc08_set_channel=usb_tc08_set_channel,
+    usb_tc08_get_minimum_interval_ms=usb_tc08_get_minimum_interval_ms,
+    usb_tc08_get_single=usb_tc08_get_single,
+    usb_tc08_run=usb_tc08_run,
+    usb_tc08_get_temp=usb_tc08_get_temp,
+    usb_tc08_stop=usb_tc08_stop,
+    usb_tc08_close_unit=usb_tc08_close_unit,
+)
+
+# - - - - - - - - - - - - - - - - - #
+#    ATLAS EZO on a simulated bus   #
+# - - - - - - - - - - - - - - - - - #
+
+class SimulatedEZOHum:
+    """EZO-HUM answering at the byte level: 254 while processing, then 1 + ASCII + nulls."""
+
+    def __init__(self, name=''):
+        self.name = name
+        self.response = None
+        self.ready_at = 0.0
+
+    def write(self, data):
+        command = data.rstrip(b'\x00').decode('latin-1')
+        upper = command.upper()
+
+        if upper == 'I':
+            response = (1, '?I,HUM,1.0')
+        elif upper == 'NAME,?':
+            response = (1, '?Name,%s' % self.name)
+        elif upper.startswith('NAME,'):
+            self.name = command[5:]
+            response = (1, '')
+        elif upper == 'R':
+            air_c, rh, ppfd = environment()
+            response = (1, '%.2f,%.2f' % (rh, air_c))
+        elif upper == 'STATUS':
+            response = (1, '?Status,P,3.30')
+        elif upper == 'SLEEP':
+            self.response = None
+            return
+        else:
+            response = (2, '')                                # syntax error
+
+        mean, jitter = EZO_LATENCY.get(upper, EZO_DEFAULT_LATENCY)
+        self.ready_at = time.monotonic() + max(0.0, random.uniform(mean - jitter, mean + jitter))
+        self.response = response
+
+    def read(self, num_of_bytes):
+        if self.response is None:
+            data = bytes([255])                               # no data to send
+        elif time.monotonic() < self.ready_at:
+            data = bytes([254])                               # still processing
+        else:
+            code, text = self.response
+            data = bytes([code]) + text.encode('latin-1')
+        return data.ljust(num_of_bytes, b'\x00')[:num_of_bytes]
+
+class SimulatedI2CBus:
+    def __init__(self, devices=None):
+        self.devices = devices if devices is not None else {EZO_HUM_ADDRESS: SimulatedEZOHum()}
+        self.lock = threading.Lock()
+
+    def device(self, address):
+        device = self.devices.get(address)
+        if device is None:
+            raise OSError(121, "Remote I/O error")
+        return device
+
+class SimulatedI2CFile:
+    def __init__(self, bus, owner):
+        self.bus = bus
+        self.owner = owner
+
+    def write(self, data):
+        with self.bus.lock:
+            self.bus.device(self.owner.address).write(bytes(data))
+        return len(data)
+
+    def read(self, num_of_bytes):
+        with self.bus.lock:
+            return self.bus.device(self.owner.address).read(num_of_bytes)
+
+    def close(self):
+        pass
+
+i2c_bus = SimulatedI2CBus()
+
+class SimulatedAtlasI2C(AtlasI2C):
+    """AtlasI2C talking to i2c_bus instead of /dev/i2c-N."""
+
+    def open_bus(self):
+        return SimulatedI2CFile(i2c_bus, self), SimulatedI2CFile(i2c_bus, self)
+
+    def set_i2c_address(self, addr):
+        self._address = addr
+
+# - - - - - - - - - - - - - - - - - #
+#    VISIBLE (RTSP) STREAM          #
+# - - - - - - - - - - - - - - - - - #
+
+class SimulatedVideoCapture:
+    """Paced like a live stream: grab() waits for the next frame, retrieve() decodes it."""
+
+    CAP_PROP_POS_MSEC = 0
+    CAP_PROP_FPS = 5
+    CAP_PROP_FRAME_WIDTH = 3
+    CAP_PROP_FRAME_HEIGHT = 4
+
+    def __init__(self, url, fps=None, shape=None):
+        self.url = url
+        self.fps = fps or VISIBLE_FPS
+        self.shape = shape or VISIBLE_SHAPE
+        self.start = time.monotonic()
+        self.frame_id = -1
+        self.opened = True
+
+        h, w = self.shape[:2]
+        yy, xx = numpy.mgrid[0:h, 0:w]
+        self.background = numpy.stack([(xx * 255 // w), (yy * 255 // h),
+                                       numpy.full((h, w), 96)], axis=-1).astype(numpy.uint8)
+
+    def isOpened(self):
+        return self.opened
+
+    def grab(self):
+        if not self.opened:
+            return False
+        period = 1.0 / self.fps
+        next_id = max(self.frame_id + 1, int((time.monotonic() - self.start) / period))
+        wait = self.start + next_id * period - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        self.frame_id = next_id
+        return True
+
+    def retrieve(self):
+        if self.frame_id < 0:
+            return False, None
+        # decoding cost: a full new frame every time
+        frame = numpy.roll(self.background, self.frame_id % self.shape[1], axis=1)
+        return True, frame
+
+    def read(self):
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def get(self, prop):
+        if prop == self.CAP_PROP_POS_MSEC:
+            return self.frame_id * 1000.0 / self.fps
+        if prop == self.CAP_PROP_FPS:
+            return self.fps
+        if prop == self.CAP_PROP_FRAME_WIDTH:
+            return self.shape[1]
+        if prop == self.CAP_PROP_FRAME_HEIGHT:
+            return self.shape[0]
+        return 0.0
+
+    def set(self, prop, value):
+        return False
+
+    def release(self):
+        self.opened = False
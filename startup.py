@@ -0,0 +1,119 @@
+# Phased startup with a timing report.
+#
+# Bringing the station up means opening several devices that do not depend
+# on each other: the EZO weather board on I2C, the TC-08 on USB and the
+# thermal camera on GigE (whose visible stream needs the camera's address).
+# Each of these is a phase. start() runs a phase on its own thread (once
+# the phases it comes after have finished), run() runs one in the calling
+# thread, and result() waits for a phase and returns its value, re-raising
+# whatever it raised (including the SystemExit of an exit() inside it), so
+# a failed device still stops the program from the main thread.
+#
+# Every phase records when it started and how long it took, relative to
+# the start of the process, so the report shows what is on the critical
+# path to the first frame:
+#
+#   startup = Startup()
+#   startup.start('camera', init_camera)
+#   startup.start('visible', init_visible, after=('camera',))
+#   camera = startup.result('camera')
+#   startup.log_report()
+#   startup.write_report(os.path.join(output_dir, 'startup.json'))
+#
+
+import json
+import time
+import threading
+import collections
+from concurrent.futures import Future
+
+# Logging and print statements
+import logging
+runlog = logging.getLogger()
+
+class Phase:
+    def __init__(self, name, started):
+        self.name = name
+        self.started = started
+        self.finished = None
+        self.thread = threading.current_thread().name
+        self.error = None
+
+class Startup:
+    def __init__(self, t0=None):
+        # t0 is the monotonic time the process started its own work
+        self.t0 = t0 if t0 is not None else time.monotonic()
+        self.phases = collections.OrderedDict()
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def begin(self, name):
+        phase = Phase(name, time.monotonic())
+        with self.lock:
+            self.phases[name] = phase
+        return phase
+
+    def execute(self, name, func, future, after=()):
+        try:
+            for dependency in after:
+                self.futures[dependency].result()
+        except BaseException as ex:
+            # the failed phase reports the error
+            future.set_exception(ex)
+            return
+
+        phase = self.begin(name)
+        try:
+            result = func()
+        except BaseException as ex:
+            phase.finished = time.monotonic()
+            phase.error = repr(ex)
+            future.set_exception(ex)
+        else:
+            phase.finished = time.monotonic()
+            future.set_result(result)
+
+    def start(self, name, func, after=()):
+        """Run func() as phase name on a new thread, once the phases named in after are done."""
+        future = self.futures[name] = Future()
+        threading.Thread(target=self.execute, args=(name, func, future, after), name='startup-' + name,
+                         daemon=True).start()
+        return future
+
+    def run(self, name, func):
+        """Run func() as phase name in this thread and return its result."""
+        future = self.futures[name] = Future()
+        self.execute(name, func, future)
+        return future.result()
+
+    def result(self, name, timeout=None):
+        return self.futures[name].result(timeout)
+
+    def report(self):
+        with self.lock:
+            phases = list(self.phases.values())
+        return [{
+            'phase': p.name,
+            'start_s': round(p.started - self.t0, 3),
+            'end_s': round(p.finished - self.t0, 3) if p.finished is not None else None,
+            'duration_s': round(p.finished - p.started, 3) if p.finished is not None else None,
+            'thread': p.thread,
+            'error': p.error,
+        } for p in phases]
+
+    def elapsed(self):
+        return time.monotonic() - self.t0
+
+    def log_report(self):
+        report = self.report()
+        for p in report:
+            runlog.warning("**** Startup %-12s %7.3f s -> %7s s  (%s s)%s" %
+                           (p['phase'], p['start_s'], '%.3f' % p['end_s'] if p['end_s'] is not None else '-',
+                            '%.3f' % p['duration_s'] if p['duration_s'] is not None else '-',
+                            ' failed: ' + p['error'] if p['error'] else ''))
+        serial = sum(p['duration_s'] or 0.0 for p in report)
+        runlog.warning("**** Startup took %.3f s (phases add up to %.3f s)" % (self.elapsed(), serial))
+
+    def write_report(self, path):
+        with open(path, 'w') as f:
+            json.dump({'elapsed_s': round(self.elapsed(), 3), 'phases': self.report()}, f, indent=1)
@@ -0,0 +1,106 @@
+# SQLite sink for the per-frame stats dictionary.
+#
+# Replaces the one -stats.csv per frame written by the main loop: rows are
+# buffered in memory and committed in batched transactions to a single
+# database in WAL mode. Columns are added as new keys show up in the stats
+# dictionary, so adding a sensor does not need a schema change.
+#
+#   store = StatsStore(output_dir + '/stats.db')
+#   store.add(counter, time.time(), stats)
+#   ...
+#   store.close()    # flushes whatever is still buffered
+#
+# Reading a run back is one indexed query:
+#   SELECT timestamp, wx_temp_air_c, RelativeHumidity FROM stats WHERE timestamp BETWEEN ? AND ?
+#
+
+import time
+import sqlite3
+
+# Logging and print statements
+import logging
+runlog = logging.getLogger()
+
+DB_NAME = 'stats.db'
+
+# commit after this many rows or this many seconds, whichever comes first
+BATCH_ROWS = 12
+BATCH_SECONDS = 60.0
+
+def quote(name):
+    return '"%s"' % str(name).replace('"', '""')
+
+class StatsStore:
+    """Buffers stats rows and commits them in batches to a WAL-mode SQLite database."""
+
+    def __init__(self, path, batch_rows=BATCH_ROWS, batch_seconds=BATCH_SECONDS):
+        self.path = path
+        self.batch_rows = batch_rows
+        self.batch_seconds = batch_seconds
+        self.buffer = []
+        self.last_flush = time.monotonic()
+
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS stats (counter INTEGER, timestamp REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS stats_counter ON stats (counter)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS stats_timestamp ON stats (timestamp)')
+        self.db.commit()
+
+        self.columns = self.read_columns()
+
+    def read_columns(self):
+        return [row[1] for row in self.db.execute('PRAGMA table_info(stats)')]
+
+    def add(self, counter, timestamp, stats):
+        """Buffer one row; values are copied so the caller can keep mutating stats."""
+        row = dict(stats)
+        row['counter'] = counter
+        row['timestamp'] = timestamp
+        self.buffer.append(row)
+
+        if (len(self.buffer) >= self.batch_rows or
+                time.monotonic() - self.last_flush >= self.batch_seconds):
+            self.flush()
+
+    def flush(self):
+        """Commit all buffered rows in one transaction."""
+        self.last_flush = time.monotonic()
+        if not self.buffer:
+            return
+
+        rows, self.buffer = self.buffer, []
+
+        with self.db:
+            for row in rows:
+                for key in row:
+                    if key not in self.columns:
+                        self.db.execute('ALTER TABLE stats ADD COLUMN %s' % quote(key))
+                        self.columns.append(key)
+
+            # rows with the same keys share one executemany
+            groups = {}
+            for row in rows:
+                groups.setdefault(tuple(row), []).append(tuple(row.values()))
+
+            for keys, values in groups.items():
+                sql = 'INSERT INTO stats (%s) VALUES (%s)' % (
+                    ', '.join(quote(k) for k in keys), ', '.join('?' * len(keys)))
+                self.db.executemany(sql, values)
+
+    def close(self):
+        try:
+            self.flush()
+        except sqlite3.Error as ex:
+            runlog.warning("Could not write stats: %s" % ex)
+        self.db.close()
+
+def read_rows(path):
+    """All rows of a stats database as dicts keyed by frame counter."""
+    db = sqlite3.connect('file:%s?mode=ro' % path, uri=True)
+    db.row_factory = sqlite3.Row
+    try:
+        return {row['counter']: dict(row) for row in db.execute('SELECT * FROM stats ORDER BY counter')}
+    finally:
+        db.close()
@@ -0,0 +1,55 @@
+# TC-08 stream log format.
+#
+# In streaming mode (thermocouple_control.TC08Stream) every complete
+# reading of the six channels is appended to tc08-stream.bin in the
+# results directory as one fixed-size record:
+#   device_ms   i8     milliseconds since usb_tc08_run on the unit's clock
+#   timestamp   f8     host time of the reading (unix seconds)
+#   values      6 x f4 channels in CHANNEL_NAMES order, NaN if missing
+#
+# Kept apart from thermocouple_control so the log can be read without the
+# Pico SDK, e.g. by reprocess.py:
+#
+#   log = read_stream_log('results_231020-142501/tc08-stream.bin')
+#   black = window_means(log, frame_times, 1.0)[:, CHANNEL_NAMES.index('tc_black_c')]
+#
+
+import os
+
+import numpy as np
+
+LOG_NAME = 'tc08-stream.bin'
+
+# 1 = soil1, 2 = soil2, 3 = soil3, 5 = ambient, 6 = light sensor, 8 = black ref
+CHANNELS = (1, 2, 3, 5, 6, 8)
+CHANNEL_NAMES = ('tc_soil1_c', 'tc_soil2_c', 'tc_soil3_c', 'tc_amb_c', 'ppfd_mV', 'tc_black_c')
+
+STREAM_DTYPE = np.dtype([('device_ms', '<i8'), ('timestamp', '<f8'), ('values', '<f4', (len(CHANNELS),))])
+
+def read_stream_log(path):
+    """Read a stream log as a STREAM_DTYPE array, dropping a trailing partial record."""
+    count = os.path.getsize(path) // STREAM_DTYPE.itemsize
+    return np.fromfile(path, dtype=STREAM_DTYPE, count=count)
+
+def window_means(log, centers, half_width=1.0):
+    """Mean of every channel over center +- half_width for many centers at once.
+
+    log is a STREAM_DTYPE array in time order; returns (len(centers),
+    channels) float64, NaN for windows without readings. One searchsorted
+    and a cumulative sum, so it is cheap for a whole run of frames.
+    """
+    centers = np.asarray(centers, dtype=np.float64)
+    values = log['values'].astype(np.float64)
+    valid = ~np.isnan(values)
+
+    # cumulative sums with a leading zero row, so a window is a difference
+    sums = np.zeros((len(log) + 1, values.shape[1]))
+    counts = np.zeros((len(log) + 1, values.shape[1]))
+    np.cumsum(np.where(valid, values, 0.0), axis=0, out=sums[1:])
+    np.cumsum(valid, axis=0, out=counts[1:])
+
+    lo = np.searchsorted(log['timestamp'], centers - half_width, side='left')
+    hi = np.searchsorted(log['timestamp'], centers + half_width, side='right')
+    n = counts[hi] - counts[lo]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(n > 0, (sums[hi] - sums[lo]) / n, np.nan)
@@ -10,52 +10,155 @@
 #
 
 import time
+
+# start of the startup timing report (see startup.py), before the other
+# imports so their time is in the report too
+STARTUP_T0 = time.monotonic()
+
 import os
 import datetime
 import csv
 import atexit
-import save_queue
+import stats_store
+import scheduler
+import sensor_sampler
+import roi_stats
+import burst_average
+import recorder as recorder_module
+import startup as startup_module
+from RadiometricData import RadiometricData
 
 # Logging and print statements
 import logging
 runlog = logging.getLogger()
 runlog.setLevel(logging.NOTSET)
 
+# The heavy imports (PySpin, picosdk through thermocouple_control, and
+# cv2 through save_queue and the visible stream) are made by the startup
+# phase that needs them, so they overlap with the other devices coming up.
+
 ## NO ARAVIS - we are replacing this entirely with Spinnaker
 #gi.require_version('Aravis', '0.4')
 #from gi.repository import Aravis
 # Aravis was the original interface for odroid
 # Spinnaker is our interface for the thermal camera
 # via the raspberry pi.
-import PySpin
+# Set FLIR_SIMULATE to run against the simulators instead (see devices.py).
+import devices
+PySpin = None # devices.pyspin(), imported by find_camera()
 
 ## Thermocouple controller - Pico.
 # Links Rpi w/ soil, humidity, PAR sensors.
 # Also links to reference plate.
-import thermocouple_control as tc
+tc = None # thermocouple_control, imported by init_thermocouples()
+import tc08_log
+import i2c_registry
 
 # Humidity sensor + AtlasI2C
-from AtlasI2C import (
-    AtlasI2C
-)
+AtlasI2C = devices.atlas_i2c()
 
 ## Device Pollers disabled (FOR NOW)
 # We may want the weather poller eventually.
-import webcam_poller
+import device_clock
+
+save_queue = None # imported by init_save_queue()
 
 # Time is recorded using sleep statements.
 # Number of images
 # 25 hours -> number of seconds in 25 hours
 # Take an image every 5 seconds
 #NUMBER_OF_HOURS =  
-NUMBER_OF_MINUTES = 5
-SECONDS_PER_IMAGE = 5
+NUMBER_OF_MINUTES = float(os.environ.get('FLIR_RUN_MINUTES', 5))
+SECONDS_PER_IMAGE = float(os.environ.get('FLIR_SECONDS_PER_IMAGE', 5))
 TOTAL_RUNTIME = (NUMBER_OF_MINUTES*60)/SECONDS_PER_IMAGE
 
+# How frames are written to disk: 'files' (one .npy/.png per image)
+# or 'segments' (appended to large preallocated files, see frame_store.py)
+STORAGE_BACKEND = 'files'
+
+# Lossless infrared frame encoding: 'raw' (.npy), 'zlib-delta', 'lzma-delta',
+# 'bz2-delta', 'png' or 'tiff'; see frame_codecs.py and benchmark.py codecs
+INFRARED_CODEC = 'raw'
+
+# Acquisition: 'interval' grabs one frame every SECONDS_PER_IMAGE, with a
+# NewestOnly stream. 'continuous' records every frame at the camera rate
+# (15 Hz) into the continuous-*.seg store (see recorder.py) on an
+# OldestFirst stream of CONTINUOUS_BUFFER_COUNT buffers, with up to
+# CONTINUOUS_RING_FRAMES frames waiting for the disk; the interval capture
+# then takes the newest recorded frame, so previews, visible images and
+# stats rows are written as before.
+RECORD_MODE = 'interval'
+CONTINUOUS_BUFFER_COUNT = 30
+CONTINUOUS_RING_FRAMES = 64
+CONTINUOUS_CODEC = 'raw'
+
+# Frames averaged into each scheduled sample: BURST_FRAMES consecutive
+# frames are summed as they arrive and their rounded mean is stored in
+# place of a single frame (noise down by sqrt(BURST_FRAMES), see
+# burst_average.py). With BURST_NOISE_MAP the per-pixel std of the burst
+# is saved as well (-infrared-std.npy, or a noise record in segments).
+BURST_FRAMES = 1
+BURST_NOISE_MAP = False
+
+# Save queue budget and what to do when it is full: 'block', 'drop_previews',
+# 'drop_visible' or 'spill' (raw frames go to SPILL_DIR, e.g. the SD card)
+SAVE_QUEUE_MB = 128
+SAVE_QUEUE_POLICY = 'block'
+
+# Save workers: 'threads' in this process, or 'processes' fed through a
+# shared memory frame ring, which keeps PNG encoding off this process's GIL
+SAVE_WORKERS = 'threads'
+SPILL_DIR = os.path.expanduser("~/pftc7_spill")
+
+# Infrared PNG previews: OpenCV colormap name, and an optional extra
+# -infrared-thumb.png downscaled by this factor (None for no thumbnail)
+PREVIEW_COLORMAP = 'OCEAN'
+PREVIEW_THUMBNAIL_SCALE = None
+
+# Periods of the other main loop tasks, in seconds (see scheduler.py)
+STATUS_PERIOD = 12 * SECONDS_PER_IMAGE        # FPS, cadence and free disk log
+CAMERA_PARAM_PERIOD = 12 * SECONDS_PER_IMAGE  # push T and RH to the camera, read calibration
+NUC_PERIOD = 24 * SECONDS_PER_IMAGE
+AUTOFOCUS_PERIOD = 24 * SECONDS_PER_IMAGE
+NUC_SETTLE_TIME = 2
+AUTOFOCUS_SETTLE_TIME = 3
+
+# Sampling periods of the weather board (each read takes 1.5 s) and the
+# TC-08, in seconds; readings older than 3 periods are flagged stale
+WEATHER_SAMPLE_PERIOD = 5
+TC08_SAMPLE_PERIOD = 1
+
+# EZO devices found on the I2C bus are remembered here, so a restart only
+# re-checks them instead of scanning the whole bus (see i2c_registry.py)
+I2C_REGISTRY = os.path.expanduser("~/pftc7_i2c_devices.json")
+
+# Regions of interest summarized in every stats row (see roi_stats.py);
+# without the file only the whole frame is
+ROI_FILE = os.path.expanduser("~/pftc7_rois.json")
+
+# How long startup waits for the first frame of the visible stream
+VISIBLE_READY_TIMEOUT = 2
+
+# TC-08 acquisition: 'single' (one reading per sample period) or 'stream'
+# (the unit samples every TC08_STREAM_INTERVAL_MS, None for its minimum,
+# and every reading is logged; reprocess.py adds per-frame window means)
+TC08_MODE = 'single'
+TC08_STREAM_INTERVAL_MS = None
+
+# Delay of the first frame after the start of the schedule, so frames land
+# after the NUC and autofocus have settled
+CAPTURE_OFFSET = max(NUC_SETTLE_TIME, AUTOFOCUS_SETTLE_TIME) + 0.5
+
+# Where the stats dictionary goes: 'sqlite' (batched into one stats.db,
+# see stats_store.py) or 'csv' (one -stats.csv per frame)
+STATS_BACKEND = 'sqlite'
+
 # Establish result directory for output.
 # Important to note that code should be run directlty off of the USB drive.
+# FLIR_OUTPUT_ROOT overrides the location, e.g. when running on simulators.
+output_root = os.environ.get('FLIR_OUTPUT_ROOT', "/media/ubuntu/FLIRCAM/pftc7_thermal_data")
 output_dir = os.path.expanduser(
-    f"/media/ubuntu/FLIRCAM/pftc7_thermal_data/results_{datetime.datetime.now().strftime('%y%m%d-%H%M%S')}"
+    f"{output_root}/results_{datetime.datetime.now().strftime('%y%m%d-%H%M%S')}"
     )
 
 if not os.path.isdir(output_dir):
@@ -76,26 +179,13 @@ def print_devices(device_list, device):
             print(" - " + i.get_device_info())
     
 def get_devices():
-    device = AtlasI2C()
-    device_address_list = device.list_i2c_devices()
-    device_list = []
-    
-    for i in device_address_list:
-        device.set_i2c_address(i)
-        response = device.query("I")
-        try:
-            moduletype = response.split(",")[1] 
-            response = device.query("name,?").split(",")[1]
-        except IndexError:
-            runlog.warning(f""">> WARNING: device at I1C address {i} has not been identified as an EZO device, and will not be queried""") 
-            continue
-        device_list.append(AtlasI2C(address = i, moduletype = moduletype, name = response))
-    return device_list 
+    return i2c_registry.find_devices(AtlasI2C, I2C_REGISTRY)
 
 def get_rh_temp(dev) -> tuple:
     # Nathan: changing \x00 from \x-01 2023.11.1
+    # "Success <device info>: rh,temp"; the name in the device info may be empty
     return_string = dev.query("R").replace("\x00", "")
-    return_string_1 = return_string.split(" : ")
+    return_string_1 = return_string.split(": ", 1)
     return_string_2 = return_string_1[1].split(",")
 
     rh = float(return_string_2[0])
@@ -108,51 +198,45 @@ def disk_free_bytes():
     free = stats.f_bavail * stats.f_frsize
     return free
 
-runlog.warning("Starting weather board")
-
-try:
-    device_list = get_devices()
-    rh_sensor = device_list[0]
-    runlog.warning("Weather board initialized")
-except:
-    runlog.warning("No weather board found; program exiting")
-    exit()
-    
-get_rh_temp(rh_sensor)
+def init_weather():
+    runlog.warning("Starting weather board")
 
-runlog.warning("Starting thermocouple DAQ board")
-therm = tc.start_thermocouples()
-atexit.register(tc.stop_thermocouples,therm)
+    try:
+        device_list = get_devices()
+        rh_sensor = device_list[0]
+        runlog.warning("Weather board initialized")
+    except:
+        runlog.warning("No weather board found; program exiting")
+        exit()
+
+    get_rh_temp(rh_sensor)
+    return rh_sensor
+
+def init_thermocouples():
+    global tc
+    runlog.warning("Starting thermocouple DAQ board")
+    import thermocouple_control as tc
+    # the unit settles while the other devices come up; the first
+    # reading (on the sampler thread) waits for whatever is left
+    therm = tc.start_thermocouples(wait=False)
+    atexit.register(tc.stop_thermocouples,therm)
+
+    # In 'stream' mode the TC-08 samples continuously; every reading is kept
+    # in tc08-stream.bin (see tc08_log.py)
+    tc_stream = None
+    if TC08_MODE == 'stream':
+        tc_stream = tc.TC08Stream(therm, TC08_STREAM_INTERVAL_MS,
+                                  log_path=os.path.join(output_dir, tc08_log.LOG_NAME))
+        tc_stream.start()
+        atexit.register(tc_stream.stop)
+        runlog.warning("TC-08 streaming every %d ms" % tc_stream.interval_ms)
+
+    return therm, tc_stream
 
 # - - - - - - - - - #
 #    FIND CAMERA    #
 # - - - - - - - - - #
 
-# Finding the thermal camera using the PySpin interface.
-runlog.warning("Finding infrared camera")
-system = PySpin.System.GetInstance()
-
-# Get current library version for PySpin.
-version = system.GetLibraryVersion()
-runlog.warning('PySpin library version: %d.%d.%d.%d' % (version.major, version.minor, version.type, version.build))
-
-# Retrieve list of cameras from the system
-cam_list = system.GetCameras()
-num_cameras = cam_list.GetSize()
-
-if num_cameras == 0:
-    runlog.warning("No camera found; program exiting.")
-    exit()
-elif num_cameras > 1:
-    runlog.warning("Please connect only one camera; program exiting.")
-    exit() 
-
-camera = cam_list.GetByIndex(0)
-nodemap_tldevice = camera.GetTLDeviceNodeMap()
-
-camera.Init()
-nodemap = camera.GetNodeMap()
-
 def print_device_info(nodemap):
     """
     This function prints the device information of the camera from the transport
@@ -187,115 +271,229 @@ def print_device_info(nodemap):
 
     return result
 
-print_device_info(nodemap_tldevice)
+def find_camera():
+    global PySpin
+    PySpin = devices.pyspin()
+    import webcam_poller
+
+    # Finding the thermal camera using the PySpin interface.
+    runlog.warning("Finding infrared camera")
+    system = PySpin.System.GetInstance()
+
+    # Get current library version for PySpin.
+    version = system.GetLibraryVersion()
+    runlog.warning('PySpin library version: %d.%d.%d.%d' % (version.major, version.minor, version.type, version.build))
+
+    # Retrieve list of cameras from the system
+    cam_list = system.GetCameras()
+    num_cameras = cam_list.GetSize()
+
+    if num_cameras == 0:
+        runlog.warning("No camera found; program exiting.")
+        exit()
+    elif num_cameras > 1:
+        runlog.warning("Please connect only one camera; program exiting.")
+        exit() 
+
+    camera = cam_list.GetByIndex(0)
+    nodemap_tldevice = camera.GetTLDeviceNodeMap()
+
+    print_device_info(nodemap_tldevice)
+
+    # read here, so the visible stream can connect while the camera is set up
+    visible_url = webcam_poller.stream_url(nodemap_tldevice)
+    return system, cam_list, camera, nodemap_tldevice, visible_url
 
 # - - - - - - - - - - - #
 #    CAMERA SETTINGS    #
 # - - - - - - - - - - - #
 
-runlog.warning("Initializing image capture settings")
-
-vid_src = PySpin.CEnumerationPtr(nodemap.GetNode('VideoSourceSelector'))
-vid_src_visual = vid_src.GetEntryByName("IR")
-vid_src.SetIntValue(vid_src_visual.GetValue())
-
-# Set Pixel format to Mono16
-node_pixel_format = PySpin.CEnumerationPtr(nodemap.GetNode('PixelFormat'))
-node_pixel_format_mono16 = node_pixel_format.GetEntryByName("Mono16")
-node_pixel_format.SetIntValue(node_pixel_format_mono16.GetValue())
-
-# Set IR Pixel format to 0.01K Tlinear (IRFormat = "TemperatureLinear10mK")
-node_IRFormat = PySpin.CEnumerationPtr(nodemap.GetNode('IRFormat'))
-node_IRFormat_TL10mK = node_IRFormat.GetEntryByName("Radiometric")
-node_IRFormat.SetIntValue(node_IRFormat_TL10mK.GetValue())
-
-# Set IR frame rate to 15 Hz (IRFrameRate = "Rate15Hz")
-node_IRframerate = PySpin.CEnumerationPtr(nodemap.GetNode('IRFrameRate'))
-node_IRframerate_15Hz = node_IRframerate.GetEntryByName("Rate15Hz")
-node_IRframerate.SetIntValue(node_IRframerate_15Hz.GetValue())
-
-# Set OffsetX and OffsetY = 0
-node_OffsetX = PySpin.CIntegerPtr(nodemap.GetNode('OffsetX'))
-node_OffsetX.SetValue(0)
-node_OffsetY = PySpin.CIntegerPtr(nodemap.GetNode('OffsetY'))
-node_OffsetY.SetValue(0)
-
-# Set Height = 480 and Width = 640
-node_Height = PySpin.CIntegerPtr(nodemap.GetNode('Height'))
-node_Height.SetValue(480)
-node_Width = PySpin.CIntegerPtr(nodemap.GetNode('Width'))
-node_Width.SetValue(640)
-
-# Grab nodes used later to perform autofocus and non-uniformity corrections
-nuc_node = PySpin.CCommandPtr(nodemap.GetNode("NUCAction"))
-auto_focus_node = PySpin.CCommandPtr(nodemap.GetNode("AutoFocus"))
-
-node_NUCMode = PySpin.CEnumerationPtr(nodemap.GetNode('NUCMode'))
-node_NUCMode_Off = node_NUCMode.GetEntryByName("Off")
-node_NUCMode.SetIntValue(node_NUCMode_Off.GetValue())
-
-node_AutoFocusMethod = PySpin.CEnumerationPtr(nodemap.GetNode('AutoFocusMethod'))
-node_AutoFocusMethod_Fine = node_AutoFocusMethod.GetEntryByName("Fine")
-node_AutoFocusMethod.SetIntValue(node_AutoFocusMethod_Fine.GetValue())
-
-runlog.warning("Setting acquisition mode to continuous")
-node_acquisition_mode = PySpin.CEnumerationPtr(nodemap.GetNode('AcquisitionMode'))
-if not PySpin.IsAvailable(node_acquisition_mode) or not PySpin.IsWritable(node_acquisition_mode):
-    runlog.warning('Unable to set acquisition mode to continuous (enum retrieval). Aborting...')
-    exit()
-
-# Retrieve entry node from enumeration node
-node_acquisition_mode_continuous = node_acquisition_mode.GetEntryByName('Continuous')
-if not PySpin.IsAvailable(node_acquisition_mode_continuous) or not PySpin.IsReadable(node_acquisition_mode_continuous):
-    runlog.warning('Unable to set acquisition mode to continuous (entry retrieval). Aborting...')
-    exit()
-
-# Retrieve integer value from entry node
-acquisition_mode_continuous = node_acquisition_mode_continuous.GetValue()
-
-# Set integer value from entry node as new value of enumeration node
-node_acquisition_mode.SetIntValue(acquisition_mode_continuous)
-
-# Set buffer handling mode to "NewestOnly" - this prevents image delays
-s_node_map = camera.GetTLStreamNodeMap()
-
-handling_mode = PySpin.CEnumerationPtr(s_node_map.GetNode('StreamBufferHandlingMode'))
-if not PySpin.IsAvailable(handling_mode) or not PySpin.IsWritable(handling_mode):
-    runlog.warning('Unable to set Buffer Handling mode (node retrieval). Aborting...\n')
-    exit()
-
-handling_mode_entry = PySpin.CEnumEntryPtr(handling_mode.GetCurrentEntry())
-if not PySpin.IsAvailable(handling_mode_entry) or not PySpin.IsReadable(handling_mode_entry):
-    runlog.warning('Unable to set Buffer Handling mode (Entry retrieval). Aborting...\n')
-    exit()
-
-handling_mode_entry = handling_mode.GetEntryByName('NewestOnly')
-handling_mode.SetIntValue(handling_mode_entry.GetValue())
-runlog.warning('Buffer Handling Mode has been set to %s' % handling_mode_entry.GetDisplayName())
-
-runlog.warning("Start thermal acquisition")
-camera.BeginAcquisition()
-
-runlog.warning("Creating save queue")
-save_queue.initialize_queue()
-
-# set up web cam
-runlog.warning("Finding visible camera")
-
-try:
-    wcp = webcam_poller.WebcamPoller(nodemap_tldevice)
-    wcp.daemon = True
-    wcp.start()
-    time.sleep(1)
-    runlog.warning("Visible camera setup complete")
-except:
-    runlog.warning("No visible camera found, exiting")
-    exit()
+def setup_camera():
+    camera = startup.result('camera')[2]
+    camera.Init()
+    nodemap = camera.GetNodeMap()
+
+    runlog.warning("Initializing image capture settings")
+
+    vid_src = PySpin.CEnumerationPtr(nodemap.GetNode('VideoSourceSelector'))
+    vid_src_visual = vid_src.GetEntryByName("IR")
+    vid_src.SetIntValue(vid_src_visual.GetValue())
+
+    # Set Pixel format to Mono16
+    node_pixel_format = PySpin.CEnumerationPtr(nodemap.GetNode('PixelFormat'))
+    node_pixel_format_mono16 = node_pixel_format.GetEntryByName("Mono16")
+    node_pixel_format.SetIntValue(node_pixel_format_mono16.GetValue())
+
+    # Set IR Pixel format to 0.01K Tlinear (IRFormat = "TemperatureLinear10mK")
+    node_IRFormat = PySpin.CEnumerationPtr(nodemap.GetNode('IRFormat'))
+    node_IRFormat_TL10mK = node_IRFormat.GetEntryByName("Radiometric")
+    node_IRFormat.SetIntValue(node_IRFormat_TL10mK.GetValue())
+
+    # Set IR frame rate to 15 Hz (IRFrameRate = "Rate15Hz")
+    node_IRframerate = PySpin.CEnumerationPtr(nodemap.GetNode('IRFrameRate'))
+    node_IRframerate_15Hz = node_IRframerate.GetEntryByName("Rate15Hz")
+    node_IRframerate.SetIntValue(node_IRframerate_15Hz.GetValue())
+
+    # Set OffsetX and OffsetY = 0
+    node_OffsetX = PySpin.CIntegerPtr(nodemap.GetNode('OffsetX'))
+    node_OffsetX.SetValue(0)
+    node_OffsetY = PySpin.CIntegerPtr(nodemap.GetNode('OffsetY'))
+    node_OffsetY.SetValue(0)
+
+    # Set Height = 480 and Width = 640
+    node_Height = PySpin.CIntegerPtr(nodemap.GetNode('Height'))
+    node_Height.SetValue(480)
+    node_Width = PySpin.CIntegerPtr(nodemap.GetNode('Width'))
+    node_Width.SetValue(640)
+
+    # Grab nodes used later to perform autofocus and non-uniformity corrections
+    nuc_node = PySpin.CCommandPtr(nodemap.GetNode("NUCAction"))
+    auto_focus_node = PySpin.CCommandPtr(nodemap.GetNode("AutoFocus"))
+
+    node_NUCMode = PySpin.CEnumerationPtr(nodemap.GetNode('NUCMode'))
+    node_NUCMode_Off = node_NUCMode.GetEntryByName("Off")
+    node_NUCMode.SetIntValue(node_NUCMode_Off.GetValue())
+
+    node_AutoFocusMethod = PySpin.CEnumerationPtr(nodemap.GetNode('AutoFocusMethod'))
+    node_AutoFocusMethod_Fine = node_AutoFocusMethod.GetEntryByName("Fine")
+    node_AutoFocusMethod.SetIntValue(node_AutoFocusMethod_Fine.GetValue())
+
+    runlog.warning("Setting acquisition mode to continuous")
+    node_acquisition_mode = PySpin.CEnumerationPtr(nodemap.GetNode('AcquisitionMode'))
+    if not PySpin.IsAvailable(node_acquisition_mode) or not PySpin.IsWritable(node_acquisition_mode):
+        runlog.warning('Unable to set acquisition mode to continuous (enum retrieval). Aborting...')
+        exit()
+
+    # Retrieve entry node from enumeration node
+    node_acquisition_mode_continuous = node_acquisition_mode.GetEntryByName('Continuous')
+    if not PySpin.IsAvailable(node_acquisition_mode_continuous) or not PySpin.IsReadable(node_acquisition_mode_continuous):
+        runlog.warning('Unable to set acquisition mode to continuous (entry retrieval). Aborting...')
+        exit()
+
+    # Retrieve integer value from entry node
+    acquisition_mode_continuous = node_acquisition_mode_continuous.GetValue()
+
+    # Set integer value from entry node as new value of enumeration node
+    node_acquisition_mode.SetIntValue(acquisition_mode_continuous)
+
+    # Set buffer handling mode to "NewestOnly" - this prevents image delays.
+    # Continuous recording needs every frame instead: "OldestFirst"
+    s_node_map = camera.GetTLStreamNodeMap()
+    buffer_handling = 'OldestFirst' if RECORD_MODE == 'continuous' else 'NewestOnly'
+
+    handling_mode = PySpin.CEnumerationPtr(s_node_map.GetNode('StreamBufferHandlingMode'))
+    if not PySpin.IsAvailable(handling_mode) or not PySpin.IsWritable(handling_mode):
+        runlog.warning('Unable to set Buffer Handling mode (node retrieval). Aborting...\n')
+        exit()
+
+    handling_mode_entry = PySpin.CEnumEntryPtr(handling_mode.GetCurrentEntry())
+    if not PySpin.IsAvailable(handling_mode_entry) or not PySpin.IsReadable(handling_mode_entry):
+        runlog.warning('Unable to set Buffer Handling mode (Entry retrieval). Aborting...\n')
+        exit()
+
+    handling_mode_entry = handling_mode.GetEntryByName(buffer_handling)
+    handling_mode.SetIntValue(handling_mode_entry.GetValue())
+    runlog.warning('Buffer Handling Mode has been set to %s' % handling_mode_entry.GetDisplayName())
+
+    if RECORD_MODE == 'continuous':
+        recorder_module.set_buffer_count(s_node_map, CONTINUOUS_BUFFER_COUNT)
+
+    # calibration nodes, resolved once; versions go to calibration.jsonl
+    import camera_params
+    cam_params = camera_params.CameraParams(nodemap, log_path=os.path.join(output_dir, camera_params.LOG_NAME))
+
+    runlog.warning("Start thermal acquisition")
+    camera.BeginAcquisition()
+    return nodemap, nuc_node, auto_focus_node, cam_params
+
+def init_visible():
+    import webcam_poller
+    nodemap_tldevice, visible_url = startup.result('camera')[3:]
+
+    # set up web cam
+    runlog.warning("Finding visible camera")
+
+    try:
+        wcp = webcam_poller.WebcamPoller(nodemap_tldevice, visible_url)
+        wcp.daemon = True
+        wcp.start()
+    except:
+        runlog.warning("No visible camera found, exiting")
+        exit()
+
+    if wcp.wait_ready(VISIBLE_READY_TIMEOUT):
+        runlog.warning("Visible camera setup complete")
+    else:
+        runlog.warning("Visible camera has not sent a frame after %.1f s" % VISIBLE_READY_TIMEOUT)
+    return wcp
+
+def init_save_queue():
+    global save_queue
+    runlog.warning("Creating save queue")
+    import save_queue
+    save_queue.initialize_queue(STORAGE_BACKEND, output_dir,
+                                max_bytes=SAVE_QUEUE_MB * 1024 * 1024,
+                                policy=SAVE_QUEUE_POLICY, spill_dir=SPILL_DIR,
+                                colormap=PREVIEW_COLORMAP, thumbnail=PREVIEW_THUMBNAIL_SCALE,
+                                processes=(SAVE_WORKERS == 'processes'), codec=INFRARED_CODEC)
+
+# - - - - - - - - - #
+#      STARTUP      #
+# - - - - - - - - - #
+
+# The devices do not depend on each other, so each is brought up in its
+# own phase on its own thread; only the visible stream and the camera
+# settings wait for the camera to be found. The timing of every phase is
+# logged and written to startup.json.
+startup = startup_module.Startup(STARTUP_T0)
+
+if SAVE_WORKERS == 'processes':
+    # the save workers are forked, so they are created before any other
+    # thread exists
+    startup.run('save_queue', init_save_queue)
+
+startup.start('weather', init_weather)
+startup.start('tc08', init_thermocouples)
+startup.start('camera', find_camera)
+startup.start('camera_setup', setup_camera, after=('camera',))
+startup.start('visible', init_visible, after=('camera',))
+if SAVE_WORKERS != 'processes':
+    startup.start('save_queue', init_save_queue)
+
+if STATS_BACKEND == 'sqlite':
+    stats_db = stats_store.StatsStore(os.path.join(output_dir, stats_store.DB_NAME))
+    atexit.register(stats_db.close)
+
+# a phase that failed (or called exit()) raises here
+rh_sensor = startup.result('weather')
+therm, tc_stream = startup.result('tc08')
+system, cam_list, camera, nodemap_tldevice, visible_url = startup.result('camera')
+nodemap, nuc_node, auto_focus_node, cam_params = startup.result('camera_setup')
+wcp = startup.result('visible')
+startup.result('save_queue')
+
+startup.log_report()
+startup.write_report(os.path.join(output_dir, 'startup.json'))
+
+recorder = None
+if RECORD_MODE == 'continuous':
+    recorder = recorder_module.Recorder(camera, output_dir, CONTINUOUS_RING_FRAMES, CONTINUOUS_CODEC)
+    recorder.start()
+    runlog.warning("Recording every frame to %s-*.seg" % recorder_module.STORE_NAME)
+
+# per-ROI temperature statistics, converted with the current calibration
+rois = roi_stats.RoiStats.from_file(ROI_FILE)
+radiometric = RadiometricData()
+radiometric_version = None
+
+# running sums of the frames of a burst, sized on the first frame
+burst = None
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 runlog.warning("Entering main loop")
 counter = 0
+ir_clock = device_clock.DeviceClock()
 time_start = time.time()
 
 # Stats dictionary will hold all recorded variables
@@ -303,162 +501,276 @@ time_start = time.time()
 # will be written as csv data.
 stats = {}
 
-program_running = True
-program_throttled = True
-
-# In the future, may be nice to have a way
-# to pause the program. This functionality does not work.
-program_paused = False
+# Frames captured before this (monotonic) time are flagged in the stats,
+# since the camera is still settling after a NUC or autofocus
+settling_until = 0.0
 
 # TODO: It might be nice to have a section where you can specify how you want acquisition to
 # occur - e.g. continuous until an exit code is pressed, or for a fixed time or a fixed
-# number of frames. It would also be nice to specify somewhere the desired framerate.
+# number of frames.
 # Nathan: ideally, this could be done at the beginning of the file or with a pi.config file.
 
-while counter < (TOTAL_RUNTIME):
-    # For now, hit ctrl-C to stop the loop.
-    # We'll make something more elegant later.
-
-    if program_throttled:
-        time.sleep(5) # Sleep time of 5 seconds           
-    
-    if program_paused:
-        time.sleep(1)
+def log_status():
+    fps = counter / (time.time() - time_start)
+    runlog.warning("**** FPS = %.3f" % fps)
+    sched.log_report()
+    save_queue.save_queue.log_metrics()
+    wcp.log_metrics()
+    if recorder is not None:
+        recorder.log_metrics()
+    cam_params.log_status()
+    sensors.log_status()
+    if tc_stream is not None:
+        tc_stream.log_status()
+    for command, (count, p50, p95, slowest) in rh_sensor.latency_stats().items():
+        runlog.warning("**** EZO %s: %s response p50 %.3f s p95 %.3f s max %.3f s over %d queries" %
+                       (rh_sensor.moduletype, command, p50, p95, slowest, count))
+
+    freedisk_gb = float(disk_free_bytes()) / 1024 / 1024 / 1024
+    runlog.warning("**** Free: %.2f GB" % freedisk_gb)
+
+    if freedisk_gb < 0.5:
+        runlog.warning("Exiting, disk full")
+        sched.stop()
+
+def settle(seconds):
+    global settling_until
+    settling_until = max(settling_until, time.monotonic() + seconds)
+
+def run_nuc():
+    runlog.warning('Non-uniformity correction')
+    nuc_node.Execute()
+    settle(NUC_SETTLE_TIME)
+
+def run_autofocus():
+    runlog.warning('Autofocus')
+    auto_focus_node.Execute()
+    settle(AUTOFOCUS_SETTLE_TIME)
+    sched.call_later(AUTOFOCUS_SETTLE_TIME, set_object_distance)
+
+def set_object_distance():
+    distance = cam_params.read('FocusDistance')
+    cam_params.set('ObjectDistance', distance)
+    runlog.warning("Setting object distance to %f meters" % distance)
+
+# get weather stats
+PPFD_CALIB = 239.34 # for the PAR sensor
+
+def read_weather():
+    wx_rh, wx_temp = get_rh_temp(rh_sensor)
+    return {'wx_temp_air_c': wx_temp, 'wx_rel_hum': wx_rh/100.0}
+
+def read_tc08():
+    if tc_stream is not None:
+        tc_stream.drain()
+        latest, _ = tc_stream.latest()
+        if latest is None:
+            return None
+        readings = [latest[name] for name in tc.CHANNEL_NAMES]
     else:
-        if counter % 12 == 0:
-            fps = counter / (time.time() - time_start)
-            runlog.warning("**** FPS = %.3f" % fps)
-
-            freedisk_gb = float(disk_free_bytes()) / 1024 / 1024 / 1024
-            runlog.warning("**** Free: %.2f GB" % freedisk_gb)
-
-            if freedisk_gb < 0.5:
-                runlog.warning("Exiting, disk full")
-                exit()
-
-        if counter % 24 == 0:
-            runlog.warning('Non-uniformity correction')
-            nuc_node.Execute()
-            time.sleep(2)
-
-        if counter % 24 == 0:
-            runlog.warning('Autofocus')
-            auto_focus_node.Execute()
-            time.sleep(3)
-            distance = PySpin.CFloatPtr(nodemap.GetNode('FocusDistance')).GetValue()
-            PySpin.CFloatPtr(nodemap.GetNode('ObjectDistance')).SetValue(distance)
-            runlog.warning("Setting object distance to %f meters" % distance)
-
-        # get weather stats     
-        LOG_FREQ = 1
-        PPFD_CALIB = 239.34 # for the PAR sensor
-
-        if counter % LOG_FREQ == 0:
-            runlog.warning("Measuring ambient temperature and humidity")
-
-            try:
-                wx_rh, wx_temp = get_rh_temp(rh_sensor)
-                stats['wx_temp_air_c'] = wx_temp
-                stats['wx_rel_hum'] = wx_rh/100.0
-            except:
-                stats['wx_temp_air_c'] = -999
-                stats['wx_rel_hum'] = -999
-                runlog.warning("Error reading RH and T")
-            
-            [   tc_soil1_c,
-                tc_soil2_c,
-                tc_soil3_c,
-                tc_amb_c,
-                ppfd_mV,
-                tc_black_c
-             ] = tc.read_thermocouples(therm)
-
-            ## Option for recording data from soil sensors
-            #stats['tc_soil2_c'] = tc_soil2_c
-            #stats['tc_soil3_c'] = tc_soil3_c
-            stats['tc_amb_c'] = tc_amb_c
-            stats['tc_black_c'] = tc_black_c
-            stats['ppfd_mV_raw'] = ppfd_mV
-            stats['ppfd_umol_m2_s'] = ppfd_mV * PPFD_CALIB
-            stats['tc_soil1_c'] = tc_soil1_c
-
-        # get current date
-        stats['Date'] = datetime.datetime.now().strftime('%y%m%d-%H%M%S')
-
-        if counter % 12 == 0:
-            runlog.warning("Adjusting camera settings based on current T and RH")
-            try:
-                stat_atm_temp = float(stats['wx_temp_air_c']) + 273.15
-                PySpin.CFloatPtr(nodemap.GetNode('AtmosphericTemperature')).SetValue(stat_atm_temp)            
-            except:
-                stat_atm_temp = -999
-                runlog.warning("Temperature error")
-
-            try:
-                stat_atm_rh  = float(stats['wx_rel_hum'])
-                PySpin.CFloatPtr(nodemap.GetNode('RelativeHumidity')).SetValue(stat_atm_rh)
-            except:
-                stat_atm_rh = -999
-                runlog.warning("RH error")
-                
-        # get camera stats every twelth iteration
-        if counter % 12 == 0:
-            stats['AtmosphericTemperature'] = PySpin.CFloatPtr(nodemap.GetNode("AtmosphericTemperature")).GetValue()
-            stats['EstimatedTransmission'] = PySpin.CFloatPtr(nodemap.GetNode("EstimatedTransmission")).GetValue()
-            stats['ExtOpticsTemperature'] = PySpin.CFloatPtr(nodemap.GetNode("ExtOpticsTemperature")).GetValue()
-            stats['ExtOpticsTransmission'] = PySpin.CFloatPtr(nodemap.GetNode("ExtOpticsTransmission")).GetValue()
-            stats['ObjectDistance'] = PySpin.CFloatPtr(nodemap.GetNode("ObjectDistance")).GetValue()
-            stats['ObjectEmissivity'] = PySpin.CFloatPtr(nodemap.GetNode("ObjectEmissivity")).GetValue()
-            stats['ReflectedTemperature'] = PySpin.CFloatPtr(nodemap.GetNode("ReflectedTemperature")).GetValue()
-            stats['RelativeHumidity'] = PySpin.CFloatPtr(nodemap.GetNode("RelativeHumidity")).GetValue()
-            stats['FocusDistance'] = PySpin.CFloatPtr(nodemap.GetNode("FocusDistance")).GetValue()
-            stats['TSens'] = PySpin.CFloatPtr(nodemap.GetNode("TSens")).GetValue()
-            stats['alpha1'] = PySpin.CFloatPtr(nodemap.GetNode("alpha1")).GetValue()
-            stats['alpha2'] = PySpin.CFloatPtr(nodemap.GetNode("alpha2")).GetValue()
-            stats['B'] = PySpin.CFloatPtr(nodemap.GetNode("B")).GetValue()
-            stats['beta1'] = PySpin.CFloatPtr(nodemap.GetNode("beta1")).GetValue()
-            stats['beta2'] = PySpin.CFloatPtr(nodemap.GetNode("beta2")).GetValue()
-            stats['F'] = PySpin.CFloatPtr(nodemap.GetNode("F")).GetValue()
-            stats['J0'] = PySpin.CIntegerPtr(nodemap.GetNode("J0")).GetValue()
-            stats['J1'] = PySpin.CFloatPtr(nodemap.GetNode("J1")).GetValue()
-            stats['R'] = PySpin.CFloatPtr(nodemap.GetNode("R")).GetValue()
-            stats['X'] = PySpin.CFloatPtr(nodemap.GetNode("X")).GetValue()
-
-        fileprefix = '%s/out_%s_%d' % (output_dir, stats['Date'], counter)
-        runlog.warning("Setting output location %s" % fileprefix)
-
-        image_result = camera.GetNextImage(1000)
-
-        if image_result.IsIncomplete():
-            print('Image incomplete with image status %d ...' % image_result.GetImageStatus())
+        readings = tc.read_thermocouples(therm)
+
+    [   tc_soil1_c,
+        tc_soil2_c,
+        tc_soil3_c,
+        tc_amb_c,
+        ppfd_mV,
+        tc_black_c
+     ] = readings
+
+    ## Option for recording data from soil sensors
+    #'tc_soil2_c': tc_soil2_c,
+    #'tc_soil3_c': tc_soil3_c,
+    return {
+        'tc_amb_c': tc_amb_c,
+        'tc_black_c': tc_black_c,
+        'ppfd_mV_raw': ppfd_mV,
+        'ppfd_umol_m2_s': ppfd_mV * PPFD_CALIB,
+        'tc_soil1_c': tc_soil1_c,
+    }
+
+# The weather board and the TC-08 are read on their own threads (see
+# sensor_sampler.py); the loop only takes the latest readings
+sensors = sensor_sampler.SensorSampling()
+sensors.add('wx', WEATHER_SAMPLE_PERIOD, read_weather, keys=('wx_temp_air_c', 'wx_rel_hum'))
+sensors.add('tc', TC08_SAMPLE_PERIOD, read_tc08,
+            keys=('tc_amb_c', 'tc_black_c', 'ppfd_mV_raw', 'ppfd_umol_m2_s', 'tc_soil1_c'))
+
+def update_camera_params():
+    runlog.warning("Adjusting camera settings based on current T and RH")
+    weather = sensors.snapshot()
+    if weather['wx_stale']:
+        runlog.warning("Weather reading is stale (age %s s)" % weather['wx_age_s'])
 
-        else:
-            runlog.warning('Reading infrared image data')
-            data_infrared = image_result.GetNDArray()
+    try:
+        cam_params.set('AtmosphericTemperature', float(weather['wx_temp_air_c']) + 273.15)
+    except:
+        runlog.warning("Temperature error")
 
-            runlog.warning('Reading visible image data')
-            image_visible = wcp.im.copy()       
+    try:
+        cam_params.set('RelativeHumidity', float(weather['wx_rel_hum']))
+    except:
+        runlog.warning("RH error")
+
+    # get camera stats: frames refer to the calibration version, whose
+    # values are in calibration.jsonl
+    calibration = cam_params.snapshot()
+    runlog.warning("Calibration version %d" % calibration.version)
+
+def temperature_table():
+    """Count -> degrees C table for the calibration currently in effect."""
+    global radiometric_version
+    if cam_params.version != radiometric_version:
+        radiometric_version = cam_params.version
+        radiometric.setFromStats(cam_params.current.values)
+    return radiometric.getTempLUT(celsius=True)
+
+def next_infrared():
+    """The next infrared image and the host time it was received."""
+    if recorder is not None:
+        # the newest frame of the continuous recording
+        image_result = recorder.latest_image()
+        return image_result, image_result.received
+    image_result = camera.GetNextImage(1000)
+    return image_result, time.time()
+
+def average_burst():
+    """Sum BURST_FRAMES frames into burst; the first frame ID and the device and host time of each frame used."""
+    global burst
+    frame_id = None
+    frame_ids = set()
+    device_times = []
+    host_times = []
+    for i in range(BURST_FRAMES):
+        image_result, received = next_infrared()
+        try:
+            if image_result.IsIncomplete():
+                print('Image incomplete with image status %d ...' % image_result.GetImageStatus())
+                continue
+            if image_result.GetFrameID() in frame_ids:
+                # the recording gave the same frame again after a timeout
+                runlog.warning('Frame %d is already in the burst, skipped' % image_result.GetFrameID())
+                continue
+            frame_ids.add(image_result.GetFrameID())
+
+            data = image_result.GetNDArray()
+            if burst is None or burst.shape != data.shape:
+                burst = burst_average.BurstAverage(data.shape, noise=BURST_NOISE_MAP)
+            if not host_times:
+                burst.reset()
+                frame_id = image_result.GetFrameID()
+            burst.add(data)
+
+            device_ns = image_result.GetTimeStamp()
+            device_times.append(device_ns)
+            host_times.append(ir_clock.host_time(device_ns, received))
+        finally:
+            # the frame is in the sums, so the camera buffer can go back
+            image_result.Release()
+    return frame_id, device_times, host_times
 
-            runlog.warning("Sending data to queue")
-            save_queue.save_queue.put( (data_infrared, image_visible, fileprefix))
+def capture_frame():
+    global counter
 
-            # Write data from global stats dictionary
-            writer = csv.writer(open(fileprefix + '-stats.csv', 'w'), delimiter=',')
-            writer.writerow(stats.keys())
-            writer.writerow(stats.values())
+    # get current date
+    stats['Date'] = datetime.datetime.now().strftime('%y%m%d-%H%M%S')
+    stats['settling'] = int(time.monotonic() < settling_until)
+    stats['calib_version'] = cam_params.commit()
 
-            runlog.warning("Summarizing data")
-            stat_mean = float(data_infrared.mean()) / (100.0 - 273.15) # Temp conversion 
-            runlog.warning("Mean value = %.3f" % stat_mean)
+    # latest weather and TC-08 readings, with their age and stale flags
+    stats.update(sensors.snapshot())
 
-            image_result.Release()
+    # save queue state, so I/O stalls show up in the data as they happen
+    queue_metrics = save_queue.save_queue.metrics()
+    stats['save_queue_items'] = queue_metrics['depth']
+    stats['save_queue_mb'] = round(queue_metrics['mb_in_flight'], 1)
+    stats['save_queue_dropped'] = (queue_metrics['dropped_previews'] + queue_metrics['dropped_visible'] +
+                                   queue_metrics['lost'])
+    # spilled frames are saved, just in SPILL_DIR
+    stats['save_queue_spilled'] = queue_metrics['spilled']
+
+    # TC-08 readings lost to overflows of the unit's buffer
+    if tc_stream is not None:
+        stats['tc08_lost_readings'] = tc_stream.metrics()['lost_readings']
+
+    fileprefix = '%s/out_%s_%d' % (output_dir, stats['Date'], counter)
+    runlog.warning("Setting output location %s" % fileprefix)
 
-        counter += 1
+    # decode visible frames from just before the infrared capture onwards
+    wcp.arm()
+    frame_id, device_times, host_times = average_burst()
+
+    if not host_times:
+        wcp.disarm()
+
+    else:
+        runlog.warning('Reading infrared image data')
+        data_infrared = burst.mean()
+
+        runlog.warning("Summarizing data")
+        stats.update(rois.stats(data_infrared, temperature_table()))
+        runlog.warning("Mean temperature = %.2f C" % stats['roi_frame_mean_c'])
+
+        # capture times of both frames on the host clock (the middle of the
+        # burst), and the visible frame closest to the infrared one
+        infrared_time = sum(host_times) / len(host_times)
+        stats['ir_frame_id'] = frame_id
+        stats['ir_device_timestamp_ns'] = sum(device_times) // len(device_times)
+        stats['ir_timestamp'] = round(infrared_time, 3)
+        stats['ir_codec'] = save_queue.infrared_codec
+        stats['burst_frames'] = burst.count
+        stats['burst_span_ms'] = round((host_times[-1] - host_times[0]) * 1000, 1)
+
+        runlog.warning('Reading visible image data')
+        image_visible, visible_time = wcp.frame_near(infrared_time)
+        stats['visible_timestamp'] = round(visible_time, 3) if visible_time else None
+        stats['pair_skew_ms'] = round((visible_time - infrared_time) * 1000, 1) if visible_time else None
+
+        # put() copies the mean frame and the noise map, so the burst
+        # buffers can be reused straight away
+        runlog.warning("Sending data to queue")
+        save_queue.save_queue.put( (data_infrared, image_visible, fileprefix, counter, infrared_time, burst.std()))
+
+        # Write data from global stats dictionary
+        if STATS_BACKEND == 'sqlite':
+            stats_db.add(counter, infrared_time, stats)
+        else:
+            with open(fileprefix + '-stats.csv', 'w') as f:
+                writer = csv.writer(f, delimiter=',')
+                writer.writerow(stats.keys())
+                writer.writerow(stats.values())
+
+    counter += 1
+
+# Each task runs on its own period against monotonic deadlines. Tasks due
+# at the same time run in the order they are added here, so the first
+# capture still sees the NUC, autofocus and camera parameters, as in the
+# original loop; sensor data comes from the samplers started here. Frames are offset from the NUC and
+# autofocus so they normally land after the camera has settled.
+# For now, hit ctrl-C to stop the loop.
+sensors.start()
+atexit.register(sensors.stop) # before the TC-08 is closed
+
+sched = scheduler.Scheduler()
+sched.add('status', STATUS_PERIOD, log_status)
+sched.add('nuc', NUC_PERIOD, run_nuc)
+sched.add('autofocus', AUTOFOCUS_PERIOD, run_autofocus)
+sched.add('camera_params', CAMERA_PARAM_PERIOD, update_camera_params, offset=CAPTURE_OFFSET)
+sched.add('capture', SECONDS_PER_IMAGE, capture_frame, offset=CAPTURE_OFFSET)
+
+sched.run(until=lambda: counter >= TOTAL_RUNTIME)
+sched.log_report()
+sched.write_report(os.path.join(output_dir, 'cadence.json'))
 
 # Deinitialize and release all cameras
 # TODO: run garbage collection checking
 # make sure all object references are cleaned up.
 
+if recorder is not None:
+    recorder.stop()
+    recorder.log_metrics()
+    recorder.write_report(os.path.join(output_dir, 'recording.json'))
+
 camera.EndAcquisition()
 camera.DeInit()
 del camera
@@ -466,7 +778,8 @@ cam_list.Clear()
 system.ReleaseInstance()
 runlog.warning("Stopping acquisition")
 
-#queue_close()
+runlog.warning("Waiting for the save queue")
+save_queue.close_queue()
 #closefile()
 #tc.stop_thermocouples(therm)
 exit()
@@ -5,13 +5,33 @@
 
 import time
 import ctypes
+import threading
 import numpy as np
 
-# PICO SDK libraries
-from picosdk.usbtc08 import usbtc08 as tc08
-from picosdk.functions import assert_pico2000_ok
+# Logging and print statements
+import logging
+runlog = logging.getLogger()
 
-def start_thermocouples():
+# Channels read by read_thermocouples and TC08Stream, in the order they
+# are returned: soil1, soil2, soil3, ambient, light sensor, black ref
+from tc08_log import CHANNELS, CHANNEL_NAMES, STREAM_DTYPE
+
+# PICO SDK libraries (or the simulated TC-08, see devices.py)
+import devices
+tc08, assert_pico2000_ok = devices.tc08()
+
+# seconds a unit needs after start_thermocouples before it reads reliably
+SETTLE_TIME = 2
+
+# monotonic time at which each started unit has settled
+settled_at = {}
+
+def start_thermocouples(wait=True):
+    """Open and configure the TC-08.
+
+    With wait=False it returns without waiting for the unit to settle;
+    the first read (or TC08Stream.start) waits for what is left instead.
+    """
     # Create chandle1 and status ready for use
     chandle1 = ctypes.c_int16()
     status = {}
@@ -47,39 +67,198 @@ def start_thermocouples():
     status["get_minimum_interval_ms"] = tc08.usb_tc08_get_minimum_interval_ms(chandle1)
     assert_pico2000_ok(status["get_minimum_interval_ms"])
      
-    time.sleep(2)
+    settled_at[chandle1] = time.monotonic() + SETTLE_TIME
+    if wait:
+        wait_settled(chandle1)
      
     return chandle1
 
+def wait_settled(chandle):
+    remaining = settled_at.get(chandle, 0.0) - time.monotonic()
+    if remaining > 0:
+        time.sleep(remaining)
+
+# buffers for usb_tc08_get_single, reused by every read
+single_temp = (ctypes.c_float * 9)()
+single_overflow = ctypes.c_int16(0)
+
 def read_thermocouples(chandle1):
     status = {}
+    wait_settled(chandle1)
 
     # get single temperature reading
-    temp1 = (ctypes.c_float * 9)()
-    overflow = ctypes.c_int16(0)
     units = tc08.USBTC08_UNITS["USBTC08_UNITS_CENTIGRADE"]
     status["get_single"] = tc08.usb_tc08_get_single(chandle1,
-                                                    ctypes.byref(temp1),
-                                                    ctypes.byref(overflow),
+                                                    ctypes.byref(single_temp),
+                                                    ctypes.byref(single_overflow),
                                                     units)
     assert_pico2000_ok(status["get_single"])
 
-    return temp1[1], temp1[2], temp1[3], temp1[5], temp1[6], temp1[8]
-    # 1 = soil1
-    # 2 = soil2
-    # 3 = soil3
-    # 5 = ambient
-    # 6 = light sensor
-    # 8 = black ref
+    return tuple(single_temp[channel] for channel in CHANNELS)
 
-def stream_thermocouples(chandle):
-    status = {}
-    temp_buffer = (ctypes.c_float * 2 * 15)()
-    times_ms_buffer = (ctypes.c_int32 * 15)()
-    overflow = ctypes.c_int16()
-    status["get_temp"] = tc08.usb_tc08_get_temp(chandle, ctypes.byref(temp_buffer), ctypes.byref(times_ms_buffer), 15, ctypes.byref(overflow), 1, 0, 0)
-    assert_pico2000_ok(status["get_temp"])
-    print(temp_buffer[2][1])
+# Streaming mode. usb_tc08_run makes the TC-08 sample all channels on its
+# own at a fixed interval and buffer the readings (up to 600 per channel);
+# drain() collects them with usb_tc08_get_temp into a NumPy ring buffer.
+
+# readings kept in memory per channel (an hour at 1 s)
+STREAM_CAPACITY = 3600
+
+# readings collected per usb_tc08_get_temp call
+STREAM_CHUNK = 64
+
+class TC08Stream:
+    """Buffered TC-08 acquisition into a ring of (device ms, host time, channel values).
+
+    Reading n of the run was taken device_ms = n * interval_ms after the
+    run started; host timestamps are the host time of usb_tc08_run plus
+    device_ms. If log_path is given, every complete reading is also
+    appended there (see tc08_log.py).
+
+    When the unit's buffer overflows between drains, the oldest readings
+    are lost: they stay NaN in the ring and the log, and are counted per
+    channel in overflows and lost (see metrics()).
+    """
+
+    def __init__(self, chandle, interval_ms=None, capacity=STREAM_CAPACITY, log_path=None):
+        self.chandle = chandle
+        self.requested_ms = interval_ms
+        self.capacity = capacity
+
+        self.device_ms = np.zeros(capacity, dtype=np.int64)
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.values = np.full((capacity, len(CHANNELS)), np.nan, dtype=np.float32)
+
+        # readings collected so far per channel; readings below the
+        # smallest of these are complete
+        self.collected = np.zeros(len(CHANNELS), dtype=np.int64)
+        self.complete = 0
+        self.overflows = np.zeros(len(CHANNELS), dtype=np.int64)
+        self.lost = np.zeros(len(CHANNELS), dtype=np.int64)
+        self.lock = threading.Lock()
+        self.drain_lock = threading.Lock()
+
+        self.temp_buffer = (ctypes.c_float * STREAM_CHUNK)()
+        self.times_ms_buffer = (ctypes.c_int32 * STREAM_CHUNK)()
+        self.overflow = ctypes.c_int16()
+        self.units = tc08.USBTC08_UNITS["USBTC08_UNITS_CENTIGRADE"]
+
+        self.log = open(log_path, 'ab') if log_path else None
+
+    def start(self):
+        wait_settled(self.chandle)
+        if self.requested_ms is None:
+            self.requested_ms = tc08.usb_tc08_get_minimum_interval_ms(self.chandle)
+        self.interval_ms = tc08.usb_tc08_run(self.chandle, self.requested_ms)
+        assert_pico2000_ok(self.interval_ms)
+        self.run_started = time.time()
+
+    def drain(self):
+        """Collect everything the unit has buffered; returns the number of new complete readings."""
+        with self.drain_lock:
+            return self.drain_channels()
+
+    def drain_channels(self):
+        for c, channel in enumerate(CHANNELS):
+            while True:
+                count = tc08.usb_tc08_get_temp(self.chandle, ctypes.byref(self.temp_buffer),
+                                               ctypes.byref(self.times_ms_buffer), STREAM_CHUNK,
+                                               ctypes.byref(self.overflow), channel, self.units, 0)
+                if count < 0:
+                    raise IOError("usb_tc08_get_temp failed on channel %d" % channel)
+                if self.overflow.value:
+                    self.overflows[c] += 1
+                    runlog.warning("TC-08 buffer overflowed on channel %d, readings lost" % channel)
+                if count == 0:
+                    break
+                self.store(c, count)
+                if count < STREAM_CHUNK:
+                    break
+
+        with self.lock:
+            complete = int(self.collected.min())
+            new = complete - self.complete
+            if self.log is not None and new > 0:
+                self.log.write(self.records(self.complete, complete).tobytes())
+                self.log.flush()
+            self.complete = complete
+        return new
+
+    def store(self, c, count):
+        times_ms = np.frombuffer(self.times_ms_buffer, dtype=np.int32, count=count).astype(np.int64)
+        temps = np.frombuffer(self.temp_buffer, dtype=np.float32, count=count)
+
+        # place each reading by its sample number, so readings lost to a
+        # device buffer overflow leave a gap rather than shifting the rest
+        numbers = (times_ms + self.interval_ms // 2) // self.interval_ms
+        slots = numbers % self.capacity
+        with self.lock:
+            # readings skipped since the last one collected on this channel
+            self.lost[c] += max(0, int(numbers[0]) - int(self.collected[c]))
+            fresh = numbers >= self.collected.max()
+            self.values[slots[fresh]] = np.nan
+            self.values[slots, c] = temps
+            self.device_ms[slots] = numbers * self.interval_ms
+            self.timestamps[slots] = self.run_started + numbers * self.interval_ms / 1000.0
+            self.collected[c] = numbers[-1] + 1
+
+    def records(self, first, end):
+        """Complete readings first..end-1 as a STREAM_DTYPE array."""
+        slots = np.arange(max(first, end - self.capacity), end) % self.capacity
+        out = np.empty(len(slots), dtype=STREAM_DTYPE)
+        out['device_ms'] = self.device_ms[slots]
+        out['timestamp'] = self.timestamps[slots]
+        out['values'] = self.values[slots]
+        return out
+
+    def latest(self):
+        """The newest complete reading as a dict keyed by CHANNEL_NAMES, and its timestamp."""
+        with self.lock:
+            if self.complete == 0:
+                return None, None
+            slot = (self.complete - 1) % self.capacity
+            return dict(zip(CHANNEL_NAMES, self.values[slot].tolist())), float(self.timestamps[slot])
+
+    def window(self, center, half_width=1.0):
+        """Mean of every channel over center +- half_width seconds (host time), and the reading count.
+
+        Readings still in the ring only; tc08_log.window_means works on the
+        whole stream log.
+        """
+        start = (center - half_width - self.run_started) * 1000.0 / self.interval_ms
+        end = (center + half_width - self.run_started) * 1000.0 / self.interval_ms
+        with self.lock:
+            first = max(int(np.ceil(start)), self.complete - self.capacity, 0)
+            last = min(int(np.floor(end)) + 1, self.complete)
+            values = self.values[np.arange(first, max(first, last)) % self.capacity]
+
+        if len(values) == 0:
+            means = [None] * len(CHANNEL_NAMES)
+        else:
+            means = np.nanmean(values, axis=0, dtype=np.float64).tolist()
+        return dict(zip(CHANNEL_NAMES, means)), len(values)
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'readings': int(self.complete),
+                'overflows': int(self.overflows.sum()),
+                # the channels usually overflow together: the worst one
+                'lost_readings': int(self.lost.max()),
+                'overflowed_channels': [CHANNELS[c] for c in np.flatnonzero(self.overflows)],
+            }
+
+    def log_status(self):
+        m = self.metrics()
+        runlog.warning("**** TC-08 stream: %d readings, %d buffer overflows (channels %s), %d readings lost" %
+                       (m['readings'], m['overflows'], m['overflowed_channels'], m['lost_readings']))
+
+    def stop(self):
+        # keep the last readings, which cover the window of the last frame
+        self.drain()
+        tc08.usb_tc08_stop(self.chandle)
+        if self.log is not None:
+            self.log.close()
+            self.log = None
 
 def stop_thermocouples(chandle):
     status = {}
@@ -3,46 +3,133 @@
 # License: GPL 2.0
  
 #import os
-import cv2
 #from time import *
 import time
 import threading
-import PySpin
 import struct
 import socket
+import collections
+import numpy
+import devices
+
+# Logging and print statements
+import logging
+runlog = logging.getLogger()
+
+PySpin = devices.pyspin()
  
 camera_visible = None #seting the global variable
  
 #os.system('clear') #clear the terminal (optional)
 
-# nodemap argument comes from Spinnaker
- 
-class WebcamPoller(threading.Thread):
-    def __init__(self, nodemap):
-        threading.Thread.__init__(self)
-        global camera_visible #bring it in scope
-        
-        # Grab device features
-        features = PySpin.CCategoryPtr(nodemap.GetNode("DeviceInformation")).GetFeatures()
-        ip_hex = " "
+# how long frame() waits for a freshly decoded frame, in seconds
+REQUEST_TIMEOUT = 1.0
+
+# pause after a failed grab before trying again
+GRAB_RETRY_DELAY = 0.1
+
+# number of recent decode times kept for the percentiles
+DECODE_HISTORY = 256
+
+# decoded frames kept for matching against infrared capture times
+VISIBLE_RING_SIZE = 4
+
+# delay between a visible frame being exposed and grab() returning it
+# (RTSP buffering and transport), subtracted from the grab time; measure
+# it in the field by filming a clock, 0 until then
+VISIBLE_LATENCY = 0.0
+
+class FrameBuffer:
+    """Lock-protected ring of decoded frames with their capture timestamps.
 
-        # Find the IP address 
-        for feat in features:
-            node_feature = PySpin.CValuePtr(feat)
-            if (PySpin.IsReadable(node_feature)):
-                #print(node_feature.GetName())
-                if node_feature.GetName() == "GevDeviceIPAddress":
-                    ip_hex = node_feature.ToString()
+    The grabber decodes into the back slot, the oldest one, then publish()
+    makes it the newest, so readers never see a half-written frame and
+    never wait for a decode. With two slots this is a plain double buffer.
+    """
 
-        # Convert IP address represented as hexadecimal string to decimal integer
-        ip_dec = int(ip_hex,0)
+    def __init__(self, slots=2):
+        self.lock = threading.Lock()
+        self.images = [None] * slots
+        self.timestamps = [None] * slots
+        self.sequence = 0
 
-        # Convert IP address represented as decimal integer to string in the normal format
-        ip_string = socket.inet_ntoa(struct.pack('!L', ip_dec))
+    def back(self, shape, dtype=numpy.uint8):
+        """The slot to decode into, (re)allocated for this frame shape."""
+        slot = (self.sequence + 1) % len(self.images)
+        with self.lock:
+            # out of nearest()'s reach until it is published again
+            self.timestamps[slot] = None
+        image = self.images[slot]
+        if image is None or image.shape != shape or image.dtype != dtype:
+            image = self.images[slot] = numpy.empty(shape, dtype)
+        return image
+
+    def publish(self, timestamp):
+        with self.lock:
+            self.sequence += 1
+            self.timestamps[self.sequence % len(self.images)] = timestamp
+
+    def newest_time(self):
+        with self.lock:
+            return self.timestamps[self.sequence % len(self.images)]
+
+    def latest(self, out=None):
+        """Copy of the newest frame and its timestamp, or (None, None) before the first."""
+        with self.lock:
+            if self.sequence == 0:
+                return None, None
+            return self.copy(self.sequence % len(self.images), out)
+
+    def nearest(self, timestamp, out=None):
+        """Copy of the frame captured closest to timestamp, and its timestamp."""
+        with self.lock:
+            slots = [i for i, t in enumerate(self.timestamps) if t is not None]
+            if not slots:
+                return None, None
+            slot = min(slots, key=lambda i: abs(self.timestamps[i] - timestamp))
+            return self.copy(slot, out)
+
+    def copy(self, slot, out):
+        if out is None:
+            out = self.images[slot].copy()
+        else:
+            numpy.copyto(out, self.images[slot])
+        return out, self.timestamps[slot]
+
+def stream_url(nodemap):
+    """RTSP URL of the visible stream of the camera with this transport layer nodemap."""
+    # Grab device features
+    features = PySpin.CCategoryPtr(nodemap.GetNode("DeviceInformation")).GetFeatures()
+    ip_hex = " "
+
+    # Find the IP address 
+    for feat in features:
+        node_feature = PySpin.CValuePtr(feat)
+        if (PySpin.IsReadable(node_feature)):
+            #print(node_feature.GetName())
+            if node_feature.GetName() == "GevDeviceIPAddress":
+                ip_hex = node_feature.ToString()
+
+    # Convert IP address represented as hexadecimal string to decimal integer
+    ip_dec = int(ip_hex,0)
+
+    # Convert IP address represented as decimal integer to string in the normal format
+    ip_string = socket.inet_ntoa(struct.pack('!L', ip_dec))
+
+    return "rtsp://"+ip_string+"/mpeg4?source=1"
+
+class WebcamPoller(threading.Thread):
+    def __init__(self, nodemap, url=None):
+        threading.Thread.__init__(self)
+        global camera_visible #bring it in scope
 
-        print("rtsp://"+ip_string+"/mpeg4?source=1")        
+        # the URL can be read from the nodemap beforehand, e.g. while the
+        # camera is being configured on another thread
+        if url is None:
+            url = stream_url(nodemap)
+        print(url)
 
-        camera_visible = cv2.VideoCapture("rtsp://"+ip_string+"/mpeg4?source=1")
+        camera_visible = devices.video_capture(url)
         
         # What does this do? Do we want to do this??????
         #camera_visible.set(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT,720)
@@ -55,15 +142,124 @@ class WebcamPoller(threading.Thread):
         self.running = True #setting the thread running to true
         self.daemon = True
 
-        self.im = None
-        self.ret = 0
- 
+        self.buffer = FrameBuffer(VISIBLE_RING_SIZE)
+        self.cond = threading.Condition()
+        self.requested = False
+        self.armed = False
+        self.grab_time = None
+        self.ready = threading.Event()
+
+        self.counts = collections.Counter()
+        self.decode_times = collections.deque(maxlen=DECODE_HISTORY)
+
     def run(self):
+        # grab() keeps the stream current without decoding; the grabbed
+        # frame is only decoded when frame() asks for one
         global camera_visible
         while self.running:
-            (ret, im) = camera_visible.read()
-            self.im = im
-            self.ret = ret
+            if not camera_visible.grab():
+                self.counts['grab_failures'] += 1
+                time.sleep(GRAB_RETRY_DELAY)
+                continue
+
+            self.grab_time = time.time() - VISIBLE_LATENCY
+            self.counts['grabbed'] += 1
+            self.ready.set()
+
+            with self.cond:
+                if not (self.requested or self.armed):
+                    continue
+                self.requested = False
+
+            self.decode(self.grab_time)
+
+    def decode(self, timestamp):
+        t = time.perf_counter()
+        ret, im = camera_visible.retrieve()
+        if not ret or im is None:
+            self.counts['decode_failures'] += 1
+            return
+
+        numpy.copyto(self.buffer.back(im.shape, im.dtype), im)
+        self.buffer.publish(timestamp)
+        self.decode_times.append(time.perf_counter() - t)
+        self.counts['decoded'] += 1
+
+        with self.cond:
+            self.cond.notify_all()
+
+    def wait_ready(self, timeout):
+        """Wait until the stream has delivered its first frame; False if it has not within timeout."""
+        return self.ready.wait(timeout)
+
+    def frame(self, timeout=REQUEST_TIMEOUT):
+        """Decode the next grabbed frame and return (image, capture time).
+
+        Waits at most timeout seconds; if no new frame arrives in time the
+        previous one is returned (counted as stale), or (None, None) if
+        there has never been one.
+        """
+        with self.cond:
+            self.counts['requests'] += 1
+            sequence = self.buffer.sequence
+            self.requested = True
+            self.cond.wait_for(lambda: self.buffer.sequence != sequence, timeout)
+            fresh = self.buffer.sequence != sequence
+            if not fresh:
+                self.counts['stale'] += 1
+
+        return self.buffer.latest()
+
+    def arm(self):
+        """Decode every grabbed frame until frame_near() is called.
+
+        Called just before the infrared capture, so the ring holds visible
+        frames from both sides of the infrared capture time.
+        """
+        with self.cond:
+            self.armed = True
+
+    def disarm(self):
+        with self.cond:
+            self.armed = False
+
+    def frame_near(self, timestamp, timeout=REQUEST_TIMEOUT):
+        """The decoded frame captured closest to timestamp (host epoch seconds), and its time.
+
+        Waits at most timeout seconds for a frame captured after timestamp,
+        so the best match on either side is in the ring, then stops decoding.
+        """
+        with self.cond:
+            self.counts['requests'] += 1
+            self.armed = True
+            newer = lambda: (self.buffer.newest_time() or 0.0) >= timestamp
+            if not self.cond.wait_for(newer, timeout):
+                self.counts['stale'] += 1
+            self.armed = False
+
+        return self.buffer.nearest(timestamp)
+
+    def stop(self):
+        self.running = False
+
+    def metrics(self):
+        """Grab and decode counts; skipped is frames grabbed but never decoded."""
+        decode_times = numpy.array(self.decode_times) if self.decode_times else numpy.array([numpy.nan])
+        metrics = {
+            'decode_p50_s': float(numpy.percentile(decode_times, 50)),
+            'decode_max_s': float(numpy.max(decode_times)),
+        }
+        for name in ('grabbed', 'decoded', 'requests', 'stale', 'grab_failures', 'decode_failures'):
+            metrics[name] = self.counts[name]
+        metrics['skipped'] = metrics['grabbed'] - metrics['decoded']
+        return metrics
+
+    def log_metrics(self):
+        m = self.metrics()
+        runlog.warning("**** Visible: %d grabbed, %d decoded (p50 %.3f s, max %.3f s), %d requests, "
+                       "%d stale, %d grab failures, %d decode failures" %
+                       (m['grabbed'], m['decoded'], m['decode_p50_s'], m['decode_max_s'], m['requests'],
+                        m['stale'], m['grab_failures'], m['decode_failures']))
 
 # OKAY it works
 #system = PySpin.System.GetInstance()
@@ -78,6 +274,6 @@ class WebcamPoller(threading.Thread):
 #time.sleep(1)
 
 #for i in range(10):
-#    image_visible = wcp.im.copy()
+#    image_visible, visible_time = wcp.frame()
 #    cv2.imwrite("visible"+str(i)+".png",image_visible)
 #    time.sleep(0.5)